@@ -0,0 +1,138 @@
+# Batch runner for many Gator Library command files
+#
+# Usage: python batch.py DIR_OR_GLOB [DIR_OR_GLOB ...] [--jobs N] [--flush quit] [--index redblack]
+#        python batch.py DIR_OR_GLOB ... --metadata CATALOG.meta [--columnar]
+#
+# Every command file runs against its own GatorLibrary, exactly as "python main.py FILE" would run it,
+# and its output goes to FILE_output_file.txt as usual. A directory stands for every file in it; a glob
+# may use ** to recurse. Files main.py writes itself (*_output_file.txt, *_profile_*.pstats) are skipped.
+# Files are spread over a process pool with one worker per available CPU. The workers are forked from
+# this process after main.py is imported, so they start without importing anything, and each takes files
+# in chunks, so a short file costs little more than running its commands. A summary of throughput and
+# failures is printed at the end; the exit status is 1 if any file failed.
+#
+# With --metadata, every library starts from the books of a metadata file (see main.py --save-metadata).
+# Each worker maps the file once. Its libraries read titles and authors through that mapping and search
+# the title and author orders saved in it, so the catalog metadata and its indexes exist once, in the
+# page cache, for all workers. Each library still holds a small object, a dict entry and a tree node per
+# book of its own.
+import argparse
+import glob
+import multiprocessing
+import os
+import sys
+import time
+
+from main import ORDERED_INDEXES, GatorLibrary, MetadataStore, OutputSink, parse_flush_policy, run_commands
+
+# Set in each worker by init_worker: (flush policy, reservation capacity, render cache size, index,
+# metadata file or None, columnar, loan period, reservation TTL)
+OPTIONS = None
+# The worker's mapping of the --metadata file
+CATALOG = None
+
+def init_worker(options):
+    global OPTIONS, CATALOG
+    OPTIONS = options
+    CATALOG = MetadataStore.open(options[4]) if options[4] else None
+
+def is_output_file(path):
+    name = os.path.basename(path)
+    return name.endswith("_output_file.txt") or ("_profile_" in name and name.endswith(".pstats"))
+
+# Expand directories and globs into a sorted list of command files, without duplicates
+def command_files(patterns):
+    files = set()
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            paths = (os.path.join(pattern, name) for name in os.listdir(pattern))
+        else:
+            paths = glob.glob(pattern, recursive=True)
+        files.update(path for path in paths if os.path.isfile(path) and not is_output_file(path))
+    return sorted(files)
+
+# Run one command file; returns (filename, commands, seconds, error or None)
+def run_file(filename):
+    flush, reservation_capacity, render_cache, index, _, columnar, loan_period, reservation_ttl = OPTIONS
+    start = time.perf_counter()
+    commands = 0
+    try:
+        with open(filename, 'r') as file, OutputSink(f'{filename}_output_file.txt', flush) as output:
+            library = GatorLibrary(output, reservation_capacity, render_cache, index,
+                                   MetadataStore() if columnar else None, loan_period, reservation_ttl)
+            if CATALOG is not None:
+                library.load_metadata(CATALOG)
+            commands = run_commands(library, file)
+    except Exception as error:
+        return filename, commands, time.perf_counter() - start, f"{type(error).__name__}: {error}"
+    return filename, commands, time.perf_counter() - start, None
+
+def available_cpus():
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+def run_batch(files, jobs, options):
+    results = []
+    start = time.perf_counter()
+    if jobs == 1:
+        init_worker(options)
+        results = [run_file(filename) for filename in files]
+    else:
+        # Forked workers inherit the imported modules; elsewhere each worker imports main.py once.
+        methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context("fork" if "fork" in methods else None)
+        chunksize = max(1, min(64, len(files) // (jobs * 4)))
+        with context.Pool(jobs, init_worker, (options,)) as pool:
+            results = list(pool.imap_unordered(run_file, files, chunksize))
+    return results, time.perf_counter() - start
+
+def print_summary(results, elapsed, jobs):
+    failures = sorted((filename, error) for filename, _, _, error in results if error is not None)
+    commands = sum(result[1] for result in results)
+    busy = sum(result[2] for result in results)
+    print(f"{len(results):,} files, {len(failures):,} failed, {commands:,} commands in {elapsed:.2f}s "
+          f"with {jobs} workers: {commands / elapsed:,.0f} commands/s, {len(results) / elapsed:,.1f} files/s")
+    if busy:
+        print(f"worker time {busy:.2f}s ({commands / busy:,.0f} commands/s per worker); "
+              f"pool efficiency {busy / (elapsed * jobs):.0%}")
+    for filename, seconds in sorted(((result[0], result[2]) for result in results), key=lambda item: -item[1])[:5]:
+        print(f"  slowest {seconds:8.3f}s  {filename}")
+    for filename, error in failures:
+        print(f"FAILED {filename}: {error}")
+    sys.stdout.flush()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run many Gator Library command files in parallel.")
+    parser.add_argument("patterns", nargs="+", metavar="DIR_OR_GLOB", help="command files, directories or globs")
+    parser.add_argument("--jobs", type=int, default=available_cpus(), metavar="N",
+                        help="worker processes (default: one per available CPU)")
+    parser.add_argument("--flush", type=parse_flush_policy, default="quit",
+                        help='output flush policy: "command", "quit" or every N commands')
+    parser.add_argument("--reservation-capacity", type=int, default=20, metavar="N",
+                        help="maximum number of reservations per book")
+    parser.add_argument("--render-cache", type=int, default=4096, metavar="N",
+                        help="number of rendered book records to cache (0 disables the cache)")
+    parser.add_argument("--loan-period", type=int, metavar="T",
+                        help="loans fall due T library time units after they start (see Advance)")
+    parser.add_argument("--reservation-ttl", type=int, metavar="T",
+                        help="reservations expire T library time units after they are made")
+    parser.add_argument("--index", choices=ORDERED_INDEXES, default="redblack", help="ordered index for the books")
+    parser.add_argument("--metadata", metavar="FILE", help="start every library from the books of this metadata file")
+    parser.add_argument("--columnar", action="store_true",
+                        help="keep titles and authors of new books in a columnar MetadataStore")
+    args = parser.parse_args(argv)
+
+    files = command_files(args.patterns)
+    if not files:
+        parser.error("no command files found")
+    jobs = max(1, min(args.jobs, len(files)))
+    options = (args.flush, args.reservation_capacity, args.render_cache, args.index, args.metadata, args.columnar,
+               args.loan_period, args.reservation_ttl)
+    results, elapsed = run_batch(files, jobs, options)
+    print_summary(results, elapsed, jobs)
+    if any(error is not None for _, _, _, error in results):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
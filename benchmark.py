@@ -0,0 +1,753 @@
+# Benchmarks for the Gator Library data structures
+#
+# Usage: python benchmark.py memory [--sizes 1000000 10000000] [--store plain|columnar|mapped]
+#        python benchmark.py queue [--sizes 20 1000 100000]
+#        python benchmark.py stress [--threads 8] [--seconds 10]
+#        python benchmark.py persistent [--sizes 10000 1000000] [--operations 100000]
+#        python benchmark.py index [--sizes 10000 1000000] [--operations 100000] [--width 100]
+#        python benchmark.py timers [--sizes 10000 1000000] [--steps 1000]
+#        python benchmark.py generate FILE [workload options]
+#        python benchmark.py workload [workload options] [--json results.jsonl]
+#        python benchmark.py compare BASELINE.jsonl CANDIDATE.jsonl
+import argparse
+import gc
+import itertools
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+from main import (BLACK, ORDERED_INDEXES, RED, BookReservationQueue, CommandStats, ConcurrentLibrary, GatorLibrary,
+                  MetadataStore, NullStream, OutputSink, PersistentRedBlackTree, RedBlackTree, read_catalog,
+                  run_commands)
+
+AUTHORS = [f"Author {i}" for i in range(1000)]
+
+# A command file touching every command but Stats, and the output main.py writes for it
+EXAMPLES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "examples")
+REGRESSION_COMMANDS = os.path.join(EXAMPLES, "regression.txt")
+REGRESSION_OUTPUT = os.path.join(EXAMPLES, "regression_expected.txt")
+
+def null_library():
+    return GatorLibrary(OutputSink(stream=NullStream()))
+
+def catalog_records(n):
+    for bookID in range(1, n + 1):
+        yield bookID, f"Title {bookID}", AUTHORS[bookID % len(AUTHORS)], True
+
+# Resident set size of this process in bytes (Linux only)
+def current_rss():
+    with open("/proc/self/statm") as statm:
+        return int(statm.read().split()[1]) * 4096
+
+# Like catalog_records, but every author is a string object of its own, as read_catalog produces them
+def parsed_catalog_records(n):
+    for bookID in range(1, n + 1):
+        yield bookID, f"Title {bookID}", f"Author {bookID % len(AUTHORS)}", True
+
+# Memory per book: the library is bulk-loaded with n books and the memory still held afterwards
+# (tree nodes, Book objects, book_dict, titles and authors) is divided by n. With store "columnar" the
+# titles and authors go into a MetadataStore; with "mapped" the library is loaded from a metadata file
+# written beforehand, whose mapped pages are shared between processes and not counted by tracemalloc
+# (with --rss, the pages the load touched are).
+def bench_memory(sizes, use_rss=False, reservations=0, store="plain"):
+    print(f"{'books':>10}  {'bytes/book':>10}  {'load s':>7}  store {store}")
+    for n in sizes:
+        if store == "mapped":
+            directory = tempfile.TemporaryDirectory()
+            path = os.path.join(directory.name, "catalog.meta")
+            writer = MetadataStore()
+            for bookID, title, author, _ in parsed_catalog_records(n):
+                writer.add(bookID, title, author)
+            writer.save(path)
+            del writer
+        gc.collect()
+        if use_rss:
+            before = current_rss()
+        else:
+            tracemalloc.start()
+            before = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        library = GatorLibrary(OutputSink(stream=NullStream()), metadata=MetadataStore() if store == "columnar" else None)
+        if store == "mapped":
+            library.load_metadata(MetadataStore.open(path))
+        else:
+            library.load_catalog(parsed_catalog_records(n))
+        for bookID in range(1, n + 1, reservations or n + 1):
+            library.BorrowBook(1, bookID, 1)
+            library.BorrowBook(2, bookID, 1)
+        elapsed = time.perf_counter() - start
+        gc.collect()
+        if use_rss:
+            used = current_rss() - before
+        else:
+            used = tracemalloc.get_traced_memory()[0] - before
+            tracemalloc.stop()
+        print(f"{n:>10}  {used / n:>10.1f}  {elapsed:>7.2f}")
+        del library
+        if store == "mapped":
+            gc.collect()
+            directory.cleanup()
+    sys.stdout.flush()
+
+# The hand-rolled binary heap BookReservationQueue used before it moved to heapq, kept as the
+# baseline for the queue benchmark. Items are (patron_id, priority, timestamp).
+class LegacyReservationQueue:
+    def __init__(self):
+        self.heap = []
+        self.positions = {}
+
+    def swap_items(self, i, j):
+        self.heap[i], self.heap[j] = self.heap[j], self.heap[i]
+        self.positions[self.heap[i][0]] = i
+        self.positions[self.heap[j][0]] = j
+
+    def heapify_up(self, index):
+        while index > 0:
+            parent_index = (index - 1) // 2
+            if self.compare_items(self.heap[index], self.heap[parent_index]) < 0:
+                self.swap_items(index, parent_index)
+                index = parent_index
+            else:
+                break
+
+    def heapify_down(self, index):
+        left_child_index = 2 * index + 1
+        right_child_index = 2 * index + 2
+        smallest = index
+        if left_child_index < len(self.heap) and self.compare_items(self.heap[left_child_index], self.heap[smallest]) < 0:
+            smallest = left_child_index
+        if right_child_index < len(self.heap) and self.compare_items(self.heap[right_child_index], self.heap[smallest]) < 0:
+            smallest = right_child_index
+        if smallest != index:
+            self.swap_items(index, smallest)
+            self.heapify_down(smallest)
+
+    def compare_items(self, item1, item2):
+        if item1[1] != item2[1]:
+            return -1 if item1[1] < item2[1] else 1
+        if item1[2] != item2[2]:
+            return -1 if item1[2] < item2[2] else 1
+        return 0
+
+    def add_reservation(self, patron_id, priority):
+        self.positions[patron_id] = len(self.heap)
+        self.heap.append((patron_id, priority, time.time()))
+        self.heapify_up(len(self.heap) - 1)
+
+    def remove_reservation(self):
+        if not self.heap:
+            return None
+        root = self.heap[0]
+        del self.positions[root[0]]
+        last_item = self.heap.pop()
+        if self.heap:
+            self.heap[0] = last_item
+            self.positions[last_item[0]] = 0
+            self.heapify_down(0)
+        return root
+
+    def remove_specific_patron(self, patron_id):
+        index = self.positions.get(patron_id)
+        if index is None:
+            return None
+        self.swap_items(index, len(self.heap) - 1)
+        removed = self.heap.pop()
+        del self.positions[patron_id]
+        if index < len(self.heap):
+            if index > 0 and self.compare_items(self.heap[index], self.heap[(index - 1) // 2]) < 0:
+                self.heapify_up(index)
+            else:
+                self.heapify_down(index)
+        return removed
+
+# Throughput of add/remove on a single reservation queue of k entries: add k reservations with random
+# priorities, then drain them with remove_reservation; and add k again, then cancel them in random order.
+def bench_queue(sizes, rounds=3):
+    print(f"{'queue':>24}  {'size':>7}  {'add/s':>11}  {'remove/s':>11}  {'cancel/s':>11}")
+    for k in sizes:
+        rng = random.Random(k)
+        priorities = [rng.randint(1, 10) for _ in range(k)]
+        cancel_order = rng.sample(range(k), k)
+        for queue_class in (LegacyReservationQueue, BookReservationQueue):
+            add = remove = cancel = 0.0
+            for _ in range(rounds):
+                queue = queue_class()
+                start = time.perf_counter()
+                for patron_id, priority in enumerate(priorities):
+                    queue.add_reservation(patron_id, priority)
+                add += time.perf_counter() - start
+                start = time.perf_counter()
+                for _ in range(k):
+                    queue.remove_reservation()
+                remove += time.perf_counter() - start
+
+                queue = queue_class()
+                for patron_id, priority in enumerate(priorities):
+                    queue.add_reservation(patron_id, priority)
+                start = time.perf_counter()
+                for patron_id in cancel_order:
+                    queue.remove_specific_patron(patron_id)
+                cancel += time.perf_counter() - start
+            operations = k * rounds
+            print(f"{queue_class.__name__:>24}  {k:>7}  {operations / add:>11,.0f}  {operations / remove:>11,.0f}  {operations / cancel:>11,.0f}")
+    sys.stdout.flush()
+
+# Check the red-black properties, parent links and subtree sizes of a tree; returns its black height
+def check_tree(tree):
+    nil_node = tree.nil_node
+    assert tree.root == nil_node or (tree.root.node_color == BLACK and tree.root.parent == nil_node)
+    stack = [(tree.root, None, None)]
+    heights = {nil_node: 0}
+    order = []
+    while stack:
+        q, lo, hi = stack.pop()
+        if q == nil_node:
+            continue
+        assert (lo is None or lo < q.key) and (hi is None or q.key < hi), f"key {q.key} out of order"
+        for child in (q.left_child, q.right_child):
+            assert child == nil_node or child.parent is q, f"bad parent link below {q.key}"
+        if q.node_color == RED:
+            assert q.left_child.node_color == BLACK and q.right_child.node_color == BLACK, f"red {q.key} has a red child"
+        order.append(q)
+        stack.append((q.left_child, lo, q.key))
+        stack.append((q.right_child, q.key, hi))
+    for q in reversed(order):
+        left, right = heights[q.left_child], heights[q.right_child]
+        assert left == right, f"black heights differ below {q.key}"
+        assert q.size == q.left_child.size + q.right_child.size + 1, f"size of {q.key} is wrong"
+        heights[q] = left + (q.node_color == BLACK)
+    return heights[tree.root]
+
+# Check the tree against book_dict, and every book's loan and reservation queue against the patron index
+def check_library(library, capacity):
+    check_tree(library.book_index)
+    assert [bookID for bookID, _ in library.book_index.iter_items()] == sorted(library.book_dict)
+    loans, reservations = {}, {}
+    for bookID, book in library.book_dict.items():
+        assert book.availabilityStatus == (book.borrowedBy is None), f"book {bookID} availability"
+        if book.borrowedBy is not None:
+            loans.setdefault(book.borrowedBy, set()).add(bookID)
+        queue = book.reservationHeap
+        if queue:
+            assert len(queue) <= capacity, f"book {bookID} queue over capacity"
+            assert book.borrowedBy not in queue, f"book {bookID} reserved by its borrower"
+            live = [entry for entry in queue.heap if queue.entries.get(entry[2]) is entry]
+            assert sorted(live) == sorted(queue.entries.values()), f"book {bookID} heap lost a reservation"
+            assert len(queue.heap) - len(live) == queue.stale, f"book {bookID} stale count"
+            for patronID in queue.entries:
+                reservations.setdefault(patronID, set()).add(bookID)
+    assert loans == library.patron_index.loans, "patron index loans"
+    assert reservations == library.patron_index.reservations, "patron index reservations"
+
+# A LibrarySnapshot of a ConcurrentLibrary, read on a thread that has never run a command, must return
+# the same text PrintBooks and FindClosestBook gave when the snapshot was taken, whatever changes since
+def check_snapshot_threads(books=200):
+    with ConcurrentLibrary(GatorLibrary(index="persistent"), threads=1) as shared:
+        for bookID in range(1, books + 1):
+            shared.execute(f'InsertBook({bookID}, "Title {bookID}", "Author {bookID % 10}", "Yes")')
+        expected = (shared.execute(f'PrintBooks(1, {books})'), shared.execute('FindClosestBook(0)'))
+        snapshot = shared.snapshot()
+        shared.execute(f'DeleteBooks(1, {books // 2})')
+        results = []
+        reader = threading.Thread(target=lambda: results.append((snapshot.PrintBooks(1, books),
+                                                                 snapshot.FindClosestBook(0))))
+        reader.start()
+        reader.join()
+        assert results == [expected], "snapshot read on a fresh thread returned the wrong text"
+
+# The regression command file, run command by command on a ConcurrentLibrary's thread pool, must give
+# exactly main.py's output for it
+def check_regression():
+    with open(REGRESSION_COMMANDS) as file, ConcurrentLibrary(threads=1) as shared:
+        output = "".join(shared.map(file))
+    with open(REGRESSION_OUTPUT) as file:
+        assert output == file.read(), f"{REGRESSION_COMMANDS} no longer gives {REGRESSION_OUTPUT}"
+
+# Stress test of ConcurrentLibrary: worker threads issue a random mix of reads and writes for a while.
+# Reader threads also check the tree invariants under the read lock, and that ColorFlipCount never
+# goes backwards; the whole library is checked at the end, along with check_snapshot_threads and
+# check_regression.
+def bench_stress(threads, seconds, books, write_ratio, capacity=5):
+    library = GatorLibrary(reservation_capacity=capacity)
+    library.load_catalog(catalog_records(books))
+    idspace = books * 2
+    failures = []
+    counts = [0] * threads
+    deadline = time.perf_counter() + seconds
+
+    with ConcurrentLibrary(library, threads) as shared:
+        def worker(index):
+            rng = random.Random(index)
+            last_flips = 0
+            try:
+                while time.perf_counter() < deadline:
+                    bookID = rng.randint(1, idspace)
+                    patronID = rng.randint(1, 50)
+                    if rng.random() < write_ratio:
+                        command = rng.choice([
+                            f'InsertBook({bookID}, "Title {bookID}", "Author {bookID % 10}", "Yes")',
+                            f'DeleteBook({bookID})',
+                            f'DeleteBooks({bookID}, {bookID + rng.randint(0, 3)})',
+                            f'BorrowBook({patronID}, {bookID}, {rng.randint(1, 5)})',
+                            f'BorrowBook({patronID}, {bookID}, {rng.randint(1, 5)})',
+                            f'ReturnBook({patronID}, {bookID})',
+                            f'CancelReservation({patronID}, {bookID})',
+                        ])
+                        shared.execute(command)
+                    elif rng.random() < 0.01:
+                        with shared.lock.read_locked():
+                            check_tree(library.book_index)
+                    else:
+                        command = rng.choice([f'PrintBook({bookID})', f'PrintBooks({bookID}, {bookID + 10})',
+                                              f'FindClosestBook({bookID})', 'ColorFlipCount()'])
+                        output = shared.execute(command)
+                        if command == 'ColorFlipCount()':
+                            flips = int(output.split(":")[1])
+                            assert flips >= last_flips, "ColorFlipCount went backwards"
+                            last_flips = flips
+                    counts[index] += 1
+            except Exception as error:
+                failures.append(f"thread {index}: {error!r}")
+
+        start = time.perf_counter()
+        workers = [threading.Thread(target=worker, args=(index,)) for index in range(threads)]
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+        elapsed = time.perf_counter() - start
+
+    try:
+        check_library(library, capacity)
+        check_snapshot_threads()
+        check_regression()
+    except AssertionError as error:
+        failures.append(f"final check: {error}")
+    print(f"{threads} threads, {sum(counts):,} commands in {elapsed:.1f}s ({sum(counts) / elapsed:,.0f}/s), "
+          f"{len(library.book_dict):,} books left, Color Flip Count {library.ColorFlipCount()}")
+    for failure in failures:
+        print(failure)
+    print("FAILED" if failures else "OK")
+    sys.stdout.flush()
+    return not failures
+
+# Write overhead of the path-copying tree: both trees are bulk-built with n keys, then take the same
+# sequence of single-key inserts and deletes. A second, traced run of the persistent tree reports the
+# memory live at the end while one version from before the operations is still held (the tree included),
+# and how much of it dropping that version frees.
+def bench_persistent(sizes, operations):
+    print(f"{'tree':>22}  {'size':>9}  {'insert/s':>11}  {'delete/s':>11}  {'live MB':>8}  {'freed MB':>8}")
+    for n in sizes:
+        rng = random.Random(n)
+        keys = rng.sample(range(4 * n), n)
+        present = set(keys)
+        inserts = [key for key in rng.sample(range(4 * n), min(2 * operations, 4 * n)) if key not in present][:operations]
+        deletes = rng.sample(keys, min(operations, n))
+        items = [(key, None) for key in sorted(keys)]
+
+        def run(tree_class, hold):
+            tree = tree_class()
+            tree.build_from_sorted(items)
+            version = tree.version() if hold else None
+            start = time.perf_counter()
+            for key in inserts:
+                tree.insert(key, None)
+            insert_time = time.perf_counter() - start
+            start = time.perf_counter()
+            for key in deletes:
+                tree.delete(key)
+            delete_time = time.perf_counter() - start
+            return tree, version, len(inserts) / insert_time, len(deletes) / delete_time
+
+        rates = {}
+        for tree_class in (RedBlackTree, PersistentRedBlackTree):
+            gc.collect()
+            rates[tree_class] = run(tree_class, False)[2:]
+            memory = ""
+            if tree_class is PersistentRedBlackTree:
+                tracemalloc.start()
+                base = tracemalloc.get_traced_memory()[0]
+                tree, version, _, _ = run(tree_class, True)
+                held = tracemalloc.get_traced_memory()[0]
+                del version
+                freed = held - tracemalloc.get_traced_memory()[0]
+                tracemalloc.stop()
+                memory = f"{(held - base) / 1e6:>8.1f}  {freed / 1e6:>8.1f}"
+            print(f"{tree_class.__name__:>22}  {n:>9,}  {rates[tree_class][0]:>11,.0f}  {rates[tree_class][1]:>11,.0f}  {memory}")
+        in_place, persistent = rates[RedBlackTree], rates[PersistentRedBlackTree]
+        print(f"{'overhead':>22}  {n:>9,}  {in_place[0] / persistent[0]:>10.2f}x  {in_place[1] / persistent[1]:>10.2f}x")
+    sys.stdout.flush()
+
+# Compare the ordered indexes on the same n bookIDs (drawn from 1..4n): point lookups with get,
+# FindClosestBook lookups with predecessor and successor, range scans of about width books on the bare
+# index and through PrintBooks (render cache off, output discarded), and a mixed stream of single-key
+# inserts and deletes applied to a freshly built index
+def bench_index(sizes, operations, width):
+    print(f"{'index':>10}  {'size':>9}  {'get/s':>11}  {'closest/s':>11}  {'scan keys/s':>12}  "
+          f"{'PrintBooks/s':>12}  {'mixed ops/s':>11}")
+    for n in sizes:
+        rng = random.Random(n)
+        keys = sorted(rng.sample(range(1, 4 * n + 1), n))
+        probes = [rng.randint(1, 4 * n) for _ in range(operations)]
+        starts = [rng.randint(1, 4 * n) for _ in range(max(1, operations // width))]
+        present = set(keys)
+        mixed = []
+        for _ in range(operations):
+            key = rng.randint(1, 4 * n)
+            mixed.append((key not in present, key))
+            present.symmetric_difference_update((key,))
+        for name, index_class in ORDERED_INDEXES.items():
+            library = GatorLibrary(OutputSink(stream=NullStream()), render_cache_size=0, index=name)
+            library.load_catalog((bookID, f"Title {bookID}", AUTHORS[bookID % len(AUTHORS)], True) for bookID in keys)
+            index = library.book_index
+            gc.collect()
+            start = time.perf_counter()
+            for key in probes:
+                index.get(key)
+            lookups = len(probes) / (time.perf_counter() - start)
+            start = time.perf_counter()
+            for key in probes:
+                index.predecessor(key)
+                index.successor(key)
+            closest = len(probes) / (time.perf_counter() - start)
+            scanned = 0
+            start = time.perf_counter()
+            for key in starts:
+                for _ in index.iter_range(key, key + 4 * width):
+                    scanned += 1
+            scans = scanned / (time.perf_counter() - start)
+            start = time.perf_counter()
+            for key in starts:
+                library.PrintBooks(key, key + 4 * width)
+            printed = scanned / (time.perf_counter() - start)
+            del library, index
+            index = index_class()
+            index.build_from_sorted([(key, None) for key in keys])
+            start = time.perf_counter()
+            for insert, key in mixed:
+                if insert:
+                    index.insert(key, None)
+                else:
+                    index.delete(key)
+            updates = len(mixed) / (time.perf_counter() - start)
+            print(f"{name:>10}  {n:>9,}  {lookups:>11,.0f}  {closest:>11,.0f}  {scans:>12,.0f}  {printed:>12,.0f}  {updates:>11,.0f}")
+    sys.stdout.flush()
+
+# Cost of Advance: n books are borrowed at times spread evenly over steps time units, every other one
+# also reserved, with a loan period and reservation TTL of steps. Library time is then advanced one unit
+# at a time for 2 * steps units, so each Advance fires about n / steps timers. For comparison, the last
+# column is the cost of finding the due timers with one scan over all of them instead.
+def bench_timers(sizes, steps):
+    print(f"{'books':>10}  {'Advance/s':>10}  {'fired/s':>11}  {'us/Advance':>10}  {'us/scan':>10}")
+    for n in sizes:
+        library = GatorLibrary(OutputSink(stream=NullStream()), loan_period=steps, reservation_ttl=steps)
+        library.load_catalog(catalog_records(n))
+        for bookID in range(1, n + 1):
+            library.Advance((bookID - 1) * steps // n)
+            library.BorrowBook(1, bookID, 1)
+            if bookID % 2:
+                library.BorrowBook(2, bookID, 1)
+        pending = len(library.timers)
+        deadlines = [entry[0] for entry in library.timers.entries.values()]
+        start = time.perf_counter()
+        due = sum(1 for deadline in deadlines if deadline <= steps)
+        scan = time.perf_counter() - start
+        gc.collect()
+        start = time.perf_counter()
+        for now in range(steps, 3 * steps):
+            library.Advance(now)
+        elapsed = time.perf_counter() - start
+        fired = pending - len(library.timers)
+        assert due and not library.timers
+        print(f"{n:>10}  {2 * steps / elapsed:>10,.0f}  {fired / elapsed:>11,.0f}  {elapsed / (2 * steps) * 1e6:>10.1f}  "
+              f"{scan * 1e6:>10.1f}")
+    sys.stdout.flush()
+
+# bookIDs of a catalog of n books, in the order they are inserted: "sequential" is 1..n in order,
+# "random" n distinct IDs from 1..10n in random order, and "clustered" runs of up to 200 consecutive
+# IDs starting at random places, inserted run by run
+def catalog_ids(n, distribution, rng):
+    if distribution == "sequential":
+        return list(range(1, n + 1))
+    if distribution == "random":
+        return rng.sample(range(1, 10 * n + 1), n)
+    ids, used = [], set()
+    while len(ids) < n:
+        start = rng.randint(1, 10 * n)
+        for bookID in range(start, start + min(rng.randint(1, 200), n - len(ids))):
+            if bookID not in used:
+                used.add(bookID)
+                ids.append(bookID)
+    return ids
+
+def insert_command(bookID):
+    return f'InsertBook({bookID}, "Book {bookID}", "{AUTHORS[bookID % len(AUTHORS)]}", "Yes")'
+
+# Yield a workload of main.py commands over a catalog. Books are picked with Zipfian popularity of
+# exponent zipf (0 is uniform) over a random ranking of the catalog. A read_ratio share of the commands
+# are reads. pressure is the share of writes that are BorrowBook, made by one of patrons patrons, so
+# popular books build up reservation queues; the other writes are ReturnBook by a patron that borrowed
+# or reserved the book, InsertBook of new IDs in the catalog's distribution and DeleteBook.
+def workload_commands(ids, distribution, commands, read_ratio, zipf, pressure, patrons, rng):
+    ranking = ids[:]
+    rng.shuffle(ranking)
+    cum_weights = list(itertools.accumulate(1 / rank ** zipf for rank in range(1, len(ranking) + 1)))
+    holders = {}
+    next_id = max(ids) + 1
+    for bookID in rng.choices(ranking, cum_weights=cum_weights, k=commands):
+        if rng.random() < read_ratio:
+            kind = rng.random()
+            if kind < 0.4:
+                yield f"PrintBook({bookID})"
+            elif kind < 0.65:
+                yield f"FindClosestBook({bookID + rng.randint(-3, 3)})"
+            elif kind < 0.85:
+                yield f"PrintBooks({bookID}, {bookID + rng.randint(1, 20)})"
+            elif kind < 0.95:
+                yield f"CountBooks({bookID}, {bookID + rng.randint(1, 1000)})"
+            else:
+                yield "ColorFlipCount()"
+            continue
+        kind = rng.random()
+        if kind < pressure:
+            patronID = rng.randint(1, patrons)
+            holders.setdefault(bookID, []).append(patronID)
+            yield f"BorrowBook({patronID}, {bookID}, {rng.randint(1, 5)})"
+        elif kind < pressure + (1 - pressure) / 2 and holders.get(bookID):
+            patrons_of_book = holders[bookID]
+            yield f"ReturnBook({patrons_of_book.pop(rng.randrange(len(patrons_of_book)))}, {bookID})"
+        elif rng.random() < 0.5:
+            if distribution == "sequential":
+                new_id, next_id = next_id, next_id + 1
+            elif distribution == "random":
+                new_id = rng.randint(1, 10 * len(ids))
+            else:
+                new_id = bookID + rng.randint(1, 5)
+            yield insert_command(new_id)
+        else:
+            yield f"DeleteBook({bookID})"
+
+WORKLOAD_DEFAULTS = {"books": 20000, "commands": 100000, "distribution": "random", "read_ratio": 0.7,
+                     "zipf": 1.0, "pressure": 0.5, "patrons": 1000, "seed": 1}
+
+def workload_name(params):
+    return (f"{params['distribution']}-b{params['books']}-c{params['commands']}-r{params['read_ratio']}"
+            f"-z{params['zipf']}-p{params['pressure']}")
+
+# Write a command file: the catalog as InsertBook commands, the workload and a final Quit. With
+# catalog_path the catalog goes to that file instead, for main.py --catalog.
+def generate_workload(path, params, catalog_path=None):
+    rng = random.Random(params["seed"])
+    ids = catalog_ids(params["books"], params["distribution"], rng)
+    with open(path, "w") as file:
+        if catalog_path is not None:
+            with open(catalog_path, "w") as catalog:
+                catalog.writelines(insert_command(bookID) + "\n" for bookID in ids)
+        else:
+            file.writelines(insert_command(bookID) + "\n" for bookID in ids)
+        for command in workload_commands(ids, params["distribution"], params["commands"], params["read_ratio"],
+                                         params["zipf"], params["pressure"], params["patrons"], rng):
+            file.write(command + "\n")
+        file.write("Quit()\n")
+
+# Run a command file in this process through the GatorLibrary API, output discarded and every command
+# timed, and print the result as JSON; used by run_workload in a child process of its own
+def run_api(path, catalog_path=None, index="redblack"):
+    library = GatorLibrary(OutputSink(stream=NullStream()), index=index)
+    library.stats = CommandStats()
+    start = time.perf_counter()
+    if catalog_path:
+        with open(catalog_path) as catalog:
+            library.load_catalog(read_catalog(catalog))
+    with open(path) as file:
+        run_commands(library, file)
+    elapsed = time.perf_counter() - start
+    snapshot = library.stats_snapshot()
+    print(json.dumps({"seconds": elapsed, "color_flips": library.ColorFlipCount(), "index": snapshot["index"],
+                      "latency": snapshot["commands"]}))
+
+# Run argv as a child process and return its stdout and peak resident set size in MB
+def run_child(argv):
+    with tempfile.TemporaryFile() as stdout:
+        child = subprocess.Popen(argv, stdout=stdout)
+        _, status, usage = os.wait4(child.pid, 0)
+        child.returncode = os.waitstatus_to_exitcode(status)
+        if child.returncode:
+            raise subprocess.CalledProcessError(child.returncode, argv)
+        stdout.seek(0)
+        return stdout.read().decode(), usage.ru_maxrss / 1024
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+# Generate a workload and run it end to end (main.py on the command file, with --stats) and through the
+# API, with the books in the given ordered index; returns one result record per mode. Both modes time each
+# command, so their throughputs include the same small timing overhead.
+def run_workload(params, bulk_load=False, index="redblack"):
+    here = os.path.dirname(os.path.abspath(__file__))
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "workload.txt")
+        catalog_path = os.path.join(directory, "catalog.txt") if bulk_load else None
+        generate_workload(path, params, catalog_path)
+        with open(path) as file:
+            commands = sum(1 for _ in file) + (params["books"] if bulk_load else 0)
+        stats_path = os.path.join(directory, "stats.json")
+        argv = [sys.executable, os.path.join(here, "main.py"), path, "--flush", "quit", "--stats", stats_path, "--index", index]
+        start = time.perf_counter()
+        _, peak_rss = run_child(argv + (["--catalog", catalog_path] if bulk_load else []))
+        elapsed = time.perf_counter() - start
+        with open(stats_path) as stats_file:
+            stats = json.load(stats_file)
+        results.append({"mode": "end-to-end", "seconds": elapsed, "peak_rss_mb": peak_rss,
+                        "color_flips": stats["index"].get("color_flips"), "index": stats["index"], "latency": stats["commands"]})
+        argv = [sys.executable, os.path.join(here, "benchmark.py"), "api", path, "--index", index] + (["--catalog", catalog_path] if bulk_load else [])
+        output, peak_rss = run_child(argv)
+        results.append(dict(json.loads(output), mode="api", peak_rss_mb=peak_rss))
+    commit = git_commit()
+    for result in results:
+        result.update(workload=workload_name(params), params=params, commit=commit, commands=commands,
+                      throughput=commands / result["seconds"])
+    return results
+
+def print_results(results):
+    print(f"{'workload':<40} {'mode':<10} {'index':<10} {'commands':>9} {'seconds':>8} {'cmds/s':>9} {'peak MB':>8} {'flips':>9}")
+    for result in results:
+        flips = result['color_flips'] if result['color_flips'] is not None else "-"
+        print(f"{result['workload']:<40} {result['mode']:<10} {result['index']['type']:<10} {result['commands']:>9} "
+              f"{result['seconds']:>8.2f} {result['throughput']:>9,.0f} {result['peak_rss_mb']:>8.1f} {flips:>9}")
+    for result in results:
+        print(f"\n{result['workload']} {result['mode']}: latency in us")
+        print(f"  {'command':<16} {'count':>8} {'mean':>8} {'p50':>8} {'p99':>8} {'max':>9}")
+        for name, latency in result["latency"].items():
+            print(f"  {name:<16} {latency['count']:>8} {latency['mean_us']:>8.2f} {latency['p50_us']:>8.2f} "
+                  f"{latency['p99_us']:>8.2f} {latency['max_us']:>9.1f}")
+    sys.stdout.flush()
+
+# Compare two result files written by "workload --json": throughput and mean latency per command of the
+# candidate relative to the baseline, for every (workload, mode) both files contain
+def compare_results(baseline_path, candidate_path):
+    def load(path):
+        with open(path) as file:
+            return {(record["workload"], record["mode"]): record for record in map(json.loads, file)}
+    baseline, candidate = load(baseline_path), load(candidate_path)
+    for key in sorted(baseline.keys() & candidate.keys()):
+        old, new = baseline[key], candidate[key]
+        print(f"{key[0]} {key[1]} ({old['commit']} -> {new['commit']}): throughput "
+              f"{new['throughput'] / old['throughput'] - 1:+.1%}, peak RSS {new['peak_rss_mb'] - old['peak_rss_mb']:+.1f} MB, "
+              f"color flips {old['color_flips']} -> {new['color_flips']}")
+        for name in sorted(old["latency"].keys() & new["latency"].keys()):
+            change = new["latency"][name]["mean_us"] / old["latency"][name]["mean_us"] - 1
+            print(f"  {name:<16} mean {old['latency'][name]['mean_us']:>8.2f} -> {new['latency'][name]['mean_us']:>8.2f} us ({change:+.1%})")
+    sys.stdout.flush()
+
+def add_workload_arguments(parser):
+    parser.add_argument("--books", type=int, default=WORKLOAD_DEFAULTS["books"], help="catalog size")
+    parser.add_argument("--commands", type=int, default=WORKLOAD_DEFAULTS["commands"], help="commands after the catalog")
+    parser.add_argument("--distribution", choices=("sequential", "random", "clustered"),
+                        default=WORKLOAD_DEFAULTS["distribution"], help="bookIDs of the catalog and of new books")
+    parser.add_argument("--read-ratio", type=float, default=WORKLOAD_DEFAULTS["read_ratio"])
+    parser.add_argument("--zipf", type=float, default=WORKLOAD_DEFAULTS["zipf"],
+                        help="Zipf exponent of book popularity (0 for uniform)")
+    parser.add_argument("--pressure", type=float, default=WORKLOAD_DEFAULTS["pressure"],
+                        help="share of writes that are BorrowBook (reservation pressure on popular books)")
+    parser.add_argument("--patrons", type=int, default=WORKLOAD_DEFAULTS["patrons"])
+    parser.add_argument("--seed", type=int, default=WORKLOAD_DEFAULTS["seed"])
+
+def workload_params(args):
+    return {name: getattr(args, name) for name in WORKLOAD_DEFAULTS}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Gator Library benchmarks.")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    memory = subparsers.add_parser("memory", help="bytes per book after a bulk load")
+    memory.add_argument("--sizes", type=int, nargs="+", default=[1_000_000, 10_000_000])
+    memory.add_argument("--rss", action="store_true",
+                        help="measure resident set size instead of tracemalloc (faster, less precise)")
+    memory.add_argument("--reservations", type=int, default=0, metavar="K",
+                        help="borrow and reserve every K-th book")
+    memory.add_argument("--store", choices=("plain", "columnar", "mapped"), default="plain",
+                        help="where titles and authors are kept")
+
+    queue = subparsers.add_parser("queue", help="reservation queue add/remove/cancel throughput")
+    queue.add_argument("--sizes", type=int, nargs="+", default=[20, 1000, 100000])
+
+    stress = subparsers.add_parser("stress", help="concurrent reads and writes with invariant checks")
+    stress.add_argument("--threads", type=int, default=8)
+    stress.add_argument("--seconds", type=float, default=10.0)
+    stress.add_argument("--books", type=int, default=10000)
+    stress.add_argument("--write-ratio", type=float, default=0.2, help="fraction of commands that mutate")
+
+    persistent = subparsers.add_parser("persistent", help="write overhead of the path-copying tree")
+    persistent.add_argument("--sizes", type=int, nargs="+", default=[10_000, 1_000_000])
+    persistent.add_argument("--operations", type=int, default=100_000, help="inserts and deletes per size")
+
+    index = subparsers.add_parser("index", help="compare the ordered indexes: lookups, range scans, inserts/deletes")
+    index.add_argument("--sizes", type=int, nargs="+", default=[10_000, 1_000_000])
+    index.add_argument("--operations", type=int, default=100_000, help="lookups and inserts/deletes per size")
+    index.add_argument("--width", type=int, default=100, help="books per range scan")
+
+    timers = subparsers.add_parser("timers", help="cost of Advance firing loan and reservation timers")
+    timers.add_argument("--sizes", type=int, nargs="+", default=[10_000, 1_000_000])
+    timers.add_argument("--steps", type=int, default=1000, help="time units the loans are spread over")
+
+    generate = subparsers.add_parser("generate", help="write a workload command file for main.py")
+    generate.add_argument("file")
+    generate.add_argument("--catalog", metavar="FILE", help="write the catalog here, for main.py --catalog")
+    add_workload_arguments(generate)
+
+    workload = subparsers.add_parser("workload", help="run a generated workload end to end and through the API")
+    add_workload_arguments(workload)
+    workload.add_argument("--bulk-load", action="store_true", help="load the catalog with --catalog instead of InsertBook")
+    workload.add_argument("--json", metavar="FILE", help="append the results to FILE as JSON lines")
+    workload.add_argument("--index", choices=ORDERED_INDEXES, default="redblack", help="ordered index for the books")
+
+    compare = subparsers.add_parser("compare", help="compare two workload result files")
+    compare.add_argument("baseline")
+    compare.add_argument("candidate")
+
+    api = subparsers.add_parser("api", help=argparse.SUPPRESS)
+    api.add_argument("file")
+    api.add_argument("--catalog")
+    api.add_argument("--index", default="redblack")
+
+    args = parser.parse_args(argv)
+    if args.benchmark == "memory":
+        bench_memory(args.sizes, args.rss, args.reservations, args.store)
+    elif args.benchmark == "queue":
+        bench_queue(args.sizes)
+    elif args.benchmark == "stress":
+        if not bench_stress(args.threads, args.seconds, args.books, args.write_ratio):
+            sys.exit(1)
+    elif args.benchmark == "persistent":
+        bench_persistent(args.sizes, args.operations)
+    elif args.benchmark == "index":
+        bench_index(args.sizes, args.operations, args.width)
+    elif args.benchmark == "timers":
+        bench_timers(args.sizes, args.steps)
+    elif args.benchmark == "generate":
+        generate_workload(args.file, workload_params(args), args.catalog)
+    elif args.benchmark == "workload":
+        results = run_workload(workload_params(args), args.bulk_load, args.index)
+        print_results(results)
+        if args.json:
+            with open(args.json, "a") as file:
+                file.writelines(json.dumps(result) + "\n" for result in results)
+    elif args.benchmark == "compare":
+        compare_results(args.baseline, args.candidate)
+    elif args.benchmark == "api":
+        run_api(args.file, args.catalog, args.index)
+
+if __name__ == "__main__":
+    main()
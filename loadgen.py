@@ -0,0 +1,93 @@
+# Load generator for the Gator Library server (server.py)
+#
+# Usage: python loadgen.py --tcp 127.0.0.1:7070 [--connections 16] [--requests 200000] [--pipeline 32]
+#        python loadgen.py --unix /tmp/gator.sock [--write-ratio 0.2] [--books 100000]
+#
+# Each connection keeps up to --pipeline commands in flight, drawn from a fixed mix of reads and writes
+# over bookIDs 1..--books. Latency is measured per command, from when it is sent to when its response
+# has been read completely. It therefore includes the time the command spent queued behind the
+# connection's earlier commands.
+import argparse
+import asyncio
+import random
+import time
+from collections import deque
+
+def commands(rng, books, write_ratio):
+    while True:
+        bookID = rng.randint(1, books)
+        patronID = rng.randint(1, 1000)
+        if rng.random() < write_ratio:
+            yield rng.choice([
+                f'InsertBook({bookID}, "Title {bookID}", "Author {bookID % 100}", "Yes")',
+                f'BorrowBook({patronID}, {bookID}, {rng.randint(1, 5)})',
+                f'ReturnBook({patronID}, {bookID})',
+                f'DeleteBook({bookID})',
+            ])
+        else:
+            yield rng.choice([f'PrintBook({bookID})', f'PrintBooks({bookID}, {bookID + 10})',
+                              f'FindClosestBook({bookID})', 'ColorFlipCount()'])
+
+async def open_connection(tcp, unix):
+    if unix is not None:
+        return await asyncio.open_unix_connection(unix)
+    host, _, port = tcp.rpartition(":")
+    return await asyncio.open_connection(host or "127.0.0.1", int(port))
+
+async def run_connection(index, args, latencies):
+    reader, writer = await open_connection(args.tcp, args.unix)
+    workload = commands(random.Random(index), args.books, args.write_ratio)
+    count = args.requests // args.connections + (index < args.requests % args.connections)
+    sent_at = deque()
+    window = asyncio.Semaphore(args.pipeline)
+
+    async def send():
+        for _ in range(count):
+            await window.acquire()
+            sent_at.append(time.perf_counter())
+            writer.write(next(workload).encode("utf-8") + b"\n")
+            await writer.drain()
+
+    async def receive():
+        for _ in range(count):
+            while True:
+                line = await reader.readline()
+                if not line:
+                    raise ConnectionError("server closed the connection")
+                if line == b"\n":
+                    break
+            latencies.append(time.perf_counter() - sent_at.popleft())
+            window.release()
+
+    await asyncio.gather(send(), receive())
+    writer.close()
+
+def percentile(ordered, fraction):
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+async def run(args):
+    latencies = []
+    start = time.perf_counter()
+    await asyncio.gather(*(run_connection(index, args, latencies) for index in range(args.connections)))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    print(f"{len(latencies):,} commands over {args.connections} connections in {elapsed:.2f}s: "
+          f"{len(latencies) / elapsed:,.0f} commands/s")
+    print(f"latency ms  p50 {percentile(latencies, 0.50) * 1000:.3f}  p99 {percentile(latencies, 0.99) * 1000:.3f}  "
+          f"max {latencies[-1] * 1000:.3f}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure Gator Library server throughput and latency.")
+    address = parser.add_mutually_exclusive_group(required=True)
+    address.add_argument("--tcp", metavar="HOST:PORT")
+    address.add_argument("--unix", metavar="PATH")
+    parser.add_argument("--connections", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=200000, help="total commands across all connections")
+    parser.add_argument("--pipeline", type=int, default=32, help="commands in flight per connection")
+    parser.add_argument("--write-ratio", type=float, default=0.2, help="fraction of commands that mutate")
+    parser.add_argument("--books", type=int, default=100000, help="bookIDs are drawn from 1..N")
+    args = parser.parse_args(argv)
+    asyncio.run(run(args))
+
+if __name__ == "__main__":
+    main()
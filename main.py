@@ -1,27 +1,69 @@
 # Import necessary modules
+import argparse
+import bisect
+import cProfile
+import heapq
+import io
+import json
+import mmap
+import os
+import re
+import struct
+import threading
+import zlib
 import time
 import sys
+from array import array
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from operator import itemgetter
+
+# Node colors are stored as booleans rather than strings
+RED = True
+BLACK = False
+COLOR_NAMES = {RED: "RED", BLACK: "BLACK"}
 
 # Define a class for Red-Black Tree nodes
 class RedBlackNode:
+    __slots__ = ("key", "value", "node_color", "left_child", "right_child", "parent", "size")
+
     def __init__(self, key, value): # Initialize a node with key, value, color, and pointers to left, right children, and parent
         self.key = key
         self.value = value
-        self.node_color = "RED"  # New nodes are initially set to RED to maintain Red-Black Tree properties.
+        self.node_color = RED  # New nodes are initially set to RED to maintain Red-Black Tree properties.
         self.left_child = None   # Pointer to the left child node.
         self.right_child = None  # Pointer to the right child node.
         self.parent = None
+        self.size = 1  # Number of nodes in the subtree rooted here; kept up to date for order statistics.
+
+# Every tree shares one nil node, so split and join can move whole subtrees between trees without
+# touching their leaves. The delete path tracks the parent of the replacement node itself instead of
+# parking it in nil_node.parent, so the nil node never carries per-tree state.
+NIL_NODE = RedBlackNode(None, None)
+NIL_NODE.node_color = BLACK
+NIL_NODE.size = 0
+
+# Set by --debug: RedBlackTree.delete and delete_fixup then trace their steps on stdout
+DEBUG = False
 
 # Define a class for Red-Black Trees
 class RedBlackTree:
-    def __init__(self): # Initialize a Red-Black Tree with a nil node, root, and color flip count
-        self.nil_node = RedBlackNode(None, None)
-        self.nil_node.node_color = "BLACK"
+    name = "redblack"
+
+    def __init__(self): # Initialize a Red-Black Tree with the shared nil node, root, and color flip count
+        self.nil_node = NIL_NODE
         self.root = self.nil_node
         self.color_flip_count = 0
+        # Counters for Stats; like color_flip_count they are plain increments, so they are always kept.
+        self.left_rotations = 0
+        self.right_rotations = 0
+        self.insert_fixup_iterations = 0
+        self.delete_fixup_iterations = 0
 
 # Perform a left rotation operation to maintain Red-Black Tree properties
     def left_rotate(self, p):
+        self.left_rotations += 1
         q = p.right_child
         p.right_child = q.left_child
         if q.left_child != self.nil_node:
@@ -35,9 +77,12 @@ class RedBlackTree:
             p.parent.right_child = q
         q.left_child = p
         p.parent = q
+        q.size = p.size
+        p.size = p.left_child.size + p.right_child.size + 1
 
 # Perform a right rotation operation to maintain Red-Black Tree properties
     def right_rotate(self, q):
+        self.right_rotations += 1
         p = q.left_child
         q.left_child = p.right_child
         if p.right_child != self.nil_node:
@@ -51,6 +96,8 @@ class RedBlackTree:
             q.parent.right_child = p
         p.right_child = q
         q.parent = p
+        p.size = q.size
+        q.size = q.left_child.size + q.right_child.size + 1
 
  # Insert a new node with key and value into the Red-Black Tree
     def insert(self, key, value):
@@ -59,6 +106,7 @@ class RedBlackTree:
         p = self.root
         while p != self.nil_node:
             q = p
+            p.size += 1  # The new node ends up somewhere below every node on the search path.
             if new_node.key < p.key:
                 p = p.left_child
             else:
@@ -76,16 +124,17 @@ class RedBlackTree:
 
 # Fix any Red-Black Tree property violations after insertion
     def insert_fixup(self, q):
-        while q.parent.node_color == "RED":
+        while q.parent.node_color == RED:
+            self.insert_fixup_iterations += 1
              # If the parent is the left child of its parent.
             if q.parent == q.parent.parent.left_child:
                  # Set 'p' as the sibling of the parent.
                 p = q.parent.parent.right_child
                 # If the sibling is also RED, perform color adjustments to restore the properties.
-                if p.node_color == "RED":
-                    q.parent.node_color = "BLACK"
-                    p.node_color = "BLACK"
-                    q.parent.parent.node_color = "RED"
+                if p.node_color == RED:
+                    q.parent.node_color = BLACK
+                    p.node_color = BLACK
+                    q.parent.parent.node_color = RED
                     q = q.parent.parent
                     self.color_flip_count += 3 # Increase the color flip count.
                 else:
@@ -94,8 +143,8 @@ class RedBlackTree:
                         q = q.parent
                         self.left_rotate(q)
                         # Adjust colors and perform a right rotation to restore properties.
-                    q.parent.node_color = "BLACK"
-                    q.parent.parent.node_color = "RED"
+                    q.parent.node_color = BLACK
+                    q.parent.parent.node_color = RED
                     self.right_rotate(q.parent.parent)
                     # Increase color flip count if the parent's parent is not the nil node.
                     if q.parent.parent != self.nil_node:
@@ -103,10 +152,10 @@ class RedBlackTree:
             else:
                  # If the parent is the right child of its parent.
                 p = q.parent.parent.left_child
-                if p.node_color == "RED":
-                    q.parent.node_color = "BLACK"
-                    p.node_color = "BLACK"
-                    q.parent.parent.node_color = "RED"
+                if p.node_color == RED:
+                    q.parent.node_color = BLACK
+                    p.node_color = BLACK
+                    q.parent.parent.node_color = RED
                     q = q.parent.parent
                     self.color_flip_count += 3
                 else:
@@ -114,13 +163,14 @@ class RedBlackTree:
                     if q == q.parent.left_child:
                         q = q.parent
                         self.right_rotate(q)
-                    q.parent.node_color = "BLACK"
-                    q.parent.parent.node_color = "RED"
+                    q.parent.node_color = BLACK
+                    q.parent.parent.node_color = RED
                     self.left_rotate(q.parent.parent)
                     if q.parent.parent != self.nil_node:
                         self.color_flip_count += 2
                         # Set the color of the root to BLACK to maintain Red-Black Tree properties.
-        self.root.node_color = "BLACK"
+        self.root.node_color = BLACK
+        return q  # The last node fixed; if it is the root, recoloring it added one to the black height.
 
 # Transplant a subtree in the Red-Black Tree
     def transplant(self, u, v):
@@ -132,6 +182,12 @@ class RedBlackTree:
             u.parent.right_child = v
         v.parent = u.parent
 
+    # Decrement the subtree sizes of p and all of its ancestors after a node below them is removed
+    def shrink_path(self, p):
+        while p != self.nil_node:
+            p.size -= 1
+            p = p.parent
+
     # Find the minimum node in a subtree
     def tree_minimum(self, p):
         while p.left_child != self.nil_node:
@@ -144,122 +200,147 @@ class RedBlackTree:
         q = self.search(key)
         # If the node is not found, print a message and return.
         if q == self.nil_node:
-            print(f"Key {key} not found in the tree.")
+            if DEBUG:
+                print(f"Key {key} not found in the tree.")
             return
         # Store the node to be deleted and its original color.
         p = q
         p_original_color = p.node_color
-        print(f"Deleting node with key {key}, original color: {p_original_color}")
+        if DEBUG:
+            print(f"Deleting node with key {key}, original color: {COLOR_NAMES[p_original_color]}")
 # Determine the replacement node 'r' based on the number of children of the node to be deleted.
         if q.left_child == self.nil_node:
             r = q.right_child
+            r_parent = q.parent
+            self.shrink_path(q.parent)
             self.transplant(q, q.right_child)
         elif q.right_child == self.nil_node:
             r = q.left_child
+            r_parent = q.parent
+            self.shrink_path(q.parent)
             self.transplant(q, q.left_child)
         else:  # If the node to be deleted has two children, find its successor 'p'.
             p = self.tree_minimum(q.right_child)
             p_original_color = p.node_color
             r = p.right_child
+            self.shrink_path(p.parent)  # 'p' leaves its old position; 'q' is one of its ancestors.
+            p.size = q.size
             # If 'p' is not the right child of 'q', adjust pointers and replace 'q' with 'p'.
             if p.parent != q:
+                r_parent = p.parent
                 self.transplant(p, p.right_child)
                 p.right_child = q.right_child
                 p.right_child.parent = p
+            else:
+                r_parent = p
             self.transplant(q, p)
             p.left_child = q.left_child
             p.left_child.parent = p
             p.node_color = q.node_color
 # Print information about the replacement node.
-        print(f"Node replaced, r key: {r.key if r != self.nil_node else 'NIL'}, r color: {r.node_color if r != self.nil_node else 'NIL'}, p_original_color: {p_original_color}")
+        if DEBUG:
+            print(f"Node replaced, r key: {r.key if r != self.nil_node else 'NIL'}, r color: {COLOR_NAMES[r.node_color] if r != self.nil_node else 'NIL'}, p_original_color: {COLOR_NAMES[p_original_color]}")
 # If the original color of the replaced node is BLACK, fix any violations in Red-Black Tree properties.
-        if p_original_color == "BLACK":
-            print("Calling delete_fixup")
-            self.delete_fixup(r)
-        else:
+        if p_original_color == BLACK:
+            if DEBUG:
+                print("Calling delete_fixup")
+            self.delete_fixup(r, r_parent)
+        elif DEBUG:
             print("No need for delete_fixup")
-    def delete_fixup(self, p):
+    def delete_fixup(self, p, parent):
 
-    # Fix any violations of Red-Black Tree properties after deletion.
-        while p != self.root and p.node_color == "BLACK":
+    # Fix any violations of Red-Black Tree properties after deletion. 'p' may be the nil node, so its
+    # parent is passed in and then followed up the tree.
+        while p != self.root and p.node_color == BLACK:
+            self.delete_fixup_iterations += 1
+            if p != self.nil_node:
+                parent = p.parent
              # Check if 'p' is the left child of its parent.
-            if p == p.parent.left_child:
-                q = p.parent.right_child
-                if q.node_color == "RED":# Case 1: Sibling 'q' is RED.
-                    print("Delete Fixup: Case 1 (Left) - Sibling RED")
-                    q.node_color = "BLACK"   # Flip colors to balance the tree.
+            if p == parent.left_child:
+                q = parent.right_child
+                if q.node_color == RED:# Case 1: Sibling 'q' is RED.
+                    if DEBUG:
+                        print("Delete Fixup: Case 1 (Left) - Sibling RED")
+                    q.node_color = BLACK   # Flip colors to balance the tree.
                     self.color_flip_count += 1
-                    p.parent.node_color = "RED"
+                    parent.node_color = RED
                     self.color_flip_count += 1
-                    self.left_rotate(p.parent)  # Rotate left to maintain the Red-Black Tree properties.
-                    q = p.parent.right_child
+                    self.left_rotate(parent)  # Rotate left to maintain the Red-Black Tree properties.
+                    q = parent.right_child
 # Case 2: Both children of 'q' are BLACK.
-                if q.left_child.node_color == "BLACK" and q.right_child.node_color == "BLACK":
-                    print("Delete Fixup: Case 2 (Left) - Both Children BLACK")
-                    q.node_color = "RED" # Flip colors and move up the tree.
+                if q.left_child.node_color == BLACK and q.right_child.node_color == BLACK:
+                    if DEBUG:
+                        print("Delete Fixup: Case 2 (Left) - Both Children BLACK")
+                    q.node_color = RED # Flip colors and move up the tree.
                     self.color_flip_count += 1
-                    p = p.parent
+                    p = parent
                 else:
 # Case 3: Right child of 'q' is BLACK.
-                    if q.right_child.node_color == "BLACK":
-                        print("Delete Fixup: Case 3 (Left) - Right Child BLACK")
-                        q.left_child.node_color = "BLACK" # Adjust colors and perform a right rotation.
+                    if q.right_child.node_color == BLACK:
+                        if DEBUG:
+                            print("Delete Fixup: Case 3 (Left) - Right Child BLACK")
+                        q.left_child.node_color = BLACK # Adjust colors and perform a right rotation.
                         self.color_flip_count += 1
-                        q.node_color = "RED"
+                        q.node_color = RED
                         self.color_flip_count += 1
                         self.right_rotate(q)
-                        q = p.parent.right_child
+                        q = parent.right_child
 # Case 4: Right child of 'q' is RED.
-                    print("Delete Fixup: Case 4 (Left) - Right Child RED")
-                    q.node_color = p.parent.node_color   # Transfer colors from 'p' to 'q' and perform left rotation.
-                    if q.node_color != "BLACK":
+                    if DEBUG:
+                        print("Delete Fixup: Case 4 (Left) - Right Child RED")
+                    q.node_color = parent.node_color   # Transfer colors from 'p' to 'q' and perform left rotation.
+                    if q.node_color != BLACK:
                         self.color_flip_count += 1
-                    p.parent.node_color = "BLACK"
+                    parent.node_color = BLACK
                     self.color_flip_count += 1
-                    q.right_child.node_color = "BLACK"
+                    q.right_child.node_color = BLACK
                     self.color_flip_count += 1
-                    self.left_rotate(p.parent)
+                    self.left_rotate(parent)
                     p = self.root
             else: # Similar cases for the right child of 'p'.
-                q = p.parent.left_child
+                q = parent.left_child
  # Case 1: Sibling 'q' is RED.
-                if q.node_color == "RED":
-                    print("Delete Fixup: Case 1 (Right) - Sibling RED")
-                    q.node_color = "BLACK"
+                if q.node_color == RED:
+                    if DEBUG:
+                        print("Delete Fixup: Case 1 (Right) - Sibling RED")
+                    q.node_color = BLACK
                     self.color_flip_count += 1
-                    p.parent.node_color = "RED"
+                    parent.node_color = RED
                     self.color_flip_count += 1
-                    self.right_rotate(p.parent)  # Rotate right to maintain the Red-Black Tree properties.
-                    q = p.parent.left_child
+                    self.right_rotate(parent)  # Rotate right to maintain the Red-Black Tree properties.
+                    q = parent.left_child
 # Case 2: Both children of 'q' are BLACK.
-                if q.right_child.node_color == "BLACK" and q.left_child.node_color == "BLACK":
-                    print("Delete Fixup: Case 2 (Right) - Both Children BLACK")
-                    q.node_color = "RED"
+                if q.right_child.node_color == BLACK and q.left_child.node_color == BLACK:
+                    if DEBUG:
+                        print("Delete Fixup: Case 2 (Right) - Both Children BLACK")
+                    q.node_color = RED
                     self.color_flip_count += 1
-                    p = p.parent
+                    p = parent
                 else:
  # Case 3: Left child of 'q' is BLACK.
-                    if q.left_child.node_color == "BLACK":
-                        print("Delete Fixup: Case 3 (Right) - Left Child BLACK")
-                        q.right_child.node_color = "BLACK" # Adjust colors and perform a left rotation.
+                    if q.left_child.node_color == BLACK:
+                        if DEBUG:
+                            print("Delete Fixup: Case 3 (Right) - Left Child BLACK")
+                        q.right_child.node_color = BLACK # Adjust colors and perform a left rotation.
                         self.color_flip_count += 1
-                        q.node_color = "RED"
+                        q.node_color = RED
                         self.color_flip_count += 1
                         self.left_rotate(q)
-                        q = p.parent.left_child
+                        q = parent.left_child
 # Case 4: Left child of 'q' is RED.
-                    print("Delete Fixup: Case 4 (Right) - Left Child RED")
-                    q.node_color = p.parent.node_color # Transfer colors from 'p' to 'q' and perform right rotation.
-                    if q.node_color != "BLACK":
+                    if DEBUG:
+                        print("Delete Fixup: Case 4 (Right) - Left Child RED")
+                    q.node_color = parent.node_color # Transfer colors from 'p' to 'q' and perform right rotation.
+                    if q.node_color != BLACK:
                      self.color_flip_count += 1
-                    p.parent.node_color = "BLACK"
+                    parent.node_color = BLACK
                     self.color_flip_count += 1
-                    q.left_child.node_color = "BLACK"
+                    q.left_child.node_color = BLACK
                     self.color_flip_count += 1
-                    self.right_rotate(p.parent)
+                    self.right_rotate(parent)
                     p = self.root
 # Set the color of the final node 'p' to BLACK.
-        p.node_color = "BLACK"
+        p.node_color = BLACK
 
     # Search for a node with the given key in the Red-Black Tree
     def search(self, key):
@@ -271,370 +352,2841 @@ class RedBlackTree:
                 q = q.right_child
         return q
 
+    # Iterate over (key, value) pairs in key order without recursion
+    def iter_items(self):
+        stack = []
+        q = self.root
+        while stack or q != self.nil_node:
+            while q != self.nil_node:
+                stack.append(q)
+                q = q.left_child
+            q = stack.pop()
+            yield q.key, q.value
+            q = q.right_child
+
+    # Replace the contents of the tree with (key, value) pairs that are sorted by key and unique.
+    # The tree is built bottom-up in O(n): every level is BLACK except the deepest one, which is RED
+    # whenever it sits below the root, so all root-to-leaf paths keep the same black height.
+    # No colors are flipped along the way, so color_flip_count is left unchanged.
+    def build_from_sorted(self, items):
+        nil_node = self.nil_node
+        red_depth = len(items).bit_length() - 1
+
+        def build(lo, hi, depth, parent):
+            if lo >= hi:
+                return nil_node
+            mid = (lo + hi) // 2
+            key, value = items[mid]
+            node = RedBlackNode(key, value)
+            node.parent = parent
+            node.size = hi - lo
+            if depth != red_depth or depth == 0:
+                node.node_color = BLACK
+            node.left_child = build(lo, mid, depth + 1, node)
+            node.right_child = build(mid + 1, hi, depth + 1, node)
+            return node
+
+        self.root = build(0, len(items), 0, nil_node)
+
+    # Iterate lazily over the (key, value) pairs with lo <= key <= hi in key order. An explicit stack
+    # replaces recursion, and subtrees entirely below lo are never visited.
+    def iter_range(self, lo, hi):
+        nil_node = self.nil_node
+        stack = []
+        q = self.root
+        while True:
+            while q is not nil_node:
+                if q.key < lo:
+                    q = q.right_child
+                else:
+                    stack.append(q)
+                    q = q.left_child
+            if not stack:
+                return
+            q = stack.pop()
+            if q.key > hi:
+                return
+            yield q.key, q.value
+            q = q.right_child
+
+    # Iterate over (node, depth) pairs in key order; together with the node colors this is enough
+    # for build_from_layout to reproduce the exact shape of the tree
+    def iter_layout(self):
+        stack = []
+        q = self.root
+        depth = 0
+        while stack or q != self.nil_node:
+            while q != self.nil_node:
+                stack.append((q, depth))
+                q = q.left_child
+                depth += 1
+            q, depth = stack.pop()
+            yield q, depth
+            q = q.right_child
+            depth += 1
+
+    # Rebuild a tree recorded by iter_layout from (key, value, depth, color) entries in key order.
+    # Each node's parent is the nearest shallower node on the stack, so the build is O(n).
+    def build_from_layout(self, entries):
+        nil_node = self.nil_node
+        stack = []
+        root = nil_node
+        for key, value, depth, color in entries:
+            node = RedBlackNode(key, value)
+            node.node_color = color
+            node.right_child = nil_node
+            last = nil_node
+            while stack and stack[-1][1] > depth:
+                last = stack.pop()[0]
+            node.left_child = last
+            if last != nil_node:
+                last.parent = node
+            if stack:
+                stack[-1][0].right_child = node
+                node.parent = stack[-1][0]
+            else:
+                node.parent = nil_node
+                root = node
+            stack.append((node, depth))
+        self.root = root
+        # Subtree sizes are only known once the shape is complete; fill them in with a post-order walk.
+        for node in self.iter_postorder():
+            node.size = node.left_child.size + node.right_child.size + 1
+
+    # Iterate over the nodes in post-order (children before their parent) without recursion
+    def iter_postorder(self):
+        stack = [self.root] if self.root != self.nil_node else []
+        order = []
+        while stack:
+            q = stack.pop()
+            order.append(q)
+            if q.left_child != self.nil_node:
+                stack.append(q.left_child)
+            if q.right_child != self.nil_node:
+                stack.append(q.right_child)
+        return reversed(order)
+
+    # Number of keys less than key (or less than or equal to it, with inclusive), in O(log n)
+    def count_less(self, key, inclusive=False):
+        count = 0
+        q = self.root
+        while q != self.nil_node:
+            if q.key < key or (inclusive and q.key == key):
+                count += q.left_child.size + 1
+                q = q.right_child
+            else:
+                q = q.left_child
+        return count
+
+    # Return the node holding the k-th smallest key (1-based), or the nil node if k is out of range
+    def select(self, k):
+        q = self.root
+        while q != self.nil_node:
+            left_size = q.left_child.size
+            if k <= left_size:
+                q = q.left_child
+            elif k == left_size + 1:
+                return q
+            else:
+                k -= left_size + 1
+                q = q.right_child
+        return q
+
+    def __len__(self):
+        return self.root.size
+
+    # Return the value stored under key, or None
+    def get(self, key):
+        q = self.search(key)
+        return q.value if q != self.nil_node else None
+
+    # Return (key, value) of the k-th smallest key (1-based), or None if k is out of range
+    def select_item(self, k):
+        q = self.select(k)
+        return (q.key, q.value) if q != self.nil_node else None
+
+    # Return (key, value) of the largest key < key (<= key with inclusive), or None
+    def predecessor(self, key, inclusive=False):
+        found = None
+        q = self.root
+        while q != self.nil_node:
+            if q.key < key or (inclusive and q.key == key):
+                found = q
+                q = q.right_child
+            else:
+                q = q.left_child
+        return (found.key, found.value) if found is not None else None
+
+    # Return (key, value) of the smallest key >= key (> key without inclusive), or None
+    def successor(self, key, inclusive=True):
+        found = None
+        q = self.root
+        while q != self.nil_node:
+            if q.key > key or (inclusive and q.key == key):
+                found = q
+                q = q.left_child
+            else:
+                q = q.right_child
+        return (found.key, found.value) if found is not None else None
+
+    # Shape and rebalancing counters for Stats
+    def index_stats(self):
+        return {"books": len(self), "height": self.height(), "black_height": self.black_height(self.root),
+                "color_flips": self.color_flip_count, "left_rotations": self.left_rotations,
+                "right_rotations": self.right_rotations, "insert_fixup_iterations": self.insert_fixup_iterations,
+                "delete_fixup_iterations": self.delete_fixup_iterations}
+
+    # Number of BLACK nodes on any path from q down to a leaf, not counting the nil node
+    def black_height(self, q):
+        height = 0
+        while q != self.nil_node:
+            if q.node_color == BLACK:
+                height += 1
+            q = q.left_child
+        return height
+
+    # Number of nodes on the longest root-to-leaf path, in O(n)
+    def height(self):
+        return max((depth + 1 for _, depth in self.iter_layout()), default=0)
+
+    # Run insert_fixup on a node of the detached subtree rooted at root and return the subtree's new
+    # root and whether its black height grew by one. The tree's own root is swapped out meanwhile, so
+    # rotations that reach the top land there.
+    def fixup_subtree(self, root, q):
+        saved_root = self.root
+        self.root = root
+        last = self.insert_fixup(q)
+        root = self.root
+        self.root = saved_root
+        return root, last is root
+
+    # Join the detached subtrees rooted at left and right, of black heights left_height and right_height
+    # (see black_height), with the single node middle between them (every key in left < middle.key <
+    # every key in right) and return the root of the result and its black height. middle is hung RED
+    # from the spine of the taller side at the first BLACK node whose black height matches the shorter
+    # side, and insert_fixup repairs any red-red pair above it, so the cost is proportional to the
+    # difference in black heights plus one.
+    def join_nodes(self, left, left_height, middle, right, right_height):
+        nil_node = self.nil_node
+        # A RED root can always be recolored, adding one to its black height; the nil node is BLACK.
+        if left.node_color == RED:
+            left.node_color = BLACK
+            left_height += 1
+        if right.node_color == RED:
+            right.node_color = BLACK
+            right_height += 1
+        middle.node_color = RED
+        parent = nil_node
+        if left_height >= right_height:
+            q, height = left, left_height
+            while q.node_color == RED or height > right_height:
+                if q.node_color == BLACK:
+                    height -= 1
+                parent = q
+                q = q.right_child
+            middle.left_child, middle.right_child = q, right
+            hung, root = right, left
+            if parent != nil_node:
+                parent.right_child = middle
+        else:
+            q, height = right, right_height
+            while q.node_color == RED or height > left_height:
+                if q.node_color == BLACK:
+                    height -= 1
+                parent = q
+                q = q.left_child
+            middle.left_child, middle.right_child = left, q
+            hung, root = left, right
+            if parent != nil_node:
+                parent.left_child = middle
+        middle.parent = parent
+        for child in (q, hung):
+            if child != nil_node:
+                child.parent = middle
+        middle.size = q.size + hung.size + 1
+        p = parent
+        while p != nil_node:
+            p.size += hung.size + 1
+            p = p.parent
+        root, grew = self.fixup_subtree(root if parent != nil_node else middle, middle)
+        return root, max(left_height, right_height) + grew
+
+    # Split the detached subtree rooted at q, of black height height, into (root, black height) pairs
+    # for (keys < key, keys >= key); with inclusive key itself goes to the first part. Each level on the
+    # search path joins the node with the side it keeps. The black heights travel with the subtrees, so
+    # no spine is ever walked to find them, and the join costs along the path telescope to O(log n).
+    def split_nodes(self, q, height, key, inclusive=False):
+        nil_node = self.nil_node
+        if q == nil_node:
+            return (nil_node, 0), (nil_node, 0)
+        child_height = height - (q.node_color == BLACK)
+        left, right = q.left_child, q.right_child
+        for child in (left, right):
+            if child != nil_node:
+                child.parent = nil_node
+        q.left_child = q.right_child = q.parent = nil_node
+        if q.key < key or (inclusive and q.key == key):
+            lower, upper = self.split_nodes(right, child_height, key, inclusive)
+            return self.join_nodes(left, child_height, q, *lower), upper
+        lower, upper = self.split_nodes(left, child_height, key, inclusive)
+        return lower, self.join_nodes(*upper, q, right, child_height)
+
+    # Move every key >= key (> key with inclusive) into a new tree and return it; this tree keeps the
+    # smaller keys. Colors flipped by the rebalancing are counted in this tree's color_flip_count.
+    def split(self, key, inclusive=False):
+        root = self.root
+        self.root = self.nil_node
+        (lower, _), (upper, _) = self.split_nodes(root, self.black_height(root), key, inclusive)
+        self.root = lower
+        other = RedBlackTree()
+        other.root = upper
+        return other
+
+    # Append every node of other, whose keys must all be greater than this tree's, leaving other empty.
+    # The smallest node of other is deleted from it and becomes the middle of join_nodes.
+    def join(self, other):
+        nil_node = self.nil_node
+        if other.root == nil_node:
+            return
+        if self.root != nil_node:
+            last = self.root
+            while last.right_child != nil_node:
+                last = last.right_child
+            middle = self.tree_minimum(other.root)
+            if not last.key < middle.key:
+                raise ValueError(f"Cannot join keys from {middle.key} after key {last.key}")
+            saved_root = self.root
+            self.root = other.root
+            self.delete(middle.key)
+            right = self.root
+            middle.left_child = middle.right_child = middle.parent = nil_node
+            self.root, _ = self.join_nodes(saved_root, self.black_height(saved_root), middle,
+                                           right, self.black_height(right))
+        else:
+            self.root = other.root
+        other.root = nil_node
+
     def preorder_walk(self, q, indent="", last=True):
         # Perform a preorder traversal of the tree, printing each node.
         if q != self.nil_node:
-            print(f"{indent}{'|-- ' if last else '|-- '}Key: {q.key}, Color: {q.node_color}, Value: {q.value}")
+            print(f"{indent}{'|-- ' if last else '|-- '}Key: {q.key}, Color: {COLOR_NAMES[q.node_color]}, Value: {q.value}")
             indent += "   " if last else "|  "
             self.preorder_walk(q.left_child, indent, False)
             self.preorder_walk(q.right_child, indent, True)
 
- # Define a class for managing book reservation queues   
-class BookReservationQueue:
- # Methods for swapping items, heapifying up, heapifying down, and comparing items
+# Define a persistent (path-copying) variant of RedBlackTree. Nodes are never changed once they are
+# reachable from a root: every mutation copies the O(log n) nodes on its path and installs a new root,
+# sharing everything else with the previous version. version() therefore hands out an immutable copy of
+# the whole tree in O(1), which readers can walk without any lock while writers keep going. Nodes have no
+# parent pointers (parent stays None), so an old version is garbage once nothing refers to its root.
+# All the read-only methods of RedBlackTree only follow child pointers and work unchanged.
+# Inserts use Okasaki's balance; delete, split and join are built from join(left, key, right), with
+# black heights passed down the path instead of recomputed. Rotations and color flips are not counted,
+# so color_flip_count is None.
+class PersistentRedBlackTree(RedBlackTree):
+    name = "persistent"
+
     def __init__(self):
-        self.heap = []  # Initialize an empty list to represent the heap.
- # Swap the items at indices i and j in the heap.
-    def swap_items(self, i, j):
-        self.heap[i], self.heap[j] = self.heap[j], self.heap[i]
-# Restore the heap property by moving the item at the given index up the heap.
-    def heapify_up(self, index):
-        while index > 0: 
-            # Calculate the index of the parent node.
-            parent_index = (index - 1) // 2
-            # Compare the current item with its parent and swap if necessary.
-            if self.compare_items(self.heap[index], self.heap[parent_index]) < 0:
-                self.swap_items(index, parent_index)
-                index = parent_index
-            else:
-                break
- # Restore the heap property by moving the item at the given index down the heap.
-    def heapify_down(self, index):
-        # Calculate the indices of the left and right children.
-        left_child_index = 2 * index + 1
-        right_child_index = 2 * index + 2
-        smallest = index
-# Compare the current item with its left child, if exists.
-        if left_child_index < len(self.heap) and self.compare_items(self.heap[left_child_index], self.heap[smallest]) < 0:
-            smallest = left_child_index
-# Compare the current item with its right child, if exists.
-        if right_child_index < len(self.heap) and self.compare_items(self.heap[right_child_index], self.heap[smallest]) < 0:
-            smallest = right_child_index
-# Swap with the smallest child if necessary and continue heapifying down.
-        if smallest != index:
-            self.swap_items(index, smallest)
-            self.heapify_down(smallest)
- # Compare two items based on their priority values.
-    def compare_items(self, item1, item2):
-        if item1[1] < item2[1]:
-            return -1
-        elif item1[1] > item2[1]:
-            return 1
+        super().__init__()
+        self.color_flip_count = None
+
+    def index_stats(self):
+        return {"books": len(self), "height": self.height(), "black_height": self.black_height(self.root)}
+
+    # Return a new immutable version sharing this tree's current root
+    def version(self):
+        other = PersistentRedBlackTree()
+        other.root = self.root
+        return other
+
+    def make_node(self, color, left, key, value, right):
+        node = RedBlackNode(key, value)
+        node.node_color = color
+        node.left_child = left
+        node.right_child = right
+        node.size = left.size + right.size + 1
+        return node
+
+    # Return q itself if it is BLACK, otherwise a BLACK copy of it
+    def blacken(self, q):
+        if q.node_color == BLACK:
+            return q
+        return self.make_node(BLACK, q.left_child, q.key, q.value, q.right_child)
+
+    # Rebuild a node from its parts, fixing a red-red pair just below a BLACK node by rotation
+    def balance(self, color, left, key, value, right):
+        make = self.make_node
+        if color == BLACK:
+            if left.node_color == RED:
+                if left.left_child.node_color == RED:
+                    a = left.left_child
+                    return make(RED, self.blacken(a), left.key, left.value,
+                                make(BLACK, left.right_child, key, value, right))
+                if left.right_child.node_color == RED:
+                    b = left.right_child
+                    return make(RED, make(BLACK, left.left_child, left.key, left.value, b.left_child), b.key, b.value,
+                                make(BLACK, b.right_child, key, value, right))
+            if right.node_color == RED:
+                if right.left_child.node_color == RED:
+                    c = right.left_child
+                    return make(RED, make(BLACK, left, key, value, c.left_child), c.key, c.value,
+                                make(BLACK, c.right_child, right.key, right.value, right.right_child))
+                if right.right_child.node_color == RED:
+                    d = right.right_child
+                    return make(RED, make(BLACK, left, key, value, right.left_child), right.key, right.value,
+                                self.blacken(d))
+        return make(color, left, key, value, right)
+
+    def insert_node(self, q, key, value):
+        if q == self.nil_node:
+            return self.make_node(RED, self.nil_node, key, value, self.nil_node)
+        if key < q.key:
+            return self.balance(q.node_color, self.insert_node(q.left_child, key, value), q.key, q.value, q.right_child)
+        return self.balance(q.node_color, q.left_child, q.key, q.value, self.insert_node(q.right_child, key, value))
+
+    # Insert a new node with key and value, producing a new root version
+    def insert(self, key, value):
+        self.root = self.blacken(self.insert_node(self.root, key, value))
+
+    # Hang key between left and right (left_height >= right_height, right BLACK) on the right spine of
+    # left, at the first BLACK node as high as right, copying the spine down to it
+    def join_right(self, left, left_height, key, value, right, right_height):
+        if left.node_color == BLACK and left_height == right_height:
+            return self.make_node(RED, left, key, value, right)
+        child_height = left_height - 1 if left.node_color == BLACK else left_height
+        child = self.join_right(left.right_child, child_height, key, value, right, right_height)
+        if left.node_color == BLACK and child.node_color == RED and child.right_child.node_color == RED:
+            # Rotate left, so the red-red pair becomes two BLACK children of a RED node.
+            return self.make_node(RED, self.make_node(BLACK, left.left_child, left.key, left.value, child.left_child),
+                                  child.key, child.value, self.blacken(child.right_child))
+        return self.make_node(left.node_color, left.left_child, left.key, left.value, child)
+
+    # Mirror image of join_right
+    def join_left(self, left, left_height, key, value, right, right_height):
+        if right.node_color == BLACK and right_height == left_height:
+            return self.make_node(RED, left, key, value, right)
+        child_height = right_height - 1 if right.node_color == BLACK else right_height
+        child = self.join_left(left, left_height, key, value, right.left_child, child_height)
+        if right.node_color == BLACK and child.node_color == RED and child.left_child.node_color == RED:
+            return self.make_node(RED, self.blacken(child.left_child), child.key, child.value,
+                                  self.make_node(BLACK, child.right_child, right.key, right.value, right.right_child))
+        return self.make_node(right.node_color, child, right.key, right.value, right.right_child)
+
+    # Return (root, black height) of the tree holding left, key and right, where every key in left is
+    # smaller than key and every key in right is larger. The cost is proportional to the difference in
+    # black heights, and only the nodes on one spine are copied.
+    def join_trees(self, left, left_height, key, value, right, right_height):
+        if left.node_color == RED:
+            left, left_height = self.blacken(left), left_height + 1
+        if right.node_color == RED:
+            right, right_height = self.blacken(right), right_height + 1
+        if left_height > right_height:
+            root = self.join_right(left, left_height, key, value, right, right_height)
+            if root.node_color == RED and root.right_child.node_color == RED:
+                return self.blacken(root), left_height + 1
+            return root, left_height
+        if right_height > left_height:
+            root = self.join_left(left, left_height, key, value, right, right_height)
+            if root.node_color == RED and root.left_child.node_color == RED:
+                return self.blacken(root), right_height + 1
+            return root, right_height
+        return self.make_node(RED, left, key, value, right), left_height
+
+    # Return (root, black height) of q with its children replaced by left and right. While both still
+    # have q's child black height and no red-red pair appears, copying q is enough; otherwise they are
+    # joined again.
+    def rebuild(self, q, height, child_height, left, left_height, right, right_height):
+        if left_height == child_height == right_height and (
+                q.node_color == BLACK or (left.node_color == BLACK and right.node_color == BLACK)):
+            return self.make_node(q.node_color, left, q.key, q.value, right), height
+        return self.join_trees(left, left_height, q.key, q.value, right, right_height)
+
+    # Remove the largest node of q and return (rest, its black height, key, value)
+    def split_last(self, q, height):
+        child_height = height - 1 if q.node_color == BLACK else height
+        if q.right_child == self.nil_node:
+            return q.left_child, child_height, q.key, q.value
+        rest, rest_height, key, value = self.split_last(q.right_child, child_height)
+        root, height = self.rebuild(q, height, child_height, q.left_child, child_height, rest, rest_height)
+        return root, height, key, value
+
+    # Join two trees without a middle key, every key in left smaller than every key in right
+    def join_pair(self, left, left_height, right, right_height):
+        if left == self.nil_node:
+            return right, right_height
+        left, left_height, key, value = self.split_last(left, left_height)
+        return self.join_trees(left, left_height, key, value, right, right_height)
+
+    # Return (root, black height, found) of q without key; q is returned as-is when key is absent
+    def delete_node(self, q, height, key):
+        if q == self.nil_node:
+            return q, height, False
+        child_height = height - 1 if q.node_color == BLACK else height
+        if key < q.key:
+            left, left_height, found = self.delete_node(q.left_child, child_height, key)
+            if not found:
+                return q, height, False
+            return self.rebuild(q, height, child_height, left, left_height, q.right_child, child_height) + (True,)
+        if key > q.key:
+            right, right_height, found = self.delete_node(q.right_child, child_height, key)
+            if not found:
+                return q, height, False
+            return self.rebuild(q, height, child_height, q.left_child, child_height, right, right_height) + (True,)
+        return self.join_pair(q.left_child, child_height, q.right_child, child_height) + (True,)
+
+    # Delete the node with key, producing a new root version
+    def delete(self, key):
+        root, height, found = self.delete_node(self.root, self.black_height(self.root), key)
+        if not found:
+            if DEBUG:
+                print("Node not found in the tree.")
+            return
+        self.root = self.blacken(root)
+
+    # Split q into (lower, its black height, upper, its black height) around key, as split_nodes does
+    def split_persistent(self, q, height, key, inclusive):
+        if q == self.nil_node:
+            return q, 0, q, 0
+        child_height = height - 1 if q.node_color == BLACK else height
+        if q.key < key or (inclusive and q.key == key):
+            lower, lower_height, upper, upper_height = self.split_persistent(q.right_child, child_height, key, inclusive)
+            lower, lower_height = self.join_trees(q.left_child, child_height, q.key, q.value, lower, lower_height)
+            return lower, lower_height, upper, upper_height
+        lower, lower_height, upper, upper_height = self.split_persistent(q.left_child, child_height, key, inclusive)
+        upper, upper_height = self.join_trees(upper, upper_height, q.key, q.value, q.right_child, child_height)
+        return lower, lower_height, upper, upper_height
+
+    # Same contract as RedBlackTree.split; the returned tree is persistent too
+    def split(self, key, inclusive=False):
+        lower, _, upper, _ = self.split_persistent(self.root, self.black_height(self.root), key, inclusive)
+        self.root = self.blacken(lower)
+        other = PersistentRedBlackTree()
+        other.root = self.blacken(upper)
+        return other
+
+    # Same contract as RedBlackTree.join. other must be persistent as well, since its nodes are shared.
+    def join(self, other):
+        nil_node = self.nil_node
+        if other.root == nil_node:
+            return
+        if self.root != nil_node:
+            last = self.root
+            while last.right_child != nil_node:
+                last = last.right_child
+            first = self.tree_minimum(other.root)
+            if not last.key < first.key:
+                raise ValueError(f"Cannot join keys from {first.key} after key {last.key}")
+            root, _ = self.join_pair(self.root, self.black_height(self.root), other.root, self.black_height(other.root))
+            self.root = self.blacken(root)
         else:
-             # If priority values are equal, compare based on secondary values.
-            if item1[2] < item2[2]:
-                return -1
-            elif item1[2] > item2[2]:
-                return 1
+            self.root = other.root
+        other.root = nil_node
+
+    # The bulk builds link parents while building; clear them so old versions are never kept alive
+    def clear_parents(self):
+        for node in self.iter_postorder():
+            node.parent = None
+
+    def build_from_sorted(self, items):
+        super().build_from_sorted(items)
+        self.clear_parents()
+
+    def build_from_layout(self, entries):
+        super().build_from_layout(entries)
+        self.clear_parents()
+
+# Define a blocked sorted array: the keys are kept in a list of sorted Python lists ("blocks") of about
+# block_size keys, with the values in parallel lists and the last key of every block in maxes. A lookup
+# is two bisects, a range scan slices whole blocks, and an insert or delete shifts the entries of one
+# block, so the work happens in C instead of following one Python object per key. A block is split once
+# it holds more than 2 * block_size keys and merged into a neighbour below block_size / 2. count_less and
+# select_item find block offsets in a Fenwick tree over the block lengths, which is rebuilt only after a
+# block was split or merged. There are no colors, so color_flip_count is None.
+class BlockedSortedArray:
+    name = "blocked"
+
+    def __init__(self, block_size=512):
+        self.block_size = block_size
+        self.keys = []
+        self.values = []
+        self.maxes = []
+        self.count = 0
+        self.color_flip_count = None
+        self.fenwick = None  # Prefix sums of the block lengths; None until needed after a split or merge.
+
+    def __len__(self):
+        return self.count
+
+    def positions(self):
+        if self.fenwick is None:
+            fenwick = [0]
+            fenwick.extend(map(len, self.keys))
+            for i in range(1, len(fenwick)):
+                parent = i + (i & -i)
+                if parent < len(fenwick):
+                    fenwick[parent] += fenwick[i]
+            self.fenwick = fenwick
+        return self.fenwick
+
+    # Record that block i gained (or lost, with a negative delta) keys without being split or merged
+    def resize_block(self, i, delta):
+        fenwick = self.fenwick
+        if fenwick is not None:
+            i += 1
+            while i < len(fenwick):
+                fenwick[i] += delta
+                i += i & -i
+
+    def split_block(self, i):
+        keys, values = self.keys[i], self.values[i]
+        half = len(keys) // 2
+        self.keys.insert(i + 1, keys[half:])
+        self.values.insert(i + 1, values[half:])
+        del keys[half:]
+        del values[half:]
+        self.maxes[i] = keys[-1]
+        self.maxes.insert(i + 1, self.keys[i + 1][-1])
+        self.fenwick = None
+
+    # Merge the undersized block i into a neighbour, splitting the result again if it is too large
+    def merge_block(self, i):
+        i = i if i + 1 < len(self.keys) else i - 1
+        self.keys[i].extend(self.keys[i + 1])
+        self.values[i].extend(self.values[i + 1])
+        del self.keys[i + 1], self.values[i + 1], self.maxes[i + 1]
+        self.maxes[i] = self.keys[i][-1]
+        self.fenwick = None
+        if len(self.keys[i]) > 2 * self.block_size:
+            self.split_block(i)
+
+    def insert(self, key, value):
+        maxes = self.maxes
+        self.count += 1
+        if not maxes:
+            self.keys.append([key])
+            self.values.append([value])
+            maxes.append(key)
+            self.fenwick = None
+            return
+        i = bisect.bisect_left(maxes, key)
+        if i == len(maxes):
+            i -= 1
+            maxes[i] = key
+        keys = self.keys[i]
+        j = bisect.bisect_right(keys, key)
+        keys.insert(j, key)
+        self.values[i].insert(j, value)
+        if len(keys) > 2 * self.block_size:
+            self.split_block(i)
+        else:
+            self.resize_block(i, 1)
+
+    def delete(self, key):
+        maxes = self.maxes
+        i = bisect.bisect_left(maxes, key)
+        if i == len(maxes):
+            return
+        keys = self.keys[i]
+        j = bisect.bisect_left(keys, key)
+        if keys[j] != key:
+            return
+        del keys[j]
+        del self.values[i][j]
+        self.count -= 1
+        if not keys:
+            del self.keys[i], self.values[i], maxes[i]
+            self.fenwick = None
+            return
+        maxes[i] = keys[-1]
+        if len(keys) < self.block_size // 2 and len(self.keys) > 1:
+            self.merge_block(i)
+        else:
+            self.resize_block(i, -1)
+
+    def get(self, key):
+        i = bisect.bisect_left(self.maxes, key)
+        if i < len(self.maxes):
+            keys = self.keys[i]
+            j = bisect.bisect_left(keys, key)
+            if keys[j] == key:
+                return self.values[i][j]
+        return None
+
+    def iter_items(self):
+        for keys, values in zip(self.keys, self.values):
+            yield from zip(keys, values)
+
+    def iter_range(self, lo, hi):
+        i = bisect.bisect_left(self.maxes, lo)
+        if i == len(self.maxes):
+            return
+        j = bisect.bisect_left(self.keys[i], lo)
+        while i < len(self.keys):
+            keys = self.keys[i]
+            end = len(keys) if keys[-1] <= hi else bisect.bisect_right(keys, hi)
+            yield from zip(keys[j:end], self.values[i][j:end])
+            if end < len(keys):
+                return
+            i += 1
+            j = 0
+
+    def predecessor(self, key, inclusive=False):
+        i = bisect.bisect_left(self.maxes, key)
+        if i < len(self.maxes):
+            keys = self.keys[i]
+            j = bisect.bisect_right(keys, key) if inclusive else bisect.bisect_left(keys, key)
+            if j:
+                return keys[j - 1], self.values[i][j - 1]
+        if i:
+            return self.keys[i - 1][-1], self.values[i - 1][-1]
+        return None
+
+    def successor(self, key, inclusive=True):
+        i = bisect.bisect_left(self.maxes, key) if inclusive else bisect.bisect_right(self.maxes, key)
+        if i == len(self.maxes):
+            return None
+        keys = self.keys[i]
+        j = bisect.bisect_left(keys, key) if inclusive else bisect.bisect_right(keys, key)
+        return keys[j], self.values[i][j]
+
+    def count_less(self, key, inclusive=False):
+        i = bisect.bisect_left(self.maxes, key)
+        if i == len(self.maxes):
+            return self.count
+        keys = self.keys[i]
+        count = bisect.bisect_right(keys, key) if inclusive else bisect.bisect_left(keys, key)
+        fenwick = self.positions()
+        while i:
+            count += fenwick[i]
+            i -= i & -i
+        return count
+
+    def select_item(self, k):
+        if not 1 <= k <= self.count:
+            return None
+        fenwick = self.positions()
+        k -= 1
+        i = 0
+        step = 1 << (len(fenwick) - 1).bit_length()
+        while step:
+            if i + step < len(fenwick) and fenwick[i + step] <= k:
+                i += step
+                k -= fenwick[i]
+            step >>= 1
+        return self.keys[i][k], self.values[i][k]
+
+    def build_from_sorted(self, items):
+        size = self.block_size
+        keys = [key for key, value in items]
+        values = [value for key, value in items]
+        self.keys = [keys[i:i + size] for i in range(0, len(keys), size)]
+        self.values = [values[i:i + size] for i in range(0, len(values), size)]
+        self.maxes = [block[-1] for block in self.keys]
+        self.count = len(keys)
+        self.fenwick = None
+
+    # Same contract as RedBlackTree.split. Only the block holding key is cut, so the two blocks at the
+    # cut may be smaller than usual until their next insert or delete.
+    def split(self, key, inclusive=False):
+        other = BlockedSortedArray(self.block_size)
+        i = bisect.bisect_right(self.maxes, key) if inclusive else bisect.bisect_left(self.maxes, key)
+        if i < len(self.maxes):
+            keys, values = self.keys[i], self.values[i]
+            j = bisect.bisect_right(keys, key) if inclusive else bisect.bisect_left(keys, key)
+            other.keys = [keys[j:]] + self.keys[i + 1:]
+            other.values = [values[j:]] + self.values[i + 1:]
+            other.maxes = self.maxes[i:]
+            other.count = sum(map(len, other.keys))
+            del keys[j:], values[j:], self.keys[i + 1:], self.values[i + 1:], self.maxes[i:]
+            if keys:
+                self.maxes.append(keys[-1])
             else:
-                return 0
+                del self.keys[i], self.values[i]
+            self.count -= other.count
+            self.fenwick = None
+        return other
+
+    # Same contract as RedBlackTree.join; other must be a BlockedSortedArray as well
+    def join(self, other):
+        if not other.count:
+            return
+        if self.count and not self.maxes[-1] < other.keys[0][0]:
+            raise ValueError(f"Cannot join keys from {other.keys[0][0]} after key {self.maxes[-1]}")
+        self.keys.extend(other.keys)
+        self.values.extend(other.values)
+        self.maxes.extend(other.maxes)
+        self.count += other.count
+        self.fenwick = None
+        other.keys, other.values, other.maxes, other.count, other.fenwick = [], [], [], 0, None
+
+    # Snapshots record a red-black layout; give the one build_from_sorted would make for these keys
+    def iter_layout(self):
+        tree = RedBlackTree()
+        tree.build_from_sorted(list(self.iter_items()))
+        return tree.iter_layout()
+
+    def build_from_layout(self, entries):
+        self.build_from_sorted([(key, value) for key, value, depth, color in entries])
+
+    def index_stats(self):
+        return {"books": self.count, "blocks": len(self.keys), "block_size": self.block_size}
+
+# Ordered indexes GatorLibrary can keep its books in, by the name passed as GatorLibrary(index=...).
+# Every index maps unique keys to values and provides:
+#   insert(key, value), delete(key), get(key), len(index)
+#   iter_items(), iter_range(lo, hi)                   (key, value) pairs in key order
+#   predecessor(key, inclusive=False)                  largest key < key, as (key, value) or None
+#   successor(key, inclusive=True)                     smallest key >= key, as (key, value) or None
+#   count_less(key, inclusive=False), select_item(k)   order statistics, k is 1-based
+#   build_from_sorted(items), split(key, inclusive), join(other)
+#   iter_layout(), build_from_layout(entries)          the tree shape stored in snapshots
+#   index_stats()                                      metrics for Stats
+#   color_flip_count                                   an int, or None if the index has no colors
+ORDERED_INDEXES = {index.name: index for index in (RedBlackTree, PersistentRedBlackTree, BlockedSortedArray)}
+
+ # Define a class for managing book reservation queues
+class BookReservationQueue:
+    # Reservations are heapq entries (priority, seq, patron_id): lower priority values are served
+    # first and seq, taken from a per-queue counter, breaks ties in arrival order, so the order is the
+    # same on every replay. Cancelled and reprioritized entries stay in the heap and are skipped when
+    # they reach the top; 'entries' maps each patron to their live entry.
+    __slots__ = ("heap", "entries", "next_seq", "stale", "capacity")
+
+    def __init__(self, capacity=None):
+        self.heap = []
+        self.entries = {}
+        self.next_seq = 0
+        self.stale = 0  # Number of dead entries still in the heap.
+        self.capacity = capacity  # Maximum number of reservations, or None for the library default.
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, patron_id):
+        return patron_id in self.entries
+
+    # Replace the queue contents with (patron_id, priority, seq) reservations
+    def restore(self, reservations):
+        self.entries = {patron_id: (priority, seq, patron_id) for patron_id, priority, seq in reservations}
+        self.heap = sorted(self.entries.values())  # A sorted list is already a valid heap.
+        self.next_seq = max((entry[1] for entry in self.heap), default=-1) + 1
+        self.stale = 0
+
+    # Once dead entries outnumber live ones, rebuild the heap from the live entries only
+    def compact(self):
+        if self.stale > len(self.entries):
+            self.heap = list(self.entries.values())
+            heapq.heapify(self.heap)
+            self.stale = 0
+
  # Method to add a reservation to the queue
     def add_reservation(self, patron_id, priority):
-        timestamp = time.time()
-        reservation = (patron_id, priority, timestamp)
-        self.heap.append(reservation)
-        self.heapify_up(len(self.heap) - 1)
- # Method to remove a reservation from the queue
+        entry = (priority, self.next_seq, patron_id)
+        self.next_seq += 1
+        if patron_id in self.entries:
+            self.stale += 1
+        self.entries[patron_id] = entry
+        heapq.heappush(self.heap, entry)
+ # Method to remove the highest-priority reservation; returns (patron_id, priority, seq) or None
     def remove_reservation(self):
-        if not self.heap:
-            return None
+        while self.heap:
+            priority, seq, patron_id = entry = heapq.heappop(self.heap)
+            if self.entries.get(patron_id) is entry:
+                del self.entries[patron_id]
+                self.compact()
+                return patron_id, priority, seq
+            self.stale -= 1
+        return None
+
+    # Patron ID of the reservation that will be served next, or None; dead entries on top are dropped
+    def first_patron(self):
+        heap = self.heap
+        while heap and self.entries.get(heap[0][2]) is not heap[0]:
+            heapq.heappop(heap)
+            self.stale -= 1
+        return heap[0][2] if heap else None
 
-        if len(self.heap) == 1:
-            return self.heap.pop()
+    # Patron IDs of the live reservations in the order they will be served
+    def patrons(self):
+        return [entry[2] for entry in sorted(self.entries.values())]
 
-        root = self.heap[0]
-        last_item = self.heap.pop()
-        self.heap[0] = last_item
-        self.heapify_down(0)
+    # Return the (patron_id, priority, seq) reservation held by a patron, or None
+    def get_reservation(self, patron_id):
+        entry = self.entries.get(patron_id)
+        return None if entry is None else (patron_id, entry[0], entry[1])
 
-        return root
     # Method to print the current queue
     def print_queue(self):
-        print("Current Queue:", self.heap)
+        print("Current Queue:", [self.get_reservation(patron_id) for patron_id in self.patrons()])
 
+    # Remove a patron's reservation in O(1) (its heap entry is dropped lazily); returns it, or None
     def remove_specific_patron(self, patron_id):
-        # Find the index of the reservation to remove
-        index_to_remove = None
-        for i, reservation in enumerate(self.heap):
-            if reservation[0] == patron_id:
-                index_to_remove = i
-                break
-
-        # If the patronID is not found, return None
-        if index_to_remove is None:
+        entry = self.entries.pop(patron_id, None)
+        if entry is None:
             return None
+        self.stale += 1
+        self.compact()
+        return patron_id, entry[0], entry[1]
 
-        # Swap the reservation with the last one and pop it
-        self.swap_items(
-            index_to_remove, len(self.heap) - 1
-        )  # Fixed indentation here
-        removed_reservation = self.heap.pop()
-
-        # Heapify up or down based on the new placement of the swapped reservation
-        if index_to_remove < len(self.heap):
-            parent_index = (index_to_remove - 1) // 2
-        if index_to_remove > 0 and self.compare_items(
-            self.heap[index_to_remove], self.heap[parent_index]
-        ) < 0:
-            self.heapify_up(index_to_remove)
-        else:
-            self.heapify_down(index_to_remove)
+    # Change the priority of a patron's reservation in O(log n), keeping its place among reservations
+    # of equal priority. Returns False if the patron has no reservation.
+    def update_priority(self, patron_id, priority):
+        entry = self.entries.get(patron_id)
+        if entry is None:
+            return False
+        entry = (priority, entry[1], patron_id)
+        self.entries[patron_id] = entry
+        heapq.heappush(self.heap, entry)
+        self.stale += 1
+        self.compact()
+        return True
+
+# Timer kinds; a timer's key is (kind, bookID, patronID)
+LOAN_TIMER = 0  # The loan of bookID to patronID is due.
+RESERVATION_TIMER = 1  # patronID's reservation for bookID expires.
+
+# Define a class for the library's timers: loan due dates and reservation expiry times. All timers share
+# one heapq of (deadline, seq, key) entries; seq, taken from a counter, breaks ties in scheduling order,
+# so timers fire in the same order on every replay. Like BookReservationQueue, cancelled and rescheduled
+# timers stay in the heap and are skipped when they reach the top, and the heap is rebuilt once dead
+# entries outnumber live ones. pop_due therefore costs O(log n) per timer that fires (amortized over the
+# dead entries it skips), however many timers are still pending.
+class TimerQueue:
+    __slots__ = ("heap", "entries", "next_seq", "stale")
+
+    def __init__(self):
+        self.heap = []
+        self.entries = {}  # key -> its live heap entry
+        self.next_seq = 0
+        self.stale = 0  # Number of dead entries still in the heap.
+
+    def __len__(self):
+        return len(self.entries)
+
+    # Set (or move) the deadline of a timer
+    def schedule(self, key, deadline):
+        entry = (deadline, self.next_seq, key)
+        self.next_seq += 1
+        if key in self.entries:
+            self.stale += 1
+        self.entries[key] = entry
+        heapq.heappush(self.heap, entry)
+
+    # Cancel a timer in O(1) (its heap entry is dropped lazily); returns its deadline, or None
+    def cancel(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return None
+        self.stale += 1
+        self.compact()
+        return entry[0]
+
+    def compact(self):
+        if self.stale > len(self.entries):
+            self.heap = list(self.entries.values())
+            heapq.heapify(self.heap)
+            self.stale = 0
+
+    # Remove the timers with deadline <= now and yield them as (key, deadline), earliest first. Timers
+    # may be cancelled while the caller handles the ones already yielded.
+    def pop_due(self, now):
+        while self.heap and self.heap[0][0] <= now:
+            deadline, seq, key = entry = heapq.heappop(self.heap)
+            if self.entries.get(key) is entry:
+                del self.entries[key]
+                yield key, deadline
+            else:
+                self.stale -= 1
+
+    # Live timers as (key, deadline) in the order they will fire
+    def items(self):
+        return [(entry[2], entry[0]) for entry in sorted(self.entries.values())]
+
+    # Replace the timers with (key, deadline) pairs given in the order they will fire
+    def restore(self, timers):
+        self.entries = {key: (deadline, seq, key) for seq, (key, deadline) in enumerate(timers)}
+        self.heap = sorted(self.entries.values())  # A sorted list is already a valid heap.
+        self.next_seq = len(self.heap)
+        self.stale = 0
 
-        return removed_reservation
-   
 # Define a class for representing books
 class Book:
+    __slots__ = ("bookID", "bookName", "authorName", "availabilityStatus", "borrowedBy", "reservationHeap")
+
     def __init__(self, bookID, bookName, authorName, availabilityStatus, borrowedBy=None): # Initialize a Book with book ID, name, author, availability status, and borrower information
         self.bookID = bookID
         self.bookName = bookName
         self.authorName = authorName
         self.availabilityStatus = availabilityStatus
         self.borrowedBy = borrowedBy
-        self.reservationHeap = BookReservationQueue()
+        # Most books are never reserved, so the queue is only allocated on the first reservation.
+        self.reservationHeap = None
+
+    # Return the reservation queue, allocating it on first use
+    def reservation_queue(self):
+        if self.reservationHeap is None:
+            self.reservationHeap = BookReservationQueue()
+        return self.reservationHeap
+
+    # Patron IDs of the current reservations, in the order they will be served
+    def reserved_patrons(self):
+        if not self.reservationHeap:
+            return []
+        return self.reservationHeap.patrons()
+
+# Columnar metadata file layout (little-endian), written by MetadataStore.save:
+#   header:  magic, version, padding, record count, author count, author bytes, title bytes (48 bytes)
+#   arrays:  bookID (int64) per record, author number (uint32) per record padded to 8 bytes,
+#            title offsets (uint64, one per record plus the end), author offsets (uint64, likewise),
+#            record numbers (uint64) sorted by (normalized title, bookID), then by (normalized author, bookID)
+#   strings: UTF-8 author names, then UTF-8 titles
+# The header's size and the padding keep every array 8-byte aligned in the file, and so in a mapping.
+METADATA_MAGIC = b"GATORMDS"
+METADATA_VERSION = 3
+METADATA_HEADER = struct.Struct("<8sI4xQQQQ")
+
+# Define a columnar store of catalog metadata. Every distinct author name is kept once and referred to
+# by number, and titles are packed as UTF-8 into one buffer with an offsets array, so a book's metadata
+# costs a few bytes plus its title instead of two string objects. Records are only ever appended, by
+# add(); a deleted book's record stays behind. open() maps a file written by save() read-only: the arrays
+# and the title buffer are then views of the mapping, so processes that open the same file share one
+# physical copy through the page cache, and only the author names are decoded in each process. The file
+# also holds the records in title and in author order, which CatalogIndex searches in place.
+class MetadataStore:
+    def __init__(self):
+        self.book_ids = array('q')
+        self.author_numbers = array('I')
+        self.title_offsets = array('Q', [0])
+        self.titles = bytearray()
+        self.authors = []
+        self.author_numbers_by_name = {}
+        self.mapping = None  # The mmap behind a store returned by open(); such a store is read-only.
+        # Record numbers sorted by (normalized title, bookID) and by (normalized author, bookID); only
+        # a store returned by open() has them.
+        self.title_order = None
+        self.author_order = None
+
+    def __len__(self):
+        return len(self.book_ids)
+
+    @property
+    def read_only(self):
+        return self.mapping is not None
+
+    # Append a record and return its number
+    def add(self, bookID, title, author):
+        if self.mapping is not None:
+            raise ValueError("A MetadataStore opened from a file is read-only")
+        number = self.author_numbers_by_name.get(author)
+        if number is None:
+            number = self.author_numbers_by_name[author] = len(self.authors)
+            self.authors.append(author)
+        self.book_ids.append(bookID)
+        self.author_numbers.append(number)
+        self.titles += title.encode("utf-8")
+        self.title_offsets.append(len(self.titles))
+        return len(self.book_ids) - 1
+
+    def title(self, record):
+        return str(self.titles[self.title_offsets[record]:self.title_offsets[record + 1]], "utf-8")
+
+    def author(self, record):
+        return self.authors[self.author_numbers[record]]
+
+    # Write the store to path (through a temporary file renamed into place, like save_snapshot)
+    def save(self, path):
+        authors = [author.encode("utf-8") for author in self.authors]
+        author_offsets = array('Q', [0])
+        for author in authors:
+            author_offsets.append(author_offsets[-1] + len(author))
+        count = len(self.book_ids)
+        authors_normalized = [normalize_name(author) for author in self.authors]
+        title_order = array('Q', sorted(range(count), key=lambda record: (normalize_name(self.title(record)),
+                                                                          self.book_ids[record])))
+        author_order = array('Q', sorted(range(count), key=lambda record: (authors_normalized[self.author_numbers[record]],
+                                                                           self.book_ids[record])))
+        temporary_path = f"{path}.tmp"
+        with open(temporary_path, 'wb') as file:
+            file.write(METADATA_HEADER.pack(METADATA_MAGIC, METADATA_VERSION, count, len(authors),
+                                            author_offsets[-1], len(self.titles)))
+            file.write(self.book_ids)
+            file.write(self.author_numbers)
+            file.write(bytes(-count * 4 % 8))
+            file.write(self.title_offsets)
+            file.write(author_offsets)
+            file.write(title_order)
+            file.write(author_order)
+            file.writelines(authors)
+            file.write(self.titles)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporary_path, path)
+
+    # Return a read-only store backed by a memory map of a file written by save()
+    @classmethod
+    def open(cls, path):
+        with open(path, 'rb') as file:
+            mapping = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(mapping)
+        if len(view) < METADATA_HEADER.size:
+            raise ValueError(f"{path} is not a Gator Library metadata file")
+        magic, version, count, author_count, author_size, title_size = METADATA_HEADER.unpack_from(view, 0)
+        if magic != METADATA_MAGIC or version != METADATA_VERSION:
+            raise ValueError(f"{path} is not a Gator Library metadata file")
+        offset = METADATA_HEADER.size
+        padding = -count * 4 % 8
+        if len(view) != offset + count * 36 + padding + (author_count + 2) * 8 + author_size + title_size:
+            raise ValueError(f"Metadata file {path} is truncated or corrupt")
+
+        def take(size):
+            nonlocal offset
+            part = view[offset:offset + size]
+            offset += size
+            return part
+
+        store = cls()
+        store.book_ids = take(count * 8).cast('q')
+        store.author_numbers = take(count * 4).cast('I')
+        take(padding)
+        store.title_offsets = take((count + 1) * 8).cast('Q')
+        author_offsets = take((author_count + 1) * 8).cast('Q')
+        store.title_order = take(count * 8).cast('Q')
+        store.author_order = take(count * 8).cast('Q')
+        author_bytes = take(author_size)
+        store.titles = take(title_size)
+        store.authors = [str(author_bytes[author_offsets[i]:author_offsets[i + 1]], "utf-8") for i in range(author_count)]
+        store.author_numbers_by_name = {author: number for number, author in enumerate(store.authors)}
+        store.mapping = mapping
+        return store
+
+    # Unmap a store returned by open(); its books cannot be read afterwards
+    def close(self):
+        if self.mapping is not None:
+            for column in (self.book_ids, self.author_numbers, self.title_offsets, self.titles, self.title_order,
+                           self.author_order):
+                column.release()
+            self.mapping.close()
+
+# Define a Book whose title and author are read from a MetadataStore record instead of being held as
+# strings. It has the same attributes and methods as Book, so the rest of the library cannot tell them
+# apart; it pickles as a plain Book, so it can be sent to another process without its store.
+class StoredBook:
+    __slots__ = ("bookID", "store", "record", "availabilityStatus", "borrowedBy", "reservationHeap")
+
+    def __init__(self, bookID, store, record, availabilityStatus=True, borrowedBy=None):
+        self.bookID = bookID
+        self.store = store
+        self.record = record
+        self.availabilityStatus = availabilityStatus
+        self.borrowedBy = borrowedBy
+        self.reservationHeap = None
+
+    @property
+    def bookName(self):
+        return self.store.title(self.record)
+
+    @property
+    def authorName(self):
+        return self.store.author(self.record)
+
+    reservation_queue = Book.reservation_queue
+    reserved_patrons = Book.reserved_patrons
+
+    def __reduce__(self):
+        return restore_book, (self.bookID, self.bookName, self.authorName, self.availabilityStatus,
+                              self.borrowedBy, self.reservationHeap)
+
+def restore_book(bookID, bookName, authorName, availabilityStatus, borrowedBy, reservationHeap):
+    book = Book(bookID, bookName, authorName, availabilityStatus, borrowedBy)
+    book.reservationHeap = reservationHeap
+    return book
+
+# Define a class indexing what each patron holds: the books they have borrowed and the books they have
+# reserved. GatorLibrary updates it on every loan, return, allotment and reservation change, so
+# per-patron queries cost time proportional to that patron's own holdings.
+class PatronIndex:
+    def __init__(self):
+        self.loans = {}  # patronID -> set of borrowed bookIDs
+        self.reservations = {}  # patronID -> set of reserved bookIDs
+
+    @staticmethod
+    def add(index, patronID, bookID):
+        books = index.get(patronID)
+        if books is None:
+            index[patronID] = {bookID}
+        else:
+            books.add(bookID)
+
+    @staticmethod
+    def discard(index, patronID, bookID):
+        books = index.get(patronID)
+        if books is not None:
+            books.discard(bookID)
+            if not books:
+                del index[patronID]
+
+    def add_loan(self, patronID, bookID):
+        self.add(self.loans, patronID, bookID)
+
+    def remove_loan(self, patronID, bookID):
+        self.discard(self.loans, patronID, bookID)
+
+    def add_reservation(self, patronID, bookID):
+        self.add(self.reservations, patronID, bookID)
+
+    def remove_reservation(self, patronID, bookID):
+        self.discard(self.reservations, patronID, bookID)
+
+    def borrowed_by(self, patronID):
+        return sorted(self.loans.get(patronID, ()))
+
+    def reserved_by(self, patronID):
+        return sorted(self.reservations.get(patronID, ()))
+
+    # Index a book's borrower and reservations, e.g. when it enters the library
+    def add_book(self, book):
+        if book.borrowedBy is not None:
+            self.add_loan(book.borrowedBy, book.bookID)
+        if book.reservationHeap:
+            for patronID in book.reservationHeap.entries:
+                self.add_reservation(patronID, book.bookID)
+
+    # Drop a book's borrower and reservations, e.g. when it leaves the library
+    def remove_book(self, book):
+        if book.borrowedBy is not None:
+            self.remove_loan(book.borrowedBy, book.bookID)
+        if book.reservationHeap:
+            for patronID in book.reservationHeap.entries:
+                self.remove_reservation(patronID, book.bookID)
+
+# Normalize an author or title for searching: surrounding quotes are dropped, case is folded and
+# runs of whitespace collapse to one space
+def normalize_name(name):
+    return " ".join(name.strip().strip('"').casefold().split())
+
+# Define a class for one secondary index: a BlockedSortedArray of (normalized name, bookID) keys, so an
+# insert or delete costs O(log n) plus a shift within one block. Exact lookups take the run of keys of
+# one name, whose bookIDs are already in order, and prefix lookups the run of names starting with the
+# prefix. A bulk build is one sort, and books that share a name share one string.
+class NameIndex:
+    __slots__ = ("entries",)
+
+    def __init__(self, pairs=()):
+        keys = []
+        previous = None
+        for name, bookID in sorted(pairs):
+            if name == previous:
+                name = previous
+            keys.append(((name, bookID), None))
+            previous = name
+        self.entries = BlockedSortedArray()
+        self.entries.build_from_sorted(keys)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, name, bookID):
+        found = self.entries.successor((name,))
+        if found is not None and found[0][0] == name:
+            name = found[0][0]
+        self.entries.insert((name, bookID), None)
+
+    def discard(self, name, bookID):
+        self.entries.delete((name, bookID))
+
+    # Lazily yield, in bookID order, the books whose normalized name equals query, or starts with it
+    # when query ends in '*'
+    def find(self, query):
+        query = query.strip().strip('"')
+        if query.endswith("*"):
+            prefix = normalize_name(query[:-1])
+            if not prefix:
+                return iter(sorted(self.ids_in("", None)))
+            # Every name starting with prefix sorts before the prefix with its last character bumped.
+            return iter(sorted(self.ids_in(prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1))))
+        name = normalize_name(query)
+        # No string sorts between name and name + "\0", so this is exactly the run of name.
+        return iter(self.ids_in(name, name + "\0"))
+
+    # bookIDs of the entries with low <= name < high (no upper bound if high is None), in (name, bookID)
+    # order
+    def ids_in(self, low, high):
+        entries = self.entries
+        if not len(entries):
+            return []
+        # (high,) sorts before every key named high, so the inclusive bound of iter_range excludes them.
+        keys = entries.iter_range((low,), (high,) if high is not None else entries.maxes[-1])
+        return [bookID for (name, bookID), _ in keys]
+
+# Define a class for the read-only sequence of normalized names bisect searches in a StoreNameIndex:
+# item i is computed by key(i) only when bisect asks for it
+class NameColumn:
+    __slots__ = ("length", "key")
+
+    def __init__(self, length, key):
+        self.length = length
+        self.key = key
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, position):
+        return self.key(position)
+
+# Define a NameIndex over the records of a mapped MetadataStore, in the title or author order saved in
+# its file. Nothing is built per book: a lookup bisects the file's order, normalizing only the
+# O(log n) names it compares, and records in dropped (books deleted or never loaded) are skipped.
+class StoreNameIndex(NameIndex):
+    __slots__ = ("names", "order", "ids", "dropped")
+
+    def __init__(self, order, key, ids, dropped):
+        self.names = NameColumn(len(order), lambda position: key(order[position]))
+        self.order = order
+        self.ids = ids
+        self.dropped = dropped
+
+    def __len__(self):
+        return len(self.order) - len(self.dropped)
+
+    def ids_in(self, low, high):
+        start = bisect.bisect_left(self.names, low)
+        end = bisect.bisect_left(self.names, high, start) if high is not None else len(self.order)
+        ids, dropped = self.ids, self.dropped
+        return [ids[record] for record in self.order[start:end] if record not in dropped]
+
+# Define a class for the secondary indexes on author and title, one NameIndex each. After load_metadata
+# of a mapped store, the store's books are found through a StoreNameIndex on each side instead, and the
+# NameIndexes only hold the books added since; results from both are merged in bookID order.
+class CatalogIndex:
+    def __init__(self):
+        self.authors = NameIndex()
+        self.titles = NameIndex()
+        self.store = None  # Mapped MetadataStore whose live books store_authors and store_titles find.
+        self.store_authors = self.store_titles = None
+        self.dropped = set()  # Records of store that are not live books of the library.
+
+    # Is the book one of the store's live books, found through the StoreNameIndexes?
+    def in_store(self, book):
+        return self.store is not None and getattr(book, "store", None) is self.store and book.record not in self.dropped
+
+    def add_book(self, book):
+        self.authors.add(normalize_name(book.authorName), book.bookID)
+        self.titles.add(normalize_name(book.bookName), book.bookID)
+
+    def remove_book(self, book):
+        if self.in_store(book):
+            self.dropped.add(book.record)
+            return
+        self.authors.discard(normalize_name(book.authorName), book.bookID)
+        self.titles.discard(normalize_name(book.bookName), book.bookID)
+
+    # Rebuild both indexes from a bookID -> Book dict with one sort each, for bulk loads. With a mapped
+    # store (or one attached before), the store's live books are indexed in place, and only the others
+    # are normalized and sorted.
+    def rebuild(self, books, store=None):
+        if store is not None and store.title_order is not None:
+            self.store = store
+        store = self.store
+        if store is not None:
+            book_ids = store.book_ids
+            self.dropped = dropped = set()
+            for record in range(len(store)):
+                book = books.get(book_ids[record])
+                if getattr(book, "store", None) is not store or book.record != record:
+                    dropped.add(record)
+            self.store_authors = StoreNameIndex(store.author_order, lambda record: normalize_name(store.author(record)),
+                                                book_ids, dropped)
+            self.store_titles = StoreNameIndex(store.title_order, lambda record: normalize_name(store.title(record)),
+                                               book_ids, dropped)
+            books = {bookID: book for bookID, book in books.items() if not self.in_store(book)}
+        self.authors = NameIndex((normalize_name(book.authorName), book.bookID) for book in books.values())
+        self.titles = NameIndex((normalize_name(book.bookName), book.bookID) for book in books.values())
+
+    def find_author(self, query):
+        if self.store is None:
+            return self.authors.find(query)
+        return heapq.merge(self.store_authors.find(query), self.authors.find(query))
+
+    def find_title(self, query):
+        if self.store is None:
+            return self.titles.find(query)
+        return heapq.merge(self.store_titles.find(query), self.titles.find(query))
+
+# Format the six-line record written by PrintBook, PrintBooks and FindClosestBook
+def format_book(book):
+    availability = "Yes" if book.availabilityStatus else "No"
+    borrowedBy = book.borrowedBy if book.borrowedBy is not None else "None"
+    return (f"BookID = {book.bookID}\n"
+            f"Title = {book.bookName}\n"
+            f"Author = {book.authorName}\n"
+            f"Availability = {availability}\n"
+            f"BorrowedBy = {borrowedBy}\n"
+            f"Reservations = {book.reserved_patrons()}\n")
+
+# Define a bounded LRU cache of rendered book records keyed by bookID. GatorLibrary invalidates an
+# entry whenever a command changes that book, so a cached record is always identical to a fresh one.
+class RenderCache:
+    def __init__(self, capacity=4096):
+        self.capacity = capacity
+        self.records = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, bookID):
+        record = self.records.get(bookID)
+        if record is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.records.move_to_end(bookID)
+        return record
+
+    def put(self, bookID, record):
+        if self.capacity <= 0:
+            return
+        self.records[bookID] = record
+        if len(self.records) > self.capacity:
+            self.records.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, bookID):
+        self.records.pop(bookID, None)
+
+    def clear(self):
+        self.records.clear()
+
+    def stats(self):
+        return {"size": len(self.records), "capacity": self.capacity, "hits": self.hits,
+                "misses": self.misses, "evictions": self.evictions}
+
+# RenderCache for a library shared between threads: readers render books concurrently, so every
+# access to the LRU order goes through one mutex
+class LockedRenderCache(RenderCache):
+    def __init__(self, capacity=4096):
+        super().__init__(capacity)
+        self.mutex = threading.Lock()
+
+    def get(self, bookID):
+        with self.mutex:
+            return super().get(bookID)
+
+    def put(self, bookID, record):
+        with self.mutex:
+            super().put(bookID, record)
+
+    def invalidate(self, bookID):
+        with self.mutex:
+            super().invalidate(bookID)
+
+    def clear(self):
+        with self.mutex:
+            super().clear()
+
+# Define a class for per-command-type counts and latency histograms, collected by run_commands when a
+# library's stats attribute is set. Latencies go into power-of-two nanosecond buckets: bucket i holds
+# the commands that took [2 ** (i - 1), 2 ** i) ns. Commands named in profile (or every command, with
+# "all") also run under a cProfile profiler of their own.
+class CommandStats:
+    def __init__(self, profile=()):
+        self.counts = {}
+        self.total_ns = {}
+        self.max_ns = {}
+        self.histograms = {}
+        self.profile = set(profile)
+        self.profilers = {}
+
+    def run(self, name, handler, library, args):
+        profiler = None
+        if name in self.profile or "all" in self.profile:
+            profiler = self.profilers.get(name)
+            if profiler is None:
+                profiler = self.profilers[name] = cProfile.Profile()
+        start = time.perf_counter_ns()
+        if profiler is None:
+            handler(library, *args)
+        else:
+            profiler.enable()
+            try:
+                handler(library, *args)
+            finally:
+                profiler.disable()
+        self.record(name, time.perf_counter_ns() - start)
+
+    def histogram(self, name):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = [0] * 64
+            self.counts[name] = self.total_ns[name] = self.max_ns[name] = 0
+        return histogram
+
+    def record(self, name, elapsed_ns):
+        self.histogram(name)[elapsed_ns.bit_length()] += 1
+        self.counts[name] += 1
+        self.total_ns[name] += elapsed_ns
+        if elapsed_ns > self.max_ns[name]:
+            self.max_ns[name] = elapsed_ns
+
+    # Add the counts and latencies of another CommandStats (for example a shard's) to these; profiles
+    # are not merged
+    def merge(self, other):
+        for name, other_histogram in other.histograms.items():
+            histogram = self.histogram(name)
+            for bucket, hits in enumerate(other_histogram):
+                histogram[bucket] += hits
+            self.counts[name] += other.counts[name]
+            self.total_ns[name] += other.total_ns[name]
+            self.max_ns[name] = max(self.max_ns[name], other.max_ns[name])
+
+    # Upper bound, in microseconds, of the bucket holding the given fraction of a command's latencies
+    def percentile_us(self, name, fraction):
+        rank = fraction * self.counts[name]
+        seen = 0
+        for bucket, count in enumerate(self.histograms[name]):
+            seen += count
+            if count and seen >= rank:
+                return (1 << bucket) / 1000
+        return 0.0
+
+    def snapshot(self):
+        return {name: {"count": count,
+                       "mean_us": round(self.total_ns[name] / count / 1000, 3),
+                       "p50_us": self.percentile_us(name, 0.5),
+                       "p99_us": self.percentile_us(name, 0.99),
+                       "max_us": round(self.max_ns[name] / 1000, 3),
+                       "histogram_ns": {1 << bucket: hits for bucket, hits in enumerate(self.histograms[name]) if hits}}
+                for name, count in sorted(self.counts.items())}
+
+    # Write one pstats file per profiled command type, named prefix + command name + ".pstats"
+    def dump_profiles(self, prefix):
+        for name, profiler in self.profilers.items():
+            profiler.dump_stats(f"{prefix}{name}.pstats")
+
+# Render a stats_snapshot as one "section.name = value" line per metric
+def format_stats(snapshot):
+    lines = []
+    for section, values in snapshot.items():
+        for name, value in values.items():
+            if section == "commands":
+                value = ", ".join(f"{key} {number}" for key, number in value.items() if key != "histogram_ns")
+            lines.append(f"{section}.{name} = {value}\n")
+    return "".join(lines)
+
+# Output stream that discards everything, used when replaying commands whose output was already written
+class NullStream:
+    def write(self, text):
+        pass
+
+    def flush(self):
+        pass
+
+# Output sink for a library shared between threads: each thread writes to the stream it selected with
+# redirect(), so commands running at the same time never interleave their output
+class ThreadOutput:
+    def __init__(self):
+        self.local = threading.local()
+
+    def redirect(self, stream):
+        self.local.stream = stream
+
+    def write(self, text):
+        self.local.stream.write(text)
+
+    def end_command(self):
+        pass
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+# Define a class for the output file shared by all library commands
+class OutputSink:
+    # flush_policy is "command" (flush after every command), "quit" (flush only on Quit/close)
+    # or an integer N (flush after every N commands)
+    def __init__(self, filename=None, flush_policy="command", stream=None, buffer_size=1 << 16):
+        if flush_policy not in ("command", "quit") and (not isinstance(flush_policy, int) or flush_policy < 1):
+            raise ValueError(f"Invalid flush policy: {flush_policy!r}")
+        self.flush_policy = flush_policy
+        self.filename = filename
+        # The file is opened once for the whole run instead of once per written line.
+        if stream is None:
+            stream = open(filename, 'a', buffering=buffer_size) if filename is not None else sys.stdout
+            self.owns_stream = filename is not None
+        else:
+            self.owns_stream = False
+        self.stream = stream
+        self.commands_since_flush = 0
+
+    def write(self, text):
+        self.stream.write(text)
+
+    # Called by the command loop after each command; flushes according to the policy
+    def end_command(self):
+        self.commands_since_flush += 1
+        if self.flush_policy == "command":
+            self.flush()
+        elif self.flush_policy != "quit" and self.commands_since_flush >= self.flush_policy:
+            self.flush()
+
+    def flush(self):
+        self.commands_since_flush = 0
+        self.stream.flush()
+
+    def close(self):
+        if self.stream is None:
+            return
+        self.flush()
+        if self.owns_stream:
+            self.stream.close()
+        self.stream = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+# Snapshot file layout (little-endian), written by GatorLibrary.save_snapshot:
+#   header:       magic, version, default reservation capacity, color flip count, book count,
+#                 reservation count, string table size
+#   clock:        library time and timer count
+#   books:        one fixed-size record per book in bookID order; title and author are (offset, length)
+#                 references into the string table, followed by the number of reservations, flags,
+#                 the node's depth in the tree and the book's own reservation capacity
+#   reservations: (patronID, priority, seq) in service order, grouped by book in bookID order
+#   strings:      UTF-8 titles and authors
+#   timers:       (bookID, patronID, deadline, kind) in the order they will fire
+# Version 2 files, which had no clock and no timers, and version 1 files, which also stored
+# (patronID, priority, timestamp) and no capacities, can still be loaded.
+SNAPSHOT_MAGIC = b"GATORLIB"
+SNAPSHOT_VERSION = 3
+SNAPSHOT_HEADER = struct.Struct("<8sIIqQQQ")
+SNAPSHOT_CLOCK = struct.Struct("<qQ")
+SNAPSHOT_TIMER = struct.Struct("<qqqB7x")
+SNAPSHOT_BOOK = struct.Struct("<qqQIIIBB2xI")
+SNAPSHOT_RESERVATION = struct.Struct("<qqq")
+SNAPSHOT_BOOK_V1 = struct.Struct("<qqQIIIBB2x")
+SNAPSHOT_RESERVATION_V1 = struct.Struct("<qqd")
+SNAPSHOT_AVAILABLE = 1
+SNAPSHOT_BORROWED = 2
+SNAPSHOT_RED = 4
+SNAPSHOT_CAPACITY = 8
 
 class GatorLibrary: # Define a class for the Gator Library
     
-    def __init__(self):
+    def __init__(self, output=None, reservation_capacity=20, render_cache_size=4096, index="redblack", metadata=None,
+                 loan_period=None, reservation_ttl=None):
         self.book_dict = {}
-        self.red_black_tree = RedBlackTree()
+        # Writable MetadataStore that new books keep their title and author in, or None for plain Books.
+        self.metadata = metadata
+        # Ordered index of the books by bookID, one of ORDERED_INDEXES; "persistent" enables snapshot().
+        self.index_class = ORDERED_INDEXES[index]
+        self.book_index = self.index_class()
+        # All command output goes through a single sink; defaults to stdout.
+        self.output = output if output is not None else OutputSink()
+        # Default limit on reservations per book; set_reservation_capacity overrides it for one book.
+        self.reservation_capacity = reservation_capacity
+        self.patron_index = PatronIndex()
+        self.catalog_index = CatalogIndex()
+        # Rendered PrintBook records of recently printed books; 0 disables caching.
+        self.render_cache = RenderCache(render_cache_size)
+        # Sorted array of bookIDs used by batch_find_closest; None until needed and after any
+        # InsertBook/DeleteBook.
+        self.sorted_ids = None
+        # CommandStats filled in by run_commands, or None to skip per-command timing altogether.
+        self.stats = None
+        # Library time. It only moves when Advance is run, and every command that reads it is run in
+        # order, so replaying a command file or journal reproduces every due date and expiry exactly.
+        # A wall clock is injected by whoever issues the Advance commands (see server.py --tick).
+        self.now = 0
+        # Loans are due loan_period after they start and reservations expire reservation_ttl after they
+        # are made, in library time units; None disables the timer.
+        self.loan_period = loan_period
+        self.reservation_ttl = reservation_ttl
+        self.timers = TimerQueue()
  # Method to insert a new book into the library
-    def InsertBook(self, bookID, bookName, authorName, availabilityStatus, filename, borrowedBy=None):
+    def InsertBook(self, bookID, bookName, authorName, availabilityStatus, borrowedBy=None):
         if bookID in self.book_dict:
-            with open(filename, 'a') as file:
-                file.write(f"Book with ID {bookID} already exists.\n")
+            self.output.write(f"Book with ID {bookID} already exists.\n")
             # print(f"Book with ID {bookID} already exists.")
             return
 
-        new_book = Book(bookID, bookName, authorName, availabilityStatus, borrowedBy)
+        new_book = self.new_book(bookID, bookName, authorName, availabilityStatus, borrowedBy)
+        self.render_cache.invalidate(bookID)
+        self.sorted_ids = None
         self.book_dict[bookID] = new_book
-        self.red_black_tree.insert(bookID, new_book)
+        self.book_index.insert(bookID, new_book)
+        self.patron_index.add_book(new_book)
+        if borrowedBy is not None:
+            self.schedule_loan(bookID, borrowedBy)
+        self.catalog_index.add_book(new_book)
+    # Method to bulk-load a catalog of (bookID, bookName, authorName, availabilityStatus[, borrowedBy])
+    # records. Input that is already sorted by bookID is used as-is, anything else is sorted first; the
+    # tree is then rebuilt in linear time instead of inserting one key at a time. Duplicate IDs keep the
+    # first record and are reported like InsertBook. A bulk load performs no color flips, so
+    # ColorFlipCount keeps reporting only the flips caused by incremental operations.
+    def load_catalog(self, records):
+        records = records if isinstance(records, list) else list(records)
+        if any(records[i][0] > records[i + 1][0] for i in range(len(records) - 1)):
+            records.sort(key=itemgetter(0))
+        return self.load_books(records, lambda record: self.new_book(*record))
+
+    # Method to bulk-load every record of a MetadataStore (typically one mapped with MetadataStore.open)
+    # as an available book, reading titles and authors through the store, in the same way as load_catalog
+    def load_metadata(self, store):
+        records = sorted(range(len(store)), key=store.book_ids.__getitem__)
+        return self.load_books([(store.book_ids[record], record) for record in records],
+                               lambda item: StoredBook(item[0], store, item[1]), store)
+
+    # Add the books made by make_book from items sorted by bookID, whose first element is the bookID.
+    # A mapped store the books come from lets the catalog index search its records in place.
+    def load_books(self, items, make_book, store=None):
+        loaded = []
+        for item in items:
+            bookID = item[0]
+            if bookID in self.book_dict:
+                self.output.write(f"Book with ID {bookID} already exists.\n")
+                continue
+            new_book = make_book(item)
+            self.book_dict[bookID] = new_book
+            self.patron_index.add_book(new_book)
+            if new_book.borrowedBy is not None:
+                self.schedule_loan(bookID, new_book.borrowedBy)
+            loaded.append((bookID, new_book))
+
+        if len(loaded) != len(self.book_dict):
+            # Merge the loaded books into the books already in the tree, both sorted by ID.
+            loaded = list(heapq.merge(self.book_index.iter_items(), loaded, key=itemgetter(0)))
+        self.book_index.build_from_sorted(loaded)
+        self.catalog_index.rebuild(self.book_dict, store)
+        self.render_cache.clear()
+        self.sorted_ids = None
+        return len(self.book_dict)
+
+    # Make a Book, or a StoredBook whose title and author go into self.metadata when that is writable
+    def new_book(self, bookID, bookName, authorName, availabilityStatus, borrowedBy=None):
+        if self.metadata is None or self.metadata.read_only:
+            return Book(bookID, bookName, authorName, availabilityStatus, borrowedBy)
+        return StoredBook(bookID, self.metadata, self.metadata.add(bookID, bookName, authorName),
+                          availabilityStatus, borrowedBy)
+
+    # Method to write the titles and authors of the current books, in bookID order, to a metadata file
+    # for load_metadata (after MetadataStore.open) in this or other processes
+    def save_metadata(self, path):
+        store = MetadataStore()
+        for bookID, book in self.book_index.iter_items():
+            store.add(bookID, book.bookName, book.authorName)
+        store.save(path)
+
   # Method to borrow a book by a patron
-    def BorrowBook(self, patronID, bookID, patronPriority, filename):
+    def BorrowBook(self, patronID, bookID, patronPriority):
         if bookID not in self.book_dict:
-            with open(filename, 'a') as file:
-                file.write(f"Book {bookID} not found in the Library.\n")
+            self.output.write(f"Book {bookID} not found in the Library.\n")
             return
 
         book = self.book_dict[bookID]
 
         if book.borrowedBy == patronID:
-            with open(filename, 'a') as file:
-                file.write(f"Patron {patronID} has already borrowed Book {bookID}.\n")
+            self.output.write(f"Patron {patronID} has already borrowed Book {bookID}.\n")
             return
 
         if book.availabilityStatus:
             book.availabilityStatus = False
             book.borrowedBy = patronID
-            with open(filename, 'a') as file:
-                file.write(f"Book {bookID} Borrowed by Patron {patronID}\n")
+            self.patron_index.add_loan(patronID, bookID)
+            self.schedule_loan(bookID, patronID)
+            self.render_cache.invalidate(bookID)
+            self.output.write(f"Book {bookID} Borrowed by Patron {patronID}\n")
         else:
-            if len(book.reservationHeap.heap) < 20:
-                book.reservationHeap.add_reservation(patronID, patronPriority)
-                with open(filename, 'a') as file:
-                    file.write(f"Book {bookID} Reserved by Patron {patronID}\n")
+            reservation_queue = book.reservation_queue()
+            if patronID in reservation_queue:
+                self.output.write(f"Patron {patronID} has already reserved Book {bookID}.\n")
+            elif len(reservation_queue) < self.capacity_of(reservation_queue):
+                reservation_queue.add_reservation(patronID, patronPriority)
+                self.patron_index.add_reservation(patronID, bookID)
+                if self.reservation_ttl is not None:
+                    self.timers.schedule((RESERVATION_TIMER, bookID, patronID), self.now + self.reservation_ttl)
+                self.render_cache.invalidate(bookID)
+                self.output.write(f"Book {bookID} Reserved by Patron {patronID}\n")
             else:
-                with open(filename, 'a') as file:
-                    file.write(f"Reservation list for Book {bookID} is full.\n")
+                self.output.write(f"Reservation list for Book {bookID} is full.\n")
  # Method to delete a book from the library
-    def DeleteBook(self, bookID, filename):
+    def DeleteBook(self, bookID):
         if bookID not in self.book_dict:
-            with open(filename, 'a') as file:
-                file.write(f"Book {bookID} not found in the Library.\n")
+            self.output.write(f"Book {bookID} not found in the Library.\n")
             return
 
         book = self.book_dict[bookID]
+        self.write_deletion_notice(book)
+
+        # Remove the book from the library
+        self.forget_book(book)
+        self.sorted_ids = None
+        self.book_index.delete(bookID)
 
+    # Write the notice for a deleted book, naming the patrons whose reservations are cancelled
+    def write_deletion_notice(self, book):
+        bookID = book.bookID
         # Check if there are reservations for the book
-        if book.reservationHeap.heap:
-            reservation_ids = ['Patron ' + str(reservation[0]) for reservation in book.reservationHeap.heap]
+        if book.reservationHeap:
+            reservation_ids = ['Patron ' + str(patronID) for patronID in book.reserved_patrons()]
             reservation_notification = ', '.join(reservation_ids)
             if len(reservation_ids) > 1:
-                with open(filename, 'a') as file:
-                    file.write(f"Book {bookID} is no longer available. Reservations made by {reservation_notification} have been cancelled!\n")
+                self.output.write(f"Book {bookID} is no longer available. Reservations made by {reservation_notification} have been cancelled!\n")
             else:
-                with open(filename, 'a') as file:
-                    file.write(f"Book {bookID} is no longer available. Reservation made by {reservation_notification} has been cancelled!\n")
+                self.output.write(f"Book {bookID} is no longer available. Reservation made by {reservation_notification} has been cancelled!\n")
         else:
-            with open(filename, 'a') as file:
-                file.write(f"Book {bookID} is no longer available.\n")
+            self.output.write(f"Book {bookID} is no longer available.\n")
 
-        # Remove the book from the library
-        del self.book_dict[bookID]
-        self.red_black_tree.delete(bookID)
+    # Drop a book from book_dict, the patron and catalog indexes, the timers and the render cache (not the tree)
+    def forget_book(self, book):
+        if self.timers:
+            for key, _ in self.book_timers(book):
+                self.timers.cancel(key)
+        self.patron_index.remove_book(book)
+        self.catalog_index.remove_book(book)
+        self.render_cache.invalidate(book.bookID)
+        del self.book_dict[book.bookID]
+
+    # Return the pending timers of a book's loan and reservations as (key, heap entry)
+    def book_timers(self, book):
+        keys = []
+        if book.borrowedBy is not None:
+            keys.append((LOAN_TIMER, book.bookID, book.borrowedBy))
+        if book.reservationHeap:
+            keys.extend((RESERVATION_TIMER, book.bookID, patronID) for patronID in book.reservationHeap.entries)
+        entries = self.timers.entries
+        return [(key, entries[key]) for key in keys if key in entries]
+
+    # Method to delete every book with bookID1 <= bookID <= bookID2. The tree is split around the range
+    # and its two outer parts joined back together, so the tree work is O(log n) however many books
+    # go (split_nodes carries black heights down instead of measuring them). Each of the k removed books
+    # then costs O(log n) to leave the author and title indexes (a bisect and a shift within one block,
+    # see NameIndex) and O(1) for the rest, so the delete is O(log n + k log n) in all. Notices are
+    # written in bookID order exactly as DeleteBook writes them, and an empty range writes nothing.
+    def DeleteBooks(self, bookID1, bookID2):
+        for bookID, book in self.cut_range(bookID1, bookID2).iter_items():
+            self.write_deletion_notice(book)
+            self.forget_book(book)
+
+    # Split the books with bookID1 <= bookID <= bookID2 out of the tree and return them as a tree of
+    # their own; the rest of the tree is joined back together. The books are still in book_dict.
+    def cut_range(self, bookID1, bookID2):
+        tree = self.book_index
+        upper = tree.split(bookID2, inclusive=True)
+        removed = tree.split(bookID1)
+        tree.join(upper)
+        self.sorted_ids = None
+        return removed
+
+    # Move the books with bookID1 <= bookID <= bookID2, reservations and all, into a new GatorLibrary
+    # and return it; the inverse of MergeCatalog. No notices are written, since the books still exist.
+    def split_catalog(self, bookID1, bookID2):
+        part = GatorLibrary(OutputSink(stream=NullStream()), self.reservation_capacity, self.render_cache.capacity,
+                            self.index_class.name, loan_period=self.loan_period, reservation_ttl=self.reservation_ttl)
+        part.now = self.now
+        part.book_index = self.cut_range(bookID1, bookID2)
+        timers = []
+        for bookID, book in part.book_index.iter_items():
+            if self.timers:
+                timers.extend(entry for _, entry in self.book_timers(book))
+            self.forget_book(book)
+            part.book_dict[bookID] = book
+            part.patron_index.add_book(book)
+            part.catalog_index.add_book(book)
+        part.timers.restore([(key, deadline) for deadline, _, key in sorted(timers)])
+        return part
+
+    # Method to absorb every book of another GatorLibrary. Its bookIDs must fall between two neighbouring
+    # bookIDs of this library (for example a block above or below the whole catalog), otherwise a
+    # ValueError is raised and neither library changes. The trees are spliced with one split and two
+    # joins in O(log n); book_dict and the patron index then take O(1) per absorbed book and the author
+    # and title indexes O(log n) (see NameIndex), so absorbing k books is O(log n + k log n). The other
+    # library is left empty, and ColorFlipCount counts only this library's
+    # flips, including those made by the joins. The merge is not a command, so it is not journaled:
+    # checkpoint the journal after merging.
+    def MergeCatalog(self, other):
+        incoming = other.book_index
+        if not len(incoming):
+            return 0
+        low = incoming.select_item(1)[0]
+        high = incoming.select_item(len(incoming))[0]
+        tree = self.book_index
+        if tree.count_less(high, inclusive=True) != tree.count_less(low):
+            raise ValueError(f"Books {low} to {high} overlap bookIDs already in the library")
+        if type(incoming) is not type(tree):
+            # Different indexes cannot be spliced, and persistent nodes may be shared with snapshots.
+            converted = type(tree)()
+            converted.build_from_sorted(list(incoming.iter_items()))
+            other.book_index = type(incoming)()
+            incoming = converted
+        upper = tree.split(low)
+        tree.join(incoming)
+        tree.join(upper)
+        for bookID, book in other.book_dict.items():
+            self.book_dict[bookID] = book
+            self.patron_index.add_book(book)
+            self.catalog_index.add_book(book)
+        for key, deadline in other.timers.items():
+            self.timers.schedule(key, deadline)
+        merged = len(other.book_dict)
+        self.sorted_ids = None
+        other.timers = TimerQueue()
+        other.book_dict = {}
+        other.patron_index = PatronIndex()
+        other.catalog_index = CatalogIndex()
+        other.render_cache.clear()
+        other.sorted_ids = None
+        return merged
 
     
     # Method to print details of a book
-    def PrintBook(self, bookID, filename):
+    def PrintBook(self, bookID):
         if bookID in self.book_dict:
-            book = self.book_dict[bookID]
-            availability = "Yes" if book.availabilityStatus else "No"
-            borrowedBy = book.borrowedBy if book.borrowedBy is not None else "None"
-            reservations = [reservation[0] for reservation in book.reservationHeap.heap]
-
-            with open(filename, 'a') as file:
-                file.write(f"BookID = {book.bookID}\n")
-                file.write(f"Title = {book.bookName}\n")
-                file.write(f"Author = {book.authorName}\n")
-                file.write(f"Availability = {availability}\n")
-                file.write(f"BorrowedBy = {borrowedBy}\n")
-                file.write(f"Reservations = {reservations}\n")
+            self.output.write(self.render_book(self.book_dict[bookID]))
         else:
-            with open(filename, 'a') as file:
-                file.write(f"Book {bookID} not found in the Library.\n")
-         # Method to print details of books within a specified range
-    def print_books_in_range(self, node, bookID1, bookID2, filename):
-        if node is not None and node != self.red_black_tree.nil_node:
-            # Traverse the left subtree if the current node's key is greater than bookID1
-            if node.key > bookID1:
-                self.print_books_in_range(node.left_child, bookID1, bookID2, filename)
-
-            # Check if the current node's key is within the range and print details if it is
-            if bookID1 <= node.key <= bookID2:
-                self.PrintBook(node.key, filename)
-
-            # Traverse the right subtree if the current node's key is less than bookID2
-            if node.key < bookID2:
-                self.print_books_in_range(node.right_child, bookID1, bookID2, filename)
+            self.output.write(f"Book {bookID} not found in the Library.\n")
+
+    # Format the six-line record written by PrintBook, PrintBooks and FindClosestBook, reusing the
+    # cached record when the book has not changed since it was last rendered
+    def render_book(self, book):
+        record = self.render_cache.get(book.bookID)
+        if record is None:
+            record = format_book(book)
+            self.render_cache.put(book.bookID, record)
+        return record
+
  # Method to print details of books within a specified range
-    def PrintBooks(self, bookID1, bookID2, filename):
-        self.print_books_in_range(self.red_black_tree.root, bookID1, bookID2, filename)
+    def PrintBooks(self, bookID1, bookID2):
+        write = self.output.write
+        for bookID, book in self.book_index.iter_range(bookID1, bookID2):
+            write(self.render_book(book))
+
+    # Method to set the reservation limit of a single book (None restores the library default)
+    def set_reservation_capacity(self, bookID, capacity):
+        self.book_dict[bookID].reservation_queue().capacity = capacity
+
+    def capacity_of(self, reservation_queue):
+        return self.reservation_capacity if reservation_queue.capacity is None else reservation_queue.capacity
+
+    # Method to count the books with IDs between bookID1 and bookID2 (inclusive) in O(log n)
+    def CountBooks(self, bookID1, bookID2):
+        count = 0
+        if bookID1 <= bookID2:
+            count = self.book_index.count_less(bookID2, inclusive=True) - self.book_index.count_less(bookID1)
+        self.output.write(f"Book Count: {count}\n")
+
+    # Method to report the 1-based position of a book in ID order
+    def Rank(self, bookID):
+        if bookID in self.book_dict:
+            self.output.write(f"Rank of Book {bookID}: {self.book_index.count_less(bookID) + 1}\n")
+        else:
+            self.output.write(f"Book {bookID} not found in the Library.\n")
+
+    # Method to print the k-th book in ID order (1-based)
+    def SelectBook(self, k):
+        item = self.book_index.select_item(k)
+        if item is not None:
+            self.output.write(self.render_book(item[1]))
+        else:
+            self.output.write("No book found.\n")
+
+    # Method to fetch one page of the books with IDs in [bookID1, bookID2], in ID order. Pass the
+    # returned cursor back in to continue after this page; it is None once the range is exhausted.
+    def books_page(self, bookID1, bookID2, limit, cursor=None):
+        start = bookID1 if cursor is None else max(bookID1, cursor)
+        page = []
+        for bookID, book in self.book_index.iter_range(start, bookID2):
+            if len(page) == limit:
+                return page, bookID
+            page.append(book)
+        return page, None
     
+    # Method to cancel a patron's reservation for a book
+    def CancelReservation(self, patronID, bookID):
+        if bookID not in self.book_dict:
+            self.output.write(f"Book {bookID} not found in the Library.\n")
+            return
+
+        book = self.book_dict[bookID]
+        if book.reservationHeap is None or book.reservationHeap.remove_specific_patron(patronID) is None:
+            self.output.write(f"Patron {patronID} has no reservation for Book {bookID}.\n")
+        else:
+            self.patron_index.remove_reservation(patronID, bookID)
+            self.timers.cancel((RESERVATION_TIMER, bookID, patronID))
+            self.render_cache.invalidate(bookID)
+            self.output.write(f"Reservation made by Patron {patronID} for Book {bookID} has been cancelled.\n")
+
+    # Method to change the priority of a patron's reservation for a book
+    def UpdatePriority(self, patronID, bookID, patronPriority):
+        if bookID not in self.book_dict:
+            self.output.write(f"Book {bookID} not found in the Library.\n")
+            return
+
+        book = self.book_dict[bookID]
+        if book.reservationHeap is None or not book.reservationHeap.update_priority(patronID, patronPriority):
+            self.output.write(f"Patron {patronID} has no reservation for Book {bookID}.\n")
+        else:
+            self.render_cache.invalidate(bookID)
+            self.output.write(f"Reservation priority of Patron {patronID} for Book {bookID} updated to {patronPriority}.\n")
+
      # Method to return a borrowed book to the library
-    def ReturnBook(self, patronID, bookID, filename):
+    def ReturnBook(self, patronID, bookID):
         if bookID not in self.book_dict:
-            with open(filename, 'a') as file:
-                file.write(f"Book {bookID} not found in the Library.\n")
+            self.output.write(f"Book {bookID} not found in the Library.\n")
             return
 
         book = self.book_dict[bookID]
 
         if book.borrowedBy != patronID:
-            with open(filename, 'a') as file:
-                file.write(f"Book {bookID} is not borrowed by Patron {patronID}.\n")
+            self.output.write(f"Book {bookID} is not borrowed by Patron {patronID}.\n")
             return
 
         # Book is returned by the patron
         book.availabilityStatus = True
         book.borrowedBy = None
-        with open(filename, 'a') as file:
-            file.write(f"Book {bookID} Returned by Patron {patronID}\n")
+        self.patron_index.remove_loan(patronID, bookID)
+        self.timers.cancel((LOAN_TIMER, bookID, patronID))
+        self.render_cache.invalidate(bookID)
+        self.output.write(f"Book {bookID} Returned by Patron {patronID}\n")
 
         # Check if there are any reservations
-        if book.reservationHeap.heap:
+        if book.reservationHeap:
             next_patron = book.reservationHeap.remove_reservation()
             book.borrowedBy = next_patron[0]  # Assigning the book to the next patron in the reservation heap
             book.availabilityStatus = False
-            with open(filename, 'a') as file:
-                file.write(f"Book {bookID} Allotted to Patron {next_patron[0]}\n")
+            self.patron_index.remove_reservation(next_patron[0], bookID)
+            self.patron_index.add_loan(next_patron[0], bookID)
+            self.timers.cancel((RESERVATION_TIMER, bookID, next_patron[0]))
+            self.schedule_loan(bookID, next_patron[0])
+            self.output.write(f"Book {bookID} Allotted to Patron {next_patron[0]}\n")
+
+    # Give a loan that starts now its due date, when loans have one. Every way a loan is created (BorrowBook,
+    # allotment on ReturnBook, InsertBook or a bulk load of a borrowed book) comes through here.
+    def schedule_loan(self, bookID, patronID):
+        if self.loan_period is not None:
+            self.timers.schedule((LOAN_TIMER, bookID, patronID), self.now + self.loan_period)
+
+    # Method to move library time forward to now and fire every timer due by then, in deadline order:
+    # overdue loans are reported, and expired reservations are cancelled, the next patron in line
+    # moving up. Only the timers that fire are touched, so the cost does not grow with the number of
+    # books, loans or pending timers. Time never goes back; an earlier now is reported and ignored.
+    def Advance(self, now):
+        if now < self.now:
+            self.output.write(f"Library time is already {self.now}.\n")
+            return
+        self.now = now
+        for key, deadline in self.timers.pop_due(now):
+            self.fire_timer(key, deadline)
+
+    # Act on one timer popped by Advance
+    def fire_timer(self, key, deadline):
+        kind, bookID, patronID = key
+        if kind == LOAN_TIMER:
+            self.output.write(f"Book {bookID} borrowed by Patron {patronID} is overdue since {deadline}.\n")
+        else:
+            self.expire_reservation(bookID, patronID)
+
+    def expire_reservation(self, bookID, patronID):
+        reservation_queue = self.book_dict[bookID].reservationHeap
+        was_first = reservation_queue.first_patron() == patronID
+        reservation_queue.remove_specific_patron(patronID)
+        self.patron_index.remove_reservation(patronID, bookID)
+        self.render_cache.invalidate(bookID)
+        self.output.write(f"Reservation made by Patron {patronID} for Book {bookID} has expired.\n")
+        if was_first and reservation_queue:
+            self.output.write(f"Patron {reservation_queue.first_patron()} is now first in line for Book {bookID}.\n")
+
+    # Method to return every book a patron has borrowed, in bookID order
+    def ReturnAll(self, patronID):
+        borrowed = self.patron_index.borrowed_by(patronID)
+        if not borrowed:
+            self.output.write(f"Patron {patronID} has no borrowed books.\n")
+        for bookID in borrowed:
+            self.ReturnBook(patronID, bookID)
+
+    # Methods to print the books by an author or with a title, in bookID order. The match is exact
+    # after normalization (see normalize_name); a trailing '*' turns the query into a prefix search.
+    def FindByAuthor(self, authorName):
+        self.print_books(self.catalog_index.find_author(authorName))
+
+    def FindByTitle(self, bookName):
+        self.print_books(self.catalog_index.find_title(bookName))
+
+    def print_books(self, bookIDs):
+        found = False
+        for bookID in bookIDs:
+            self.output.write(self.render_book(self.book_dict[bookID]))
+            found = True
+        if not found:
+            self.output.write("No book found.\n")
+
+    # Method to print the books a patron has borrowed and reserved
+    def PatronSummary(self, patronID):
+        self.output.write(f"PatronID = {patronID}\n"
+                          f"Borrowed = {self.patron_index.borrowed_by(patronID)}\n"
+                          f"Reserved = {self.patron_index.reserved_by(patronID)}\n")
              
-    def FindClosestBook(self, targetID, filename):
-    # Initialize variables to store the closest books
-        closest_lower = None
-        closest_higher = None
-        closest_lower_diff = float('inf')
-        closest_higher_diff = float('inf')
-
-    # Start from the root of the Red-Black tree
-        current_node = self.red_black_tree.root
-
-        while current_node is not None and current_node != self.red_black_tree.nil_node:
-            current_key_diff = abs(current_node.key - targetID)
-
-            if current_node.key < targetID:
-                if current_key_diff <= closest_lower_diff:
-                    closest_lower_diff = current_key_diff
-                    closest_lower = current_node
-                current_node = current_node.right_child
-            else:
-                if current_key_diff <= closest_higher_diff:
-                    closest_higher_diff = current_key_diff
-                    closest_higher = current_node
-                current_node = current_node.left_child
+    def FindClosestBook(self, targetID):
+        for book in self.closest_books(self.book_index, targetID):
+            self.output.write(self.render_book(book))
 
-        # Determine which book(s) to print based on closeness
-        def print_book_details(book):
-            if book:
-                availability = "Yes" if book.value.availabilityStatus else "No"
-                borrowed_by = book.value.borrowedBy if book.value.borrowedBy is not None else "None"
-                reservations = [reservation[0] for reservation in book.value.reservationHeap.heap]
-                with open(filename, 'a') as file:
-                    file.write(f"BookID = {book.key}\n")
-                    file.write(f"Title = {book.value.bookName}\n")
-                    file.write(f"Author = {book.value.authorName}\n")
-                    file.write(f"Availability = {availability}\n")
-                    file.write(f"BorrowedBy = {borrowed_by}\n")
-                    file.write(f"Reservations = {reservations}\n")
-            else:
-                with open(filename, 'a') as file:
-                    file.write(f"No book found.\n")
+    # Return the books FindClosestBook prints for targetID, looked up in index (the library's own index or
+    # a snapshot version of it): the closest one, or the lower and the higher one when they tie
+    def closest_books(self, index, targetID):
+    # The closest books below and at-or-above the target
+        closest_lower = index.predecessor(targetID)
+        closest_higher = index.successor(targetID)
+        closest_lower_diff = targetID - closest_lower[0] if closest_lower else float('inf')
+        closest_higher_diff = closest_higher[0] - targetID if closest_higher else float('inf')
 
+        # Determine which book(s) to print based on closeness
         if closest_lower_diff == closest_higher_diff:
         # Print both books in case of a tie
-            if closest_lower:
-                print_book_details(closest_lower)
-            if closest_higher:
-                print_book_details(closest_higher)
+            return [item[1] for item in (closest_lower, closest_higher) if item]
         elif closest_lower_diff < closest_higher_diff:
             # Print closest lower book
-            print_book_details(closest_lower)
+            return [closest_lower[1]]
         else:
         # Print closest higher book
-            print_book_details(closest_higher)
+            return [closest_higher[1]]
 
     
+    # Resolve many FindClosestBook targets at once against a sorted array of the bookIDs, which is
+    # built on first use and reused until the next InsertBook or DeleteBook. The targets are sorted
+    # (in O(m) if they already are) and merged with the array in one pass of two pointers, so a batch
+    # costs O(m log m + n) for m targets and n books; a handful of targets is cheaper one at a time
+    # with FindClosestBook. Returns, for each target in input order, a tuple of the closest bookIDs:
+    # one, or the lower and higher IDs when they are equally close, following FindClosestBook's rule.
+    def batch_find_closest(self, targets):
+        if self.sorted_ids is None:
+            self.sorted_ids = [bookID for bookID, book in self.book_index.iter_items()]
+        bookIDs = self.sorted_ids
+        results = [()] * len(targets)
+        if not bookIDs:
+            return results
+        position = 0
+        count = len(bookIDs)
+        for index in sorted(range(len(targets)), key=targets.__getitem__):
+            target = targets[index]
+            while position < count and bookIDs[position] < target:
+                position += 1
+            # bookIDs[position] is the closest ID >= target, bookIDs[position - 1] the closest ID below it.
+            if position == count:
+                results[index] = (bookIDs[-1],)
+            elif position == 0:
+                results[index] = (bookIDs[0],)
+            else:
+                lower_diff = target - bookIDs[position - 1]
+                higher_diff = bookIDs[position] - target
+                if lower_diff == higher_diff:
+                    results[index] = (bookIDs[position - 1], bookIDs[position])
+                elif lower_diff < higher_diff:
+                    results[index] = (bookIDs[position - 1],)
+                else:
+                    results[index] = (bookIDs[position],)
+        return results
+
+    # Method to print the FindClosestBook result for every target, in input order
+    def BatchFindClosest(self, targets):
+        write = self.output.write
+        for bookIDs in self.batch_find_closest(targets):
+            for bookID in bookIDs:
+                write(self.render_book(self.book_dict[bookID]))
+
     def ColorFlipCount(self):
-        # Access the color_flip_count from the Red-Black tree
-        return self.red_black_tree.color_flip_count
+        # Access the color_flip_count from the Red-Black tree; None if the index does not count flips
+        return self.book_index.color_flip_count
+
+    # Collect the library's internal metrics as a JSON-serializable dict: the index's shape and, for the
+    # red-black tree, rebalancing counters (see index_stats), the distribution of reservation queue depths (number of books per depth), the render
+    # cache, the timers and, when self.stats is set, per-command counts and latencies. The tree height and the
+    # queue depths are computed here in O(n), so the metrics cost nothing until they are asked for.
+    def stats_snapshot(self):
+        depths = Counter(len(book.reservationHeap) if book.reservationHeap else 0 for book in self.book_dict.values())
+        return {
+            "index": {"type": self.book_index.name, **self.book_index.index_stats()},
+            "reservation_queue_depths": dict(sorted(depths.items())),
+            "render_cache": self.render_cache.stats(),
+            "timers": {"now": self.now, "pending": len(self.timers), "heap_entries": len(self.timers.heap)},
+            "commands": self.stats.snapshot() if self.stats is not None else {},
+        }
+
+    # Method to print the metrics of stats_snapshot
+    def Stats(self):
+        self.output.write(format_stats(self.stats_snapshot()))
+
+    # Method to write the full library state to a compact binary snapshot (see SNAPSHOT_HEADER).
+    # The file is written next to path and renamed into place, so a crash never leaves a torn snapshot.
+    def save_snapshot(self, path):
+        records = bytearray()
+        reservations = bytearray()
+        strings = bytearray()
+        reservation_count = 0
+        for node, depth in self.book_index.iter_layout():
+            bookID, book = node.key, node.value
+            title = book.bookName.encode("utf-8")
+            author = book.authorName.encode("utf-8")
+            queue = book.reservationHeap
+            heap = sorted(queue.entries.values()) if queue else ()
+            capacity = queue.capacity if queue is not None else None
+            flags = ((SNAPSHOT_AVAILABLE if book.availabilityStatus else 0) | (SNAPSHOT_BORROWED if book.borrowedBy is not None else 0)
+                     | (SNAPSHOT_RED if node.node_color == RED else 0) | (SNAPSHOT_CAPACITY if capacity is not None else 0))
+            records += SNAPSHOT_BOOK.pack(bookID, book.borrowedBy or 0, len(strings), len(title), len(author), len(heap),
+                                          flags, depth, capacity or 0)
+            strings += title
+            strings += author
+            for priority, seq, patronID in heap:
+                reservations += SNAPSHOT_RESERVATION.pack(patronID, priority, seq)
+            reservation_count += len(heap)
+        timers = self.timers.items()
+
+        temporary_path = f"{path}.tmp"
+        with open(temporary_path, 'wb') as file:
+            file.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, self.reservation_capacity,
+                                            self.book_index.color_flip_count or 0, len(self.book_dict),
+                                            reservation_count, len(strings)))
+            file.write(SNAPSHOT_CLOCK.pack(self.now, len(timers)))
+            file.write(records)
+            file.write(reservations)
+            file.write(strings)
+            file.write(b"".join(SNAPSHOT_TIMER.pack(bookID, patronID, deadline, kind)
+                                for (kind, bookID, patronID), deadline in timers))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporary_path, path)
+
+    # Method to replace the library state with a snapshot written by save_snapshot. The file is read
+    # through mmap and the tree is rebuilt in one sorted pass instead of per-key inserts, with the same
+    # shape and colors it had when saved so later ColorFlipCount results match an uninterrupted run.
+    def load_snapshot(self, path):
+        with open(path, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as view:
+            if len(view) < SNAPSHOT_HEADER.size:
+                raise ValueError(f"{path} is not a Gator Library snapshot")
+            magic, version, reservation_capacity, color_flip_count, book_count, reservation_count, strings_size = SNAPSHOT_HEADER.unpack_from(view, 0)
+            if magic != SNAPSHOT_MAGIC:
+                raise ValueError(f"{path} is not a Gator Library snapshot")
+            if version == 1:
+                book_format, reservation_format, reservation_capacity = SNAPSHOT_BOOK_V1, SNAPSHOT_RESERVATION_V1, 20
+            elif version in (2, SNAPSHOT_VERSION):
+                book_format, reservation_format = SNAPSHOT_BOOK, SNAPSHOT_RESERVATION
+            else:
+                raise ValueError(f"Unsupported snapshot version {version} in {path}")
+            books_start, now, timer_count = SNAPSHOT_HEADER.size, 0, 0
+            if version == SNAPSHOT_VERSION:
+                if len(view) < books_start + SNAPSHOT_CLOCK.size:
+                    raise ValueError(f"Snapshot {path} is truncated or corrupt")
+                now, timer_count = SNAPSHOT_CLOCK.unpack_from(view, books_start)
+                books_start += SNAPSHOT_CLOCK.size
+            reservations_start = books_start + book_count * book_format.size
+            strings_start = reservations_start + reservation_count * reservation_format.size
+            timers_start = strings_start + strings_size
+            if len(view) != timers_start + timer_count * SNAPSHOT_TIMER.size:
+                raise ValueError(f"Snapshot {path} is truncated or corrupt")
+            timers = [((kind, bookID, patronID), deadline)
+                      for bookID, patronID, deadline, kind in SNAPSHOT_TIMER.iter_unpack(view[timers_start:])]
+
+            reservation_entries = reservation_format.iter_unpack(view[reservations_start:strings_start])
+            book_dict = {}
+            entries = []
+            for bookID, borrowedBy, offset, title_length, author_length, heap_size, flags, depth, *capacity in book_format.iter_unpack(view[books_start:reservations_start]):
+                offset += strings_start
+                title = view[offset:offset + title_length].decode("utf-8")
+                offset += title_length
+                author = view[offset:offset + author_length].decode("utf-8")
+                book = self.new_book(bookID, title, author, bool(flags & SNAPSHOT_AVAILABLE),
+                                     borrowedBy if flags & SNAPSHOT_BORROWED else None)
+                if heap_size:
+                    reservations = [next(reservation_entries) for _ in range(heap_size)]
+                    if version == 1:
+                        # Version 1 stored timestamps; turn their order into sequence numbers.
+                        reservations.sort(key=lambda reservation: (reservation[1], reservation[2]))
+                        reservations = [(patronID, priority, seq) for seq, (patronID, priority, timestamp) in enumerate(reservations)]
+                    book.reservation_queue().restore(reservations)
+                if flags & SNAPSHOT_CAPACITY:
+                    book.reservation_queue().capacity = capacity[0]
+                book_dict[bookID] = book
+                entries.append((bookID, book, depth, RED if flags & SNAPSHOT_RED else BLACK))
+
+        self.book_dict = book_dict
+        self.reservation_capacity = reservation_capacity
+        self.patron_index = PatronIndex()
+        for book in book_dict.values():
+            self.patron_index.add_book(book)
+        self.catalog_index = CatalogIndex()
+        self.catalog_index.rebuild(book_dict)
+        self.now = now
+        self.timers = TimerQueue()
+        self.timers.restore(timers)
+        if version < SNAPSHOT_VERSION:
+            # Older snapshots have no due dates, so their loans start over at the time of the load.
+            for bookID, book in book_dict.items():
+                if book.borrowedBy is not None:
+                    self.schedule_loan(bookID, book.borrowedBy)
+        self.render_cache.clear()
+        self.sorted_ids = None
+        self.book_index = self.index_class()
+        self.book_index.build_from_layout(entries)
+        if self.book_index.color_flip_count is not None:
+            self.book_index.color_flip_count = color_flip_count
+
+    # Return a LibrarySnapshot of the books as they are now; O(1). Needs the "persistent" index. Its
+    # queries write to output when one is given and otherwise return the text they render.
+    def snapshot(self, output=None):
+        if self.index_class is not PersistentRedBlackTree:
+            raise ValueError('Snapshots need a GatorLibrary created with index="persistent"')
+        return LibrarySnapshot(self, self.book_index.version(), output)
+
+# Define a class for a read-only view of a persistent library's catalog at one moment. It holds one
+# root version of the tree, so PrintBooks, FindClosestBook and books() see the same set of books however
+# the library changes meanwhile, and need no lock. The version is freed once every snapshot holding it
+# has been released (or garbage collected). Records are rendered from the live Book objects, without
+# the render cache, so loans and reservations are as of the rendering: a book whose BorrowBook or
+# ReturnBook is running on another thread at that moment may show a mix of its old and new state.
+class LibrarySnapshot:
+    def __init__(self, library, tree, output=None):
+        self.library = library
+        self.tree = tree
+        # Where PrintBooks and FindClosestBook write, or None to have them return their text. The
+        # library's own output is never used: under ConcurrentLibrary it belongs to execute().
+        self.output = output
+
+    # Write text to the snapshot's output, or return it when there is none
+    def emit(self, text):
+        if self.output is None:
+            return text
+        self.output.write(text)
+
+    def __len__(self):
+        return len(self.tree)
+
+    # Iterate over the (bookID, Book) pairs with bookID1 <= bookID <= bookID2 in bookID order
+    def books(self, bookID1=float('-inf'), bookID2=float('inf')):
+        return self.tree.iter_range(bookID1, bookID2)
+
+    def PrintBooks(self, bookID1, bookID2):
+        return self.emit("".join(format_book(book) for bookID, book in self.tree.iter_range(bookID1, bookID2)))
+
+    def FindClosestBook(self, targetID):
+        return self.emit("".join(format_book(book) for book in self.library.closest_books(self.tree, targetID)))
+
+    # Drop the version; the snapshot cannot be used afterwards
+    def release(self):
+        self.tree = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
 
     
-# Assuming the GatorLibrary class and its methods are already defined as per your specifications
+# Command parsing and dispatch
+
+# One pass per line: the command name and the raw text between the parentheses.
+COMMAND_PATTERN = re.compile(r'\s*(\w+)\s*\((.*)\)\s*$')
+# Arguments are either double-quoted strings (which may contain commas) or bare tokens.
+ARGUMENT_PATTERN = re.compile(r'"[^"]*"|[^,\s][^,]*')
+
+def parse_availability(token):
+    return token.strip('"') == "Yes"
 
-# Create an instance of GatorLibrary
+def write_color_flip_count(library):
+    flips = library.ColorFlipCount()
+    if flips is None:
+        library.output.write(f'Color Flip Count: not counted by the {library.index_class.name} index\n')
+    else:
+        library.output.write(f'Color Flip Count: {flips}\n')
 
-# def process_string(s):
-#     return [chunk for chunk in s.replace('(', ' ').replace(',', ' ').replace(')', ' ').split() if chunk]
+def quit_library(library):
+    library.output.write('Program Terminated!!\n')
+    library.output.flush()
 
-def process_string(s):
-    vec = [""]
-    for c in s:
-        if c == '(' or c == ',' or c == ')':
-            vec.append("")
+# Command name -> (handler called as handler(library, *args), argument converters)
+COMMANDS = {
+    'InsertBook': (GatorLibrary.InsertBook, (int, str, str, parse_availability)),
+    'PrintBook': (GatorLibrary.PrintBook, (int,)),
+    'PrintBooks': (GatorLibrary.PrintBooks, (int, int)),
+    'BorrowBook': (GatorLibrary.BorrowBook, (int, int, int)),
+    'ReturnBook': (GatorLibrary.ReturnBook, (int, int)),
+    'ReturnAll': (GatorLibrary.ReturnAll, (int,)),
+    'PatronSummary': (GatorLibrary.PatronSummary, (int,)),
+    'DeleteBook': (GatorLibrary.DeleteBook, (int,)),
+    'DeleteBooks': (GatorLibrary.DeleteBooks, (int, int)),
+    'CancelReservation': (GatorLibrary.CancelReservation, (int, int)),
+    'UpdatePriority': (GatorLibrary.UpdatePriority, (int, int, int)),
+    'FindClosestBook': (GatorLibrary.FindClosestBook, (int,)),
+    'FindByAuthor': (GatorLibrary.FindByAuthor, (str,)),
+    'FindByTitle': (GatorLibrary.FindByTitle, (str,)),
+    'CountBooks': (GatorLibrary.CountBooks, (int, int)),
+    'Rank': (GatorLibrary.Rank, (int,)),
+    'SelectBook': (GatorLibrary.SelectBook, (int,)),
+    'Advance': (GatorLibrary.Advance, (int,)),
+    'ColorFlipCount': (write_color_flip_count, ()),
+    'Stats': (GatorLibrary.Stats, ()),
+    'Quit': (quit_library, ()),
+}
+
+# Commands that change library state; only these are written to the journal
+MUTATING_COMMANDS = {'InsertBook', 'BorrowBook', 'ReturnBook', 'ReturnAll', 'DeleteBook', 'DeleteBooks',
+                     'CancelReservation', 'UpdatePriority', 'Advance'}
+
+def format_argument(convert, value):
+    if convert is parse_availability:
+        return '"Yes"' if value else '"No"'
+    return str(value)
+
+# Render a parsed command back into the command language; parse_command(format_command(...)) round-trips
+def format_command(name, args):
+    converters = COMMANDS[name][1]
+    return f"{name}({', '.join(format_argument(convert, value) for convert, value in zip(converters, args))})"
+
+# Parse a single command line into (name, handler, typed arguments); returns None for blank lines
+def parse_command(line):
+    match = COMMAND_PATTERN.match(line)
+    if match is None:
+        if line.strip():
+            raise ValueError(f"Malformed command: {line.strip()!r}")
+        return None
+    name, argument_text = match.groups()
+    if name not in COMMANDS:
+        raise ValueError(f"Unknown command: {name!r}")
+    handler, converters = COMMANDS[name]
+    tokens = ARGUMENT_PATTERN.findall(argument_text)
+    if len(tokens) != len(converters):
+        raise ValueError(f"{name} expects {len(converters)} arguments, got {len(tokens)}")
+    return name, handler, [convert(token.rstrip()) for convert, token in zip(converters, tokens)]
+
+# Lazily parse any iterable of lines, so arbitrarily large command logs stream in constant memory. A
+# line that does not parse raises ValueError, unless on_error is given: then on_error(error) is called
+# in its place and the line is skipped.
+def parse_commands(lines, on_error=None):
+    for line_number, line in enumerate(lines, 1):
+        try:
+            command = parse_command(line)
+        except ValueError as error:
+            if on_error is None:
+                raise ValueError(f"Line {line_number}: {error}") from None
+            on_error(error)
+            continue
+        if command is not None:
+            yield command
+
+# Run every command from lines against the library, flushing output according to its sink's policy.
+# With a journal, state-changing commands are logged before they are applied. Commands are timed
+# only when library.stats is set. A line that does not parse writes "Error: <reason>" (as server.py
+# answers it) and is skipped, or with strict raises ValueError. The first skip commands are passed
+# over without running (see main's --resume). Returns the number of commands read.
+def run_commands(library, lines, verbose=False, journal=None, strict=False, skip=0):
+    def report(error):
+        if count >= skip:  # Lines among the skipped commands were reported by the run that read them.
+            library.output.write(f"Error: {error}\n")
+            library.output.end_command()
+
+    stats = library.stats
+    count = 0
+    for count, (name, handler, args) in enumerate(parse_commands(lines, None if strict else report), 1):
+        if count <= skip:
+            continue
+        if verbose:
+            print([name, *args])
+        if journal is not None and name in MUTATING_COMMANDS:
+            journal.append(format_command(name, args), count)
+        if stats is None:
+            handler(library, *args)
+        else:
+            stats.run(name, handler, library, args)
+        library.output.end_command()
+        if journal is not None:
+            journal.maybe_checkpoint(library)
+    return count
+
+# Define a class for the write-ahead journal of state-changing commands.
+#
+# The journal directory holds checkpoint-<seq>.snap files (library snapshots taken after command
+# <seq>) and journal-<seq>.log segments whose first record is command <seq>. Each record is one line,
+# "<seq> <crc32> <command>", so a torn final write is detected and discarded on startup. Commands run
+# from a command file also record their position in it, as "<seq>:<position> <crc32> <command>", and
+# a checkpoint starts its segment with a "<seq>:<position> <crc32> " mark carrying the position on;
+# position then tells how much of an interrupted file the journal holds (see main's --resume).
+# Records are group-committed: they are buffered and written with a single fsync once sync_every
+# records are pending or sync_interval seconds have passed since the first of them was appended. A
+# flusher thread makes that sync happen even if no further record arrives.
+class CommandJournal:
+    def __init__(self, directory, sync_every=64, sync_interval=0.05, checkpoint_every=100000):
+        self.directory = directory
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self.checkpoint_every = checkpoint_every
+        self.pending = []
+        self.last_sync = time.monotonic()
+        self.lock = threading.RLock()  # The flusher commits from a thread of its own.
+        self.wake = threading.Condition(self.lock)
+        self.flusher = None
+        self.commands_since_checkpoint = 0
+        os.makedirs(directory, exist_ok=True)
+
+        self.checkpoint_seq = max(self.list_files("checkpoint-", ".snap"), default=0)
+        segments = self.list_files("journal-", ".log")
+        self.last_seq = self.checkpoint_seq
+        self.position = None  # Input position of the last journaled command, if it came from a file.
+        if segments:
+            last_segment = self.segment_path(segments[-1])
+            for seq, position, command in self.read_segment(last_segment, truncate=True):
+                self.last_seq, self.position = seq, position
+            self.last_seq = max(self.last_seq, segments[-1] - 1)
+            if len(segments) > 1 and not os.path.getsize(last_segment):
+                # A checkpoint stopped before its mark: the previous segment still has the position.
+                for seq, position, command in self.read_segment(self.segment_path(segments[-2])):
+                    self.position = position
+            self.file = open(last_segment, 'ab')
+        else:
+            self.file = open(self.segment_path(self.last_seq + 1), 'ab')
+
+    def list_files(self, prefix, suffix):
+        return sorted(int(name[len(prefix):-len(suffix)]) for name in os.listdir(self.directory)
+                      if name.startswith(prefix) and name.endswith(suffix))
+
+    def segment_path(self, seq):
+        return os.path.join(self.directory, f"journal-{seq:016d}.log")
+
+    def checkpoint_path(self, seq):
+        return os.path.join(self.directory, f"checkpoint-{seq:016d}.snap")
+
+    # Yield (seq, input position or None, command) for every intact record, with an empty command for
+    # a checkpoint's mark; with truncate, a torn tail is cut off the file
+    def read_segment(self, path, truncate=False):
+        good_size = 0
+        with open(path, 'rb') as file:
+            for raw in file:
+                try:
+                    head, crc, command = raw.rstrip(b"\n").decode("utf-8").split(" ", 2)
+                    valid = raw.endswith(b"\n") and int(crc, 16) == zlib.crc32(f"{head} {command}".encode("utf-8"))
+                    seq, _, position = head.partition(":")
+                    seq, position = int(seq), int(position) if position else None
+                except ValueError:
+                    valid = False
+                if not valid:
+                    break
+                good_size += len(raw)
+                yield seq, position, command
+        if truncate and good_size != os.path.getsize(path):
+            with open(path, 'r+b') as file:
+                file.truncate(good_size)
+
+    @staticmethod
+    def encode(seq, position, command):
+        head = f"{seq}" if position is None else f"{seq}:{position}"
+        return f"{head} {zlib.crc32(f'{head} {command}'.encode('utf-8')):08x} {command}\n".encode("utf-8")
+
+    # Log a state-changing command, with its position in the command file it came from if any; it
+    # becomes durable at the next group commit
+    def append(self, command, position=None):
+        with self.lock:
+            self.last_seq += 1
+            self.position = position
+            self.pending.append(self.encode(self.last_seq, position, command))
+            self.commands_since_checkpoint += 1
+            if len(self.pending) >= self.sync_every or time.monotonic() - self.last_sync >= self.sync_interval:
+                self.commit()
+            elif len(self.pending) == 1 and self.sync_interval < float("inf"):
+                self.last_sync = time.monotonic()
+                if self.flusher is None:
+                    self.flusher = threading.Thread(target=self.flush_loop, daemon=True)
+                    self.flusher.start()
+                self.wake.notify()
+
+    # Flusher thread: commit the pending records once the first of them is sync_interval old
+    def flush_loop(self):
+        with self.lock:
+            while self.file is not None:
+                if not self.pending:
+                    self.wake.wait()
+                    continue
+                remaining = self.last_sync + self.sync_interval - time.monotonic()
+                if remaining > 0:
+                    self.wake.wait(remaining)
+                else:
+                    self.commit()
+
+    # Write all pending records and make them durable with one fsync
+    def commit(self):
+        with self.lock:
+            if self.pending and self.file is not None:
+                self.file.write(b"".join(self.pending))
+                self.pending.clear()
+                self.file.flush()
+                os.fsync(self.file.fileno())
+            self.last_sync = time.monotonic()
+
+    def maybe_checkpoint(self, library):
+        if self.commands_since_checkpoint >= self.checkpoint_every:
+            self.checkpoint(library)
+
+    # Snapshot the library, start a new journal segment and drop the files the snapshot supersedes
+    def checkpoint(self, library):
+        with self.lock:
+            self.commit()
+            library.save_snapshot(self.checkpoint_path(self.last_seq))
+            self.file.close()
+            self.file = open(self.segment_path(self.last_seq + 1), 'ab')
+            if self.position is not None:
+                self.pending.append(self.encode(self.last_seq, self.position, ""))
+                self.commit()
+            for seq in self.list_files("checkpoint-", ".snap"):
+                if seq < self.last_seq:
+                    os.remove(self.checkpoint_path(seq))
+            for seq in self.list_files("journal-", ".log"):
+                if seq <= self.last_seq:
+                    os.remove(self.segment_path(seq))
+            self.checkpoint_seq = self.last_seq
+            self.commands_since_checkpoint = 0
+
+    # Load the latest checkpoint into the library and replay only the journal records after it.
+    # Output produced while replaying is discarded, since it was already written the first time.
+    def recover(self, library):
+        if self.checkpoint_seq:
+            library.load_snapshot(self.checkpoint_path(self.checkpoint_seq))
+        output = library.output
+        library.output = OutputSink(stream=NullStream())
+        replayed = 0
+        try:
+            for segment in self.list_files("journal-", ".log"):
+                for seq, position, command in self.read_segment(self.segment_path(segment)):
+                    if seq <= self.checkpoint_seq or not command:
+                        continue
+                    name, handler, args = parse_command(command)
+                    handler(library, *args)
+                    replayed += 1
+        finally:
+            library.output = output
+        self.commands_since_checkpoint = replayed
+        return replayed
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.commit()
+                self.file.close()
+                self.file = None
+                self.wake.notify()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+# Define a reader-writer lock: any number of readers or a single writer. A waiting writer holds back
+# new readers, so a steady stream of reads cannot starve mutations.
+class ReadWriteLock:
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.readers = 0
+        self.writing = False
+        self.waiting_writers = 0
+
+    def acquire_read(self):
+        with self.condition:
+            while self.writing or self.waiting_writers:
+                self.condition.wait()
+            self.readers += 1
+
+    def release_read(self):
+        with self.condition:
+            self.readers -= 1
+            if not self.readers:
+                self.condition.notify_all()
+
+    def acquire_write(self):
+        with self.condition:
+            self.waiting_writers += 1
+            while self.writing or self.readers:
+                self.condition.wait()
+            self.waiting_writers -= 1
+            self.writing = True
+
+    def release_write(self):
+        with self.condition:
+            self.writing = False
+            self.condition.notify_all()
+
+    @contextmanager
+    def read_locked(self):
+        self.acquire_read()
+        try:
+            yield
+        finally:
+            self.release_read()
+
+    @contextmanager
+    def write_locked(self):
+        self.acquire_write()
+        try:
+            yield
+        finally:
+            self.release_write()
+
+# Commands that only read library state; ConcurrentLibrary runs them in parallel under the read lock
+READ_ONLY_COMMANDS = {'PrintBook', 'PrintBooks', 'FindClosestBook', 'FindByAuthor', 'FindByTitle', 'CountBooks',
+                      'Rank', 'SelectBook', 'PatronSummary', 'ColorFlipCount', 'Stats'}
+
+# Define a class serving one in-memory library to many threads. Read-only commands share a
+# ReadWriteLock and run in parallel; every other command holds it exclusively, so mutations are
+# linearizable and each read sees the state between two of them. Each command's output is collected
+# separately and returned to its caller. With a journal, state-changing commands are logged under the
+# write lock exactly as run_commands logs them.
+class ConcurrentLibrary:
+    def __init__(self, library=None, threads=8, journal=None):
+        self.library = library if library is not None else GatorLibrary()
+        self.library.output = ThreadOutput()
+        self.library.render_cache = LockedRenderCache(self.library.render_cache.capacity)
+        self.lock = ReadWriteLock()
+        self.journal = journal
+        self.executor = ThreadPoolExecutor(threads)
+
+    # Run one command line on the calling thread and return its output
+    def execute(self, line):
+        command = parse_command(line)
+        if command is None:
+            return ""
+        name, handler, args = command
+        buffer = io.StringIO()
+        self.library.output.redirect(buffer)
+        if name in READ_ONLY_COMMANDS:
+            with self.lock.read_locked():
+                handler(self.library, *args)
         else:
-            vec[-1] += c
-    vec.pop()
-    return vec
-
-if len(sys.argv) != 2:
-    print("Usage: python main.py filename")
-    sys.exit(1)
-
-filename = sys.argv[1]
-
-library = GatorLibrary()
-
-with open(filename, 'r') as file:
-    output = f'{filename}_output_file.txt'
-    for line in file:
-        x = line.strip()
-        X = process_string(x)
-        print(X)
-        if X[0] == 'InsertBook':
-            library.InsertBook(int(X[1]), X[2], X[3],output, X[4].strip()[1: 4] == "Yes")
-        elif X[0] == 'PrintBook':
-            library.PrintBook(int(X[1]), output)
-        elif X[0] == 'BorrowBook':
-            library.BorrowBook(int(X[1]), int(X[2]), int(X[3]), output)
-        elif X[0] == 'PrintBooks':
-            library.PrintBooks(int(X[1]), int(X[2]), output)
-        elif X[0] == 'FindClosestBook':
-            library.FindClosestBook(int(X[1]), output)
-        elif X[0] == 'ColorFlipCount':
-            with open(output, 'a') as file:
-                file.write(f'Color Flip Count: {library.ColorFlipCount()}\n')
-        elif X[0] == 'DeleteBook':
-            library.DeleteBook(int(X[1]), output)
-        elif X[0] == 'Quit':
-            with open(output, 'a') as file:
-                file.write(f'Program Terminated!!\n')
-        elif X[0] == 'ReturnBook':
-            library.ReturnBook(int(X[1]), int(X[2]), output)
+            with self.lock.write_locked():
+                if self.journal is not None and name in MUTATING_COMMANDS:
+                    self.journal.append(format_command(name, args))
+                handler(self.library, *args)
+                if self.journal is not None:
+                    self.journal.maybe_checkpoint(self.library)
+        return buffer.getvalue()
+
+    # Take a LibrarySnapshot between two mutations. Scanning it needs no lock, so writers are not held
+    # up by long PrintBooks or exports; the library must have been created with index="persistent".
+    # Without an output, the snapshot's queries return their text, so any thread may use it.
+    def snapshot(self, output=None):
+        with self.lock.read_locked():
+            return self.library.snapshot(output)
+
+    # Run one command line on the thread pool; the future's result is its output
+    def submit(self, line):
+        return self.executor.submit(self.execute, line)
+
+    # Run many command lines on the thread pool, yielding their outputs in input order
+    def map(self, lines):
+        return self.executor.map(self.execute, lines)
+
+    def close(self):
+        self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+# Read a catalog file made of InsertBook commands as load_catalog records
+def read_catalog(lines):
+    for name, handler, args in parse_commands(lines):
+        if name != 'InsertBook':
+            raise ValueError(f"Catalog files may only contain InsertBook commands, found {name}")
+        yield args
+
+def parse_flush_policy(value):
+    if value in ("command", "quit"):
+        return value
+    return int(value)
+
+def main(argv=None):
+    global DEBUG
+    parser = argparse.ArgumentParser(description="Run a Gator Library command file.")
+    parser.add_argument("filename")
+    parser.add_argument("--flush", type=parse_flush_policy, default="command",
+                        help='output flush policy: "command", "quit" or every N commands')
+    parser.add_argument("-v", "--verbose", action="store_true", help="print every parsed command")
+    parser.add_argument("--strict", action="store_true",
+                        help="stop at the first line that does not parse instead of reporting it and going on")
+    parser.add_argument("--reservation-capacity", type=int, default=20, metavar="N",
+                        help="maximum number of reservations per book")
+    parser.add_argument("--render-cache", type=int, default=4096, metavar="N",
+                        help="number of rendered book records to cache (0 disables the cache)")
+    parser.add_argument("--loan-period", type=int, metavar="T",
+                        help="loans fall due T library time units after they start (see Advance)")
+    parser.add_argument("--reservation-ttl", type=int, metavar="T",
+                        help="reservations expire T library time units after they are made")
+    parser.add_argument("--catalog", help="file of InsertBook commands bulk-loaded before the command file")
+    parser.add_argument("--restore", metavar="SNAPSHOT", help="load a library snapshot before running commands")
+    parser.add_argument("--save", metavar="SNAPSHOT", help="save a library snapshot after running commands")
+    parser.add_argument("--journal", metavar="DIR",
+                        help="recover from and write a journal of state-changing commands in DIR; every command "
+                             "of the file is run on top of the recovered state, so pass new commands only")
+    parser.add_argument("--resume", action="store_true",
+                        help="with --journal, rerun an interrupted command file: skip the commands of it "
+                             "the journal already holds")
+    parser.add_argument("--checkpoint-every", type=int, default=100000, metavar="N",
+                        help="checkpoint the journal every N state-changing commands")
+    parser.add_argument("--sync-every", type=int, default=64, metavar="N",
+                        help="group-commit the journal every N state-changing commands")
+    parser.add_argument("--debug", action="store_true", help="trace red-black tree deletions on stdout")
+    parser.add_argument("--stats", metavar="FILE",
+                        help="time every command and write all library metrics to FILE as JSON at exit")
+    parser.add_argument("--profile", metavar="COMMANDS", type=lambda value: value.split(","), default=[],
+                        help='comma-separated command names (or "all") to run under cProfile; '
+                             'writes filename_profile_<Command>.pstats at exit')
+    parser.add_argument("--index", choices=ORDERED_INDEXES, default="redblack",
+                        help="ordered index for the books; only redblack counts color flips")
+    parser.add_argument("--columnar", action="store_true",
+                        help="keep titles and authors of new books in a columnar MetadataStore")
+    parser.add_argument("--metadata", metavar="FILE",
+                        help="start from the books of a metadata file, memory-mapped read-only")
+    parser.add_argument("--save-metadata", metavar="FILE", help="write the books' titles and authors to FILE at exit")
+    args = parser.parse_args(argv)
+    DEBUG = args.debug
+
+    with open(args.filename, 'r') as file, OutputSink(f'{args.filename}_output_file.txt', args.flush) as output:
+        library = GatorLibrary(output, args.reservation_capacity, args.render_cache, args.index,
+                               MetadataStore() if args.columnar else None, args.loan_period, args.reservation_ttl)
+        if args.metadata:
+            library.load_metadata(MetadataStore.open(args.metadata))
+        if args.stats or args.profile:
+            library.stats = CommandStats(args.profile)
+        journal = None
+        if args.journal:
+            journal = CommandJournal(args.journal, args.sync_every, checkpoint_every=args.checkpoint_every)
+            journal.recover(library)
+        if args.restore:
+            library.load_snapshot(args.restore)
+        if args.catalog:
+            with open(args.catalog, 'r') as catalog:
+                library.load_catalog(read_catalog(catalog))
+        if journal is not None and (args.restore or args.catalog):
+            # Bulk loads bypass the journal, so make them durable with a checkpoint.
+            journal.checkpoint(library)
+        skip = 0
+        if args.resume:
+            if journal is None:
+                parser.error("--resume needs --journal")
+            skip = journal.position or 0
+        try:
+            run_commands(library, file, args.verbose, journal, args.strict, skip)
+        finally:
+            if journal is not None:
+                journal.close()
+        if args.save:
+            library.save_snapshot(args.save)
+        if args.save_metadata:
+            library.save_metadata(args.save_metadata)
+        if library.stats is not None:
+            library.stats.dump_profiles(f'{args.filename}_profile_')
+        if args.stats:
+            with open(args.stats, 'w') as stats_file:
+                json.dump(library.stats_snapshot(), stats_file, indent=2)
+
+if __name__ == "__main__":
+    main()
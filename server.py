@@ -0,0 +1,216 @@
+# Gator Library command server
+#
+# Usage: python server.py --tcp 127.0.0.1:7070 [--journal DIR] [--restore SNAPSHOT] [--catalog FILE] [--save SNAPSHOT]
+#        python server.py --unix /tmp/gator.sock ...
+#
+# Clients send commands in the command-file syntax, one per line. Every command gets one response: the
+# output the command file run would have written for it, followed by an empty line. A line that does
+# not parse gets "Error: <reason>". Requests on a connection may be pipelined; their responses come
+# back in request order. Quit answers "Program Terminated!!" and closes that connection only. Sending
+# all of examples/regression.txt at once gets back examples/regression_expected.txt, with an empty line
+# after each response.
+#
+# Read-only commands run straight away on the event loop. Every other command is queued for a single
+# writer task that journals it (with --journal) and applies it. The writer group-commits each batch of
+# queued commands before acknowledging any of them. While a connection has commands waiting for the
+# writer, its reads are queued behind them, so every client sees its own writes in order.
+#
+# With --tick, library time follows the server's clock: every tick the server queues Advance(<clock
+# time>) for the writer like any client command, so it is journaled with the time it carries and a
+# recovery fires the same timers. Due dates and expiry times are then in seconds (see --loan-period and
+# --reservation-ttl), and the notices the timers write are printed on stdout.
+import argparse
+import asyncio
+import io
+import signal
+import time
+
+from main import (COMMANDS, MUTATING_COMMANDS, ORDERED_INDEXES, READ_ONLY_COMMANDS, CommandJournal, GatorLibrary,
+                  ThreadOutput, format_command, parse_command, read_catalog)
+
+class LibraryServer:
+    def __init__(self, library, journal=None, pipeline=128, batch_size=256, tick=None, clock=time.time):
+        self.library = library
+        self.output = ThreadOutput()
+        library.output = self.output
+        self.journal = journal
+        self.pipeline = pipeline  # Responses a connection may have outstanding before it stops reading.
+        self.batch_size = batch_size  # Most commands the writer applies per group commit.
+        self.tick = tick  # Seconds between Advance commands, or None to leave library time alone.
+        self.clock = clock  # Source of the times those Advance commands carry.
+        self.writes = asyncio.Queue()
+        self.connections = set()
+
+    # Run one parsed command and return its output
+    def run(self, handler, args):
+        buffer = io.StringIO()
+        self.output.redirect(buffer)
+        try:
+            handler(self.library, *args)
+        except Exception as error:
+            buffer.write(f"Error: {error}\n")
+        return buffer.getvalue()
+
+    # The single writer: run queued commands in arrival order and answer them once they are durable
+    async def write_loop(self):
+        while True:
+            batch = [await self.writes.get()]
+            while len(batch) < self.batch_size and not self.writes.empty():
+                batch.append(self.writes.get_nowait())
+            results = []
+            for name, handler, args, future in batch:
+                if self.journal is not None and name in MUTATING_COMMANDS:
+                    self.journal.append(format_command(name, args))
+                results.append((future, self.run(handler, args)))
+            if self.journal is not None:
+                self.journal.commit()
+                self.journal.maybe_checkpoint(self.library)
+            for future, output in results:
+                if not future.done():
+                    future.set_result(output)
+
+    # Queue Advance to the clock's current time for the writer; the future's result is its output
+    def queue_advance(self):
+        future = asyncio.get_running_loop().create_future()
+        self.writes.put_nowait(('Advance', COMMANDS['Advance'][0], [int(self.clock())], future))
+        return future
+
+    # Ticks within the same second as the library's time queue nothing, so they are not journaled
+    async def tick_loop(self, first):
+        future = first
+        while True:
+            notices = await future if future is not None else ""
+            if notices:
+                print(notices, end="", flush=True)
+            await asyncio.sleep(self.tick)
+            future = self.queue_advance() if int(self.clock()) > self.library.now else None
+
+    async def send_responses(self, responses, writer):
+        try:
+            while True:
+                future = await responses.get()
+                if future is None:
+                    break
+                writer.write((await future).encode("utf-8") + b"\n")
+                if responses.empty():
+                    await writer.drain()
+        except ConnectionError:
+            pass
+
+    async def handle_connection(self, reader, writer):
+        loop = asyncio.get_running_loop()
+        responses = asyncio.Queue(self.pipeline)
+        sender = asyncio.create_task(self.send_responses(responses, writer))
+        self.connections.add(writer)
+        last_queued = None
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    command = parse_command(line.decode("utf-8"))
+                except (ValueError, UnicodeDecodeError) as error:
+                    future = loop.create_future()
+                    future.set_result(f"Error: {error}\n")
+                    await responses.put(future)
+                    continue
+                if command is None:
+                    continue
+                name, handler, args = command
+                if name in READ_ONLY_COMMANDS and (last_queued is None or last_queued.done()):
+                    future = loop.create_future()
+                    future.set_result(self.run(handler, args))
+                else:
+                    # Once a command of this connection is queued, later reads queue behind it too.
+                    future = last_queued = loop.create_future()
+                    self.writes.put_nowait((name, handler, args, future))
+                await responses.put(future)
+                if name == 'Quit':
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            await responses.put(None)
+            await sender
+            self.connections.discard(writer)
+            writer.close()
+
+    async def serve(self, tcp=None, unix=None):
+        # The first Advance is queued before any client command, so no loan starts at the old library time.
+        ticker = asyncio.create_task(self.tick_loop(self.queue_advance())) if self.tick else None
+        if unix is not None:
+            server = await asyncio.start_unix_server(self.handle_connection, unix)
+        else:
+            host, _, port = tcp.rpartition(":")
+            server = await asyncio.start_server(self.handle_connection, host or None, int(port))
+        writer_task = asyncio.create_task(self.write_loop())
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, stop.set)
+        addresses = ", ".join(str(sock.getsockname()) for sock in server.sockets)
+        print(f"Serving {len(self.library.book_dict)} books on {addresses}", flush=True)
+        async with server:
+            await stop.wait()
+            for writer in list(self.connections):
+                writer.close()
+        # Let the writer finish everything already queued before shutting down.
+        if ticker is not None:
+            ticker.cancel()
+        while not self.writes.empty():
+            await asyncio.sleep(0.01)
+        writer_task.cancel()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve a Gator Library over TCP or a Unix socket.")
+    address = parser.add_mutually_exclusive_group(required=True)
+    address.add_argument("--tcp", metavar="HOST:PORT", help="listen on a TCP address")
+    address.add_argument("--unix", metavar="PATH", help="listen on a Unix domain socket")
+    parser.add_argument("--reservation-capacity", type=int, default=20, metavar="N",
+                        help="maximum number of reservations per book")
+    parser.add_argument("--render-cache", type=int, default=4096, metavar="N",
+                        help="number of rendered book records to cache (0 disables the cache)")
+    parser.add_argument("--index", choices=ORDERED_INDEXES, default="redblack", help="ordered index for the books")
+    parser.add_argument("--tick", type=float, metavar="SECONDS",
+                        help="advance library time to the clock (in whole seconds) every SECONDS")
+    parser.add_argument("--loan-period", type=int, metavar="T",
+                        help="loans fall due T library time units after they start (seconds with --tick)")
+    parser.add_argument("--reservation-ttl", type=int, metavar="T",
+                        help="reservations expire T library time units after they are made")
+    parser.add_argument("--catalog", help="file of InsertBook commands bulk-loaded at startup")
+    parser.add_argument("--restore", metavar="SNAPSHOT", help="load a library snapshot at startup")
+    parser.add_argument("--save", metavar="SNAPSHOT", help="save a library snapshot at shutdown")
+    parser.add_argument("--journal", metavar="DIR",
+                        help="recover from and write a journal of state-changing commands in DIR")
+    parser.add_argument("--checkpoint-every", type=int, default=100000, metavar="N",
+                        help="checkpoint the journal every N state-changing commands")
+    parser.add_argument("--pipeline", type=int, default=128, metavar="N",
+                        help="outstanding responses per connection before it stops reading")
+    args = parser.parse_args(argv)
+
+    library = GatorLibrary(reservation_capacity=args.reservation_capacity, render_cache_size=args.render_cache,
+                           index=args.index, loan_period=args.loan_period, reservation_ttl=args.reservation_ttl)
+    journal = None
+    if args.journal:
+        # Every batch is committed by the writer, so the journal never needs to sync on its own.
+        journal = CommandJournal(args.journal, sync_every=1 << 30, sync_interval=float("inf"),
+                                 checkpoint_every=args.checkpoint_every)
+        journal.recover(library)
+    if args.restore:
+        library.load_snapshot(args.restore)
+    if args.catalog:
+        with open(args.catalog, 'r') as catalog:
+            library.load_catalog(read_catalog(catalog))
+    if journal is not None and (args.restore or args.catalog):
+        journal.checkpoint(library)
+    try:
+        asyncio.run(LibraryServer(library, journal, args.pipeline, tick=args.tick).serve(args.tcp, args.unix))
+    finally:
+        if journal is not None:
+            journal.close()
+    if args.save:
+        library.save_snapshot(args.save)
+
+if __name__ == "__main__":
+    main()
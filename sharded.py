@@ -0,0 +1,513 @@
+# Range-sharded Gator Library
+#
+# Usage: python sharded.py filename [--shards N] [--max-id M] [--catalog FILE] [--rebalance-every N]
+#                           [--loan-period T] [--reservation-ttl T] [--stats FILE] [--strict]
+#
+# The bookID space is cut into contiguous ranges, one per worker process. Each worker owns a
+# GatorLibrary with its own RedBlackTree and book_dict. The router process reads the command file,
+# sends point commands to the shard owning the bookID, and scatters range and patron commands to the
+# shards involved. It writes the gathered output to filename_output_file.txt in command order, exactly
+# as main.py would. There are two differences: ColorFlipCount is the sum of the shards' counts, since
+# each shard rebalances its own tree, and Advance reports the timers of different shards that fall due
+# at the same time in shard order rather than in the order they were set. Stats adds up the shards'
+# metrics; its command latencies are those of the requests the shards ran, so a scattered command is
+# counted once per shard it reached, under the name of its shard-side part.
+#
+# Requests are batched per shard and pipelined: the router keeps routing while the shards work and
+# only waits for a reply when it has to write that command's output, or when the reply decides
+# where the command goes next (FindClosestBook at a range boundary, SelectBook, rebalancing).
+import argparse
+import bisect
+import heapq
+import io
+import json
+import multiprocessing
+import os
+import time
+from collections import Counter, deque
+from operator import itemgetter
+
+from main import (COMMANDS, CommandStats, GatorLibrary, NullStream, OutputSink, ThreadOutput, format_stats,
+                  parse_commands, parse_flush_policy, read_catalog)
+
+# Position of the bookID among the arguments of each command routed to a single shard
+POINT_COMMANDS = {'InsertBook': 0, 'PrintBook': 0, 'DeleteBook': 0, 'BorrowBook': 1, 'ReturnBook': 1,
+                  'CancelReservation': 1, 'UpdatePriority': 1}
+
+# Range commands whose output is the concatenation of each overlapping shard's output
+RANGE_COMMANDS = {'PrintBooks', 'DeleteBooks'}
+
+BATCH_SIZE = 256  # Requests per message to a shard.
+WINDOW = 2  # Batches in flight per shard; small enough that neither side blocks on a full pipe.
+PENDING_OUTPUTS = 4096  # Commands whose output the router may hold before it waits for the oldest.
+
+# Queries answered by a shard with a value instead of command output; called as query(library, *args)
+def closest_keys(library, targetID):
+    lower = library.book_index.predecessor(targetID)
+    higher = library.book_index.successor(targetID)
+    return lower and lower[0], higher and higher[0]
+
+def local_rank(library, bookID):
+    return library.book_index.count_less(bookID) + 1 if bookID in library.book_dict else None
+
+def count_range(library, bookID1, bookID2):
+    index = library.book_index
+    return index.count_less(bookID2, inclusive=True) - index.count_less(bookID1) if bookID1 <= bookID2 else 0
+
+def patron_holdings(library, patronID):
+    return library.patron_index.borrowed_by(patronID), library.patron_index.reserved_by(patronID)
+
+# Shard-side parts of scattered commands; like commands, their output is sent back as text
+def return_all(library, patronID):
+    if library.patron_index.loans.get(patronID):
+        library.ReturnAll(patronID)
+
+def find_books(library, name, query):
+    index = library.catalog_index
+    bookIDs = list(index.find_author(query) if name == 'FindByAuthor' else index.find_title(query))
+    if bookIDs:
+        library.print_books(bookIDs)
+
+def load_books(library, records):
+    library.load_catalog(records)
+
+# Books move between shards with their loan and reservation timers
+def export_books(library, bookID1, bookID2):
+    part = library.split_catalog(bookID1, bookID2)
+    return [book for _, book in part.book_index.iter_items()], part.timers.items()
+
+def import_books(library, books, timers):
+    part = GatorLibrary(OutputSink(stream=NullStream()), library.reservation_capacity)
+    part.book_index.build_from_sorted([(book.bookID, book) for book in books])
+    part.book_dict = {book.bookID: book for book in books}
+    part.timers.restore(timers)
+    library.MergeCatalog(part)
+
+# Shard-side part of Advance: fire the shard's due timers and return each one's output with its
+# deadline, so the router can interleave the shards' notices in time order
+def advance(library, now):
+    library.now = now
+    events = []
+    for key, deadline in library.timers.pop_due(now):
+        buffer = io.StringIO()
+        library.output.redirect(buffer)
+        library.fire_timer(key, deadline)
+        events.append((deadline, buffer.getvalue()))
+    return events
+
+# The shard's stats_snapshot, with its CommandStats itself in place of their summary so that the
+# router can merge the latency histograms
+def shard_stats(library):
+    snapshot = library.stats_snapshot()
+    snapshot["commands"] = library.stats
+    return snapshot
+
+SHARD_QUERIES = {
+    'closest': closest_keys,
+    'rank': local_rank,
+    'count': count_range,
+    'size': lambda library: len(library.book_index),
+    'select': lambda library, k: library.book_index.select_item(k)[0],
+    'flips': GatorLibrary.ColorFlipCount,
+    'holdings': patron_holdings,
+    'export': export_books,
+    'import': import_books,
+    'advance': advance,
+    'stats': shard_stats,
+}
+
+SHARD_COMMANDS = {'return_all': return_all, 'find': find_books, 'load': load_books}
+
+# Worker process: run batches of ('run', name, args) commands and (query, None, args) requests against
+# the shard's library and answer each batch with a list holding each command's output or query's value.
+# With stats, every request but 'stats' is timed under its command or query name.
+def shard_worker(connection, reservation_capacity, render_cache_size, loan_period, reservation_ttl, stats):
+    output = ThreadOutput()
+    library = GatorLibrary(output, reservation_capacity, render_cache_size, loan_period=loan_period,
+                           reservation_ttl=reservation_ttl)
+    if stats:
+        library.stats = CommandStats()
+    while True:
+        try:
+            batch = connection.recv()
+        except EOFError:
+            break
+        if batch is None:
+            break
+        results = []
+        for kind, name, args in batch:
+            buffer = io.StringIO()
+            output.redirect(buffer)
+            if kind == 'run':
+                handler = COMMANDS[name][0] if name in COMMANDS else SHARD_COMMANDS[name]
+                if library.stats is None:
+                    handler(library, *args)
+                else:
+                    library.stats.run(name, handler, library, args)
+                results.append(buffer.getvalue())
+            elif library.stats is None or kind == 'stats':
+                results.append(SHARD_QUERIES[kind](library, *args))
+            else:
+                start = time.perf_counter_ns()
+                results.append(SHARD_QUERIES[kind](library, *args))
+                library.stats.record(kind, time.perf_counter_ns() - start)
+        connection.send(results)
+    connection.close()
+
+# Router-side handle of one shard: requests are numbered with tickets, sent in batches, and their
+# results kept until asked for, so replies can be collected in any order
+class Shard:
+    def __init__(self, reservation_capacity, render_cache_size, loan_period=None, reservation_ttl=None, stats=False):
+        self.connection, worker_connection = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=shard_worker, daemon=True,
+                                               args=(worker_connection, reservation_capacity, render_cache_size,
+                                                     loan_period, reservation_ttl, stats))
+        self.process.start()
+        worker_connection.close()
+        self.batch = []
+        self.in_flight = deque()  # Sizes of the batches sent and not yet answered.
+        self.next_ticket = 0
+        self.answered = 0  # Every ticket below this has its result in results.
+        self.results = {}
+        self.discarded = set()  # Tickets whose results nobody will ask for.
+        self.load = 0  # Commands routed here since the last rebalance.
+
+    # With discard, the result is dropped when it arrives; use it for requests run only for their effect
+    def request(self, kind, name=None, args=(), discard=False):
+        ticket = self.next_ticket
+        self.next_ticket += 1
+        if discard:
+            self.discarded.add(ticket)
+        self.batch.append((kind, name, args))
+        if len(self.batch) >= BATCH_SIZE:
+            self.send()
+        return ticket
+
+    def send(self):
+        if self.batch:
+            if len(self.in_flight) >= WINDOW:
+                self.receive()
+            self.connection.send(self.batch)
+            self.in_flight.append(len(self.batch))
+            self.batch = []
+
+    def receive(self):
+        for value in self.connection.recv():
+            if self.answered in self.discarded:
+                self.discarded.remove(self.answered)
+            else:
+                self.results[self.answered] = value
+            self.answered += 1
+        self.in_flight.popleft()
+
+    def result(self, ticket):
+        while ticket >= self.answered:
+            if not self.in_flight:
+                self.send()
+            self.receive()
+        return self.results.pop(ticket)
+
+    def close(self):
+        self.send()
+        while self.in_flight:
+            self.receive()
+        self.connection.send(None)
+        self.process.join()
+
+# Combine the shards' stats: counters and sizes add up, while the index's height, black height and block
+# size are those of the tallest or largest shard
+def merge_stats(snapshots):
+    index = {}
+    depths = Counter()
+    render_cache = Counter()
+    timers = {"now": 0, "pending": 0, "heap_entries": 0}
+    commands = None
+    for snapshot in snapshots:
+        for name, value in snapshot["index"].items():
+            if name == "type" or value is None:
+                index[name] = value
+            elif name in ("height", "black_height", "block_size"):
+                index[name] = max(index.get(name, 0), value)
+            else:
+                index[name] = index.get(name, 0) + value
+        depths.update(snapshot["reservation_queue_depths"])
+        render_cache.update(snapshot["render_cache"])
+        timers["now"] = max(timers["now"], snapshot["timers"]["now"])
+        timers["pending"] += snapshot["timers"]["pending"]
+        timers["heap_entries"] += snapshot["timers"]["heap_entries"]
+        if snapshot["commands"] is not None:
+            if commands is None:
+                commands = CommandStats()
+            commands.merge(snapshot["commands"])
+    return {
+        "index": index,
+        "reservation_queue_depths": dict(sorted(depths.items())),
+        "render_cache": dict(render_cache),
+        "timers": timers,
+        "commands": commands.snapshot() if commands is not None else {},
+    }
+
+class ShardedLibrary:
+    # bounds are the lowest bookIDs of shards 1..n-1: shard i owns [bounds[i - 1], bounds[i]), the first
+    # shard everything below bounds[0] and the last everything from bounds[-1] up
+    def __init__(self, bounds, output=None, reservation_capacity=20, render_cache_size=4096, loan_period=None,
+                 reservation_ttl=None, stats=False):
+        if any(low >= high for low, high in zip(bounds, bounds[1:])):
+            raise ValueError(f"Shard bounds must increase: {bounds}")
+        self.bounds = list(bounds)
+        self.output = output if output is not None else OutputSink()
+        self.shards = [Shard(reservation_capacity, render_cache_size, loan_period, reservation_ttl, stats)
+                       for _ in range(len(bounds) + 1)]
+        self.now = 0  # Library time, kept in step with every shard's by Advance.
+        self.pending = deque()  # Output of each routed command: a string, or a callable producing it.
+
+    # Split [1, max_id] into equal ranges for the given number of shards
+    @classmethod
+    def even(cls, shards, max_id, *args, **kwargs):
+        return cls([1 + i * max_id // shards for i in range(1, shards)], *args, **kwargs)
+
+    def shard_of(self, bookID):
+        return bisect.bisect_right(self.bounds, bookID)
+
+    # Indexes of the shards whose ranges overlap [bookID1, bookID2]
+    def shards_between(self, bookID1, bookID2):
+        return range(self.shard_of(bookID1), self.shard_of(bookID2) + 1) if bookID1 <= bookID2 else range(0)
+
+    def defer(self, output):
+        self.pending.append(output)
+        if len(self.pending) > PENDING_OUTPUTS:
+            self.write_oldest()
+
+    def write_oldest(self):
+        output = self.pending.popleft()
+        self.output.write(output if isinstance(output, str) else output())
+        self.output.end_command()
+
+    # Write the output of every routed command
+    def drain(self):
+        while self.pending:
+            self.write_oldest()
+
+    # Route one parsed command; its output is written once its shards have answered
+    def execute(self, name, args):
+        shards = self.shards
+        if name in POINT_COMMANDS:
+            shard = shards[self.shard_of(args[POINT_COMMANDS[name]])]
+            shard.load += 1
+            ticket = shard.request('run', name, args)
+            self.defer(lambda: shard.result(ticket))
+        elif name in RANGE_COMMANDS:
+            self.gather([(shards[i], shards[i].request('run', name, args)) for i in self.shards_between(*args)])
+        elif name == 'FindClosestBook':
+            self.find_closest(args[0])
+        elif name == 'CountBooks':
+            tickets = [(shards[i], shards[i].request('count', None, args)) for i in self.shards_between(*args)]
+            self.defer(lambda: f"Book Count: {sum(shard.result(ticket) for shard, ticket in tickets)}\n")
+        elif name == 'Rank':
+            self.rank(args[0])
+        elif name == 'SelectBook':
+            self.select(args[0])
+        elif name in ('FindByAuthor', 'FindByTitle'):
+            self.gather([(shard, shard.request('run', 'find', (name, args[0]))) for shard in shards], "No book found.\n")
+        elif name == 'ReturnAll':
+            self.gather([(shard, shard.request('run', 'return_all', args)) for shard in shards],
+                        f"Patron {args[0]} has no borrowed books.\n")
+        elif name == 'PatronSummary':
+            tickets = [(shard, shard.request('holdings', None, args)) for shard in shards]
+
+            def summary():
+                borrowed, reserved = [], []
+                for shard, ticket in tickets:
+                    shard_borrowed, shard_reserved = shard.result(ticket)
+                    borrowed += shard_borrowed
+                    reserved += shard_reserved
+                return f"PatronID = {args[0]}\nBorrowed = {borrowed}\nReserved = {reserved}\n"
+            self.defer(summary)
+        elif name == 'ColorFlipCount':
+            tickets = [(shard, shard.request('flips')) for shard in shards]
+            self.defer(lambda: f"Color Flip Count: {sum(shard.result(ticket) for shard, ticket in tickets)}\n")
+        elif name == 'Advance':
+            self.advance(args[0])
+        elif name == 'Stats':
+            tickets = [(shard, shard.request('stats')) for shard in shards]
+            self.defer(lambda: format_stats(merge_stats([shard.result(ticket) for shard, ticket in tickets])))
+        elif name == 'Quit':
+            self.defer('Program Terminated!!\n')
+            self.drain()
+            self.output.flush()
+        else:
+            raise ValueError(f"{name} is not supported by the sharded library")
+
+    # Concatenate the outputs of several shard requests in shard (and so bookID) order
+    def gather(self, tickets, empty=""):
+        self.defer(lambda: "".join(shard.result(ticket) for shard, ticket in tickets) or empty)
+
+    # The owner shard knows the closest books on both sides unless the target lies before its first or
+    # after its last book; only then are the neighbouring shards consulted, moving outwards until one
+    # has a book. The chosen books are then printed by their own shards.
+    def find_closest(self, targetID):
+        owner = self.shard_of(targetID)
+        lower, higher = self.shards[owner].result(self.shards[owner].request('closest', None, (targetID,)))
+        index = owner
+        while lower is None and index > 0:
+            index -= 1
+            shard = self.shards[index]
+            lower = shard.result(shard.request('closest', None, (targetID,)))[0]
+        index = owner
+        while higher is None and index < len(self.shards) - 1:
+            index += 1
+            shard = self.shards[index]
+            higher = shard.result(shard.request('closest', None, (targetID,)))[1]
+        # The same rule as GatorLibrary.FindClosestBook: both books on a tie, lower first.
+        lower_diff = targetID - lower if lower is not None else float('inf')
+        higher_diff = higher - targetID if higher is not None else float('inf')
+        chosen = [bookID for bookID, diff in ((lower, lower_diff), (higher, higher_diff))
+                  if bookID is not None and diff == min(lower_diff, higher_diff)]
+        tickets = []
+        for bookID in chosen:
+            shard = self.shards[self.shard_of(bookID)]
+            tickets.append((shard, shard.request('run', 'PrintBook', (bookID,))))
+        self.gather(tickets)
+
+    # Every shard moves to the new time; their notices are merged by deadline, as one library's would be
+    def advance(self, now):
+        if now < self.now:
+            # All shards share the library time, so any of them writes the refusal.
+            shard = self.shards[0]
+            ticket = shard.request('run', 'Advance', (now,))
+            self.defer(lambda: shard.result(ticket))
+            return
+        self.now = now
+        tickets = [(shard, shard.request('advance', None, (now,))) for shard in self.shards]
+        self.defer(lambda: "".join(text for _, text in heapq.merge(*(shard.result(ticket) for shard, ticket in tickets),
+                                                                   key=itemgetter(0))))
+
+    def rank(self, bookID):
+        owner = self.shard_of(bookID)
+        rank_ticket = self.shards[owner].request('rank', None, (bookID,))
+        size_tickets = [(shard, shard.request('size')) for shard in self.shards[:owner]]
+
+        def output():
+            rank = self.shards[owner].result(rank_ticket)
+            before = sum(shard.result(ticket) for shard, ticket in size_tickets)
+            if rank is None:
+                return f"Book {bookID} not found in the Library.\n"
+            return f"Rank of Book {bookID}: {before + rank}\n"
+        self.defer(output)
+
+    def select(self, k):
+        for shard in self.shards:
+            size = shard.result(shard.request('size'))
+            if 1 <= k <= size:
+                ticket = shard.request('run', 'SelectBook', (k,))
+                self.defer(lambda: shard.result(ticket))
+                return
+            k -= size
+        self.defer("No book found.\n")
+
+    # Bulk-load (bookID, bookName, authorName, availabilityStatus[, borrowedBy]) records, each on its shard
+    def load_catalog(self, records):
+        parts = [[] for _ in self.shards]
+        for record in records:
+            parts[self.shard_of(record[0])].append(record)
+        self.gather([(shard, shard.request('run', 'load', (part,))) for shard, part in zip(self.shards, parts)])
+
+    # Move the boundary between shards index - 1 and index to bound, handing the books in between
+    # (with their loans and reservations) to the other shard
+    def rebalance(self, index, bound):
+        low = self.bounds[index - 2] if index > 1 else None
+        high = self.bounds[index] if index < len(self.bounds) else None
+        if (low is not None and bound <= low) or (high is not None and bound >= high):
+            raise ValueError(f"Bound {bound} would leave shard {index - 1} or {index} without a range")
+        current = self.bounds[index - 1]
+        if bound < current:
+            source, target, bookID1, bookID2 = self.shards[index - 1], self.shards[index], bound, current - 1
+        else:
+            source, target, bookID1, bookID2 = self.shards[index], self.shards[index - 1], current, bound - 1
+        books, timers = source.result(source.request('export', None, (bookID1, bookID2)))
+        target.request('import', None, (books, timers), discard=True)
+        self.bounds[index - 1] = bound
+        return len(books)
+
+    # Split the busiest shard's range at its median book and hand one half to its less busy neighbour
+    def rebalance_load(self):
+        if len(self.shards) < 2:
+            return 0
+        hot = max(range(len(self.shards)), key=lambda i: self.shards[i].load)
+        shard = self.shards[hot]
+        size = shard.result(shard.request('size'))
+        moved = 0
+        if size >= 2:
+            median = shard.result(shard.request('select', None, (size // 2 + 1,)))
+            left = self.shards[hot - 1].load if hot > 0 else None
+            right = self.shards[hot + 1].load if hot < len(self.shards) - 1 else None
+            try:
+                if right is None or (left is not None and left <= right):
+                    moved = self.rebalance(hot, median)
+                else:
+                    moved = self.rebalance(hot + 1, median)
+            except ValueError:
+                pass  # The median sits on a boundary already; nothing to move.
+        for shard in self.shards:
+            shard.load = 0
+        return moved
+
+    # The library's metrics as GatorLibrary.stats_snapshot would report them, summed over the shards
+    def stats_snapshot(self):
+        tickets = [(shard, shard.request('stats')) for shard in self.shards]
+        return merge_stats([shard.result(ticket) for shard, ticket in tickets])
+
+    def close(self):
+        self.drain()
+        for shard in self.shards:
+            shard.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run a Gator Library command file on range-sharded worker processes.")
+    parser.add_argument("filename")
+    parser.add_argument("--shards", type=int, default=os.cpu_count(), metavar="N", help="number of worker processes")
+    parser.add_argument("--max-id", type=int, default=1_000_000, metavar="M",
+                        help="bookIDs 1..M are split evenly between the shards")
+    parser.add_argument("--flush", type=parse_flush_policy, default="command",
+                        help='output flush policy: "command", "quit" or every N commands')
+    parser.add_argument("--reservation-capacity", type=int, default=20, metavar="N",
+                        help="maximum number of reservations per book")
+    parser.add_argument("--render-cache", type=int, default=4096, metavar="N",
+                        help="number of rendered book records to cache per shard (0 disables the cache)")
+    parser.add_argument("--catalog", help="file of InsertBook commands bulk-loaded before the command file")
+    parser.add_argument("--rebalance-every", type=int, default=0, metavar="N",
+                        help="move half of the busiest shard's books to a neighbour every N commands")
+    parser.add_argument("--loan-period", type=int, metavar="T",
+                        help="loans fall due T library time units after they start (see Advance)")
+    parser.add_argument("--reservation-ttl", type=int, metavar="T",
+                        help="reservations expire T library time units after they are made")
+    parser.add_argument("--stats", metavar="FILE",
+                        help="time every shard request and write the shards' combined metrics to FILE as JSON at exit")
+    parser.add_argument("--strict", action="store_true",
+                        help="stop at the first line that does not parse instead of reporting it and going on")
+    args = parser.parse_args(argv)
+
+    with open(args.filename, 'r') as file, OutputSink(f'{args.filename}_output_file.txt', args.flush) as output, \
+            ShardedLibrary.even(args.shards, args.max_id, output, args.reservation_capacity, args.render_cache,
+                                args.loan_period, args.reservation_ttl, bool(args.stats)) as library:
+        if args.catalog:
+            with open(args.catalog, 'r') as catalog:
+                library.load_catalog(read_catalog(catalog))
+        # Like run_commands, report a line that does not parse in its place in the output and go on.
+        report = None if args.strict else lambda error: library.defer(f"Error: {error}\n")
+        for count, (name, handler, command_args) in enumerate(parse_commands(file, report), 1):
+            library.execute(name, command_args)
+            if args.rebalance_every and count % args.rebalance_every == 0:
+                library.rebalance_load()
+        if args.stats:
+            with open(args.stats, 'w') as stats_file:
+                json.dump(library.stats_snapshot(), stats_file, indent=2)
+
+if __name__ == "__main__":
+    main()